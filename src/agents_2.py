@@ -1,12 +1,13 @@
 import datetime
 import json
 import sys
-from openai import OpenAI
-from medrag import MedRAG
+import asyncio
+from medrag import MedRAG, chat_completion, achat_completion
 
 MODEL_NAME = "deepseek-chat"  
 
-client = OpenAI(api_key="", base_url="https://api.deepseek.com")
+# endpoint of the doctors' LLM, served by the pooled client shared through medrag.get_openai_client
+CLIENT_KWARGS = {"api_key": "", "base_url": "https://api.deepseek.com"}
 
 class BaseDoctor:
     def __init__(self, llm_name="OpenAI/gpt-3.5-turbo-16k", retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus"):
@@ -19,8 +20,9 @@ class BaseDoctor:
             db_dir=db_dir
         )
 
-    def process_medical_text(self, input_text, k=3):
-        retrieved_snippets, scores = self.medrag.medrag_retrieve(input_text, k=k)
+    def process_medical_text(self, input_text, k=3, dedup=None, token_budget=None, score_gap=None):
+        # dedup=None: as MedRAG is set up (MEDRAG_DEDUP)
+        retrieved_snippets, scores = self.medrag.medrag_retrieve(input_text, k=k, dedup=dedup, token_budget=token_budget, score_gap=score_gap)
         
         retrieved_info = "\n".join([
             "Document [{:d}] (Title: {:s}) {:s}".format(
@@ -32,6 +34,41 @@ class BaseDoctor:
             'retrieved_info': retrieved_info,
         }
 
+    def _respond(self, system_message, user_message, retrieved_info):
+        response = chat_completion(
+            client_kwargs=CLIENT_KWARGS,
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message}
+            ],
+            stream=False
+        )
+
+        return {
+            'prompt': system_message,
+            'response': response.choices[0].message.content,
+            'retrieved_info': retrieved_info
+        }
+
+    async def _arespond(self, system_message, user_message, retrieved_info, timeout=None):
+        response = await achat_completion(
+            client_kwargs=CLIENT_KWARGS,
+            timeout=timeout,
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message}
+            ],
+            stream=False
+        )
+
+        return {
+            'prompt': system_message,
+            'response': response.choices[0].message.content,
+            'retrieved_info': retrieved_info
+        }
+
 # Chief complaint doctor agent
 class ChiefComplaintDoctor(BaseDoctor):
     def __init__(self):
@@ -44,7 +81,14 @@ class ChiefComplaintDoctor(BaseDoctor):
     
     def examine_patient(self, patient_info):
         print("The chief physician is currently handling the matter...")
-        
+        return self._respond(*self._examine_patient_prompt(patient_info))
+
+    async def aexamine_patient(self, patient_info, timeout=None):
+        print("The chief physician is currently handling the matter...")
+        prompt = await asyncio.to_thread(self._examine_patient_prompt, patient_info)
+        return await self._arespond(*prompt, timeout=timeout)
+
+    def _examine_patient_prompt(self, patient_info):
         input_text = patient_info["Chief-Complaints"] + " " + patient_info["Present-Illness"]
         
         result = self.process_medical_text(input_text)
@@ -96,20 +140,8 @@ Please ensure that the output strictly follows the above format and only include
             retrieved_info=result['retrieved_info']
         )
 
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": "Please ensure that the output strictly follows the above format and only includes the evidence tree structure. Avoid any additional text or explanations outside the tree structure. "}
-            ],
-            stream=False
-        )
-        
-        return {
-            'prompt': system_message,
-            'response': response.choices[0].message.content,
-            'retrieved_info': result['retrieved_info']
-        }
+        user_message = "Please ensure that the output strictly follows the above format and only includes the evidence tree structure. Avoid any additional text or explanations outside the tree structure. "
+        return system_message, user_message, result['retrieved_info']
 
 def chief_complaint_agent(patient_info):
     doctor = ChiefComplaintDoctor()
@@ -127,7 +159,14 @@ class LabDoctor(BaseDoctor):
     
     def analyze_results(self, lab_results):
         print("The laboratory doctor is currently handling it...")
-        
+        return self._respond(*self._analyze_results_prompt(lab_results))
+
+    async def aanalyze_results(self, lab_results, timeout=None):
+        print("The laboratory doctor is currently handling it...")
+        prompt = await asyncio.to_thread(self._analyze_results_prompt, lab_results)
+        return await self._arespond(*prompt, timeout=timeout)
+
+    def _analyze_results_prompt(self, lab_results):
         result = self.process_medical_text(lab_results)
 
         template = """
@@ -167,20 +206,8 @@ Please ensure that the output strictly follows the above format and only include
             retrieved_info=result['retrieved_info']
         )
 
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": "Please carefully consider and answer the above questions."}
-            ],
-            stream=False
-        )
-        
-        return {
-            'prompt': system_message,
-            'response': response.choices[0].message.content,
-            'retrieved_info': result['retrieved_info']
-        }
+        user_message = "Please carefully consider and answer the above questions."
+        return system_message, user_message, result['retrieved_info']
 
 def lab_agent(lab_results):
     doctor = LabDoctor()
@@ -199,7 +226,14 @@ class ImagingDoctor(BaseDoctor):
     
     def analyze_images(self, imaging_results):
         print("The imaging doctor is currently processing it...")
-        
+        return self._respond(*self._analyze_images_prompt(imaging_results))
+
+    async def aanalyze_images(self, imaging_results, timeout=None):
+        print("The imaging doctor is currently processing it...")
+        prompt = await asyncio.to_thread(self._analyze_images_prompt, imaging_results)
+        return await self._arespond(*prompt, timeout=timeout)
+
+    def _analyze_images_prompt(self, imaging_results):
         result = self.process_medical_text(imaging_results)
 
         template = """
@@ -237,20 +271,8 @@ Please ensure that the output strictly follows the above format and only include
             retrieved_info=result['retrieved_info']
         )
 
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": "Please carefully consider and answer the above questions."}
-            ],
-            stream=False
-        )
-        
-        return {
-            'prompt': system_message,
-            'response': response.choices[0].message.content,
-            'retrieved_info': result['retrieved_info']
-        }
+        user_message = "Please carefully consider and answer the above questions."
+        return system_message, user_message, result['retrieved_info']
 
 def imaging_agent(imaging_results):
     doctor = ImagingDoctor()
@@ -269,7 +291,14 @@ class PathologyDoctor(BaseDoctor):
     
     def analyze_pathology(self, pathology_results):
         print("The pathologist is currently handling it...")
-        
+        return self._respond(*self._analyze_pathology_prompt(pathology_results))
+
+    async def aanalyze_pathology(self, pathology_results, timeout=None):
+        print("The pathologist is currently handling it...")
+        prompt = await asyncio.to_thread(self._analyze_pathology_prompt, pathology_results)
+        return await self._arespond(*prompt, timeout=timeout)
+
+    def _analyze_pathology_prompt(self, pathology_results):
         result = self.process_medical_text(pathology_results)
 
         template = """
@@ -309,20 +338,8 @@ Please ensure that the output strictly follows the above format and only include
             retrieved_info=result['retrieved_info']
         )
 
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": "Please carefully consider and answer the above questions."}
-            ],
-            stream=False
-        )
-        
-        return {
-            'prompt': system_message,
-            'response': response.choices[0].message.content,
-            'retrieved_info': result['retrieved_info']
-        }
+        user_message = "Please carefully consider and answer the above questions."
+        return system_message, user_message, result['retrieved_info']
 
 def pathology_agent(pathology_results):
     doctor = PathologyDoctor()
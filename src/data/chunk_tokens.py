@@ -0,0 +1,9 @@
+import tiktoken
+
+# n_tokens stored with each chunk by the chunking scripts, so token-budgeted retrieval (utils.select_by_token_budget)
+# need not count them. Only corpora chunked locally by these scripts have it: the chunks cloned from Huggingface do
+# not, and retrieval estimates the count of each snippet it considers instead
+encoding = tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text):
+    return len(encoding.encode(text, disallowed_special=()))
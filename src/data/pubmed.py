@@ -2,6 +2,7 @@ import os
 import gzip
 import tqdm
 import json
+from chunk_tokens import count_tokens
 
 def ends_with_ending_punctuation(s):
     ending_punctuation = ('.', '?', '!')
@@ -18,6 +19,7 @@ def extract(gz_fpath):
     abstracts = []
     title = ""
     abs = ""
+    pmid = ""
     ids = []
 
     for line in gzip.open(gz_fpath, 'rt').read().split('\n'):
@@ -29,9 +31,9 @@ def extract(gz_fpath):
                 continue
             titles.append(title)
             abstracts.append(abs)
-            ids.append(id)
+            ids.append(pmid)
         if line.strip().startswith("<PMID"):
-            id = line.strip().strip("</PMID>").split(">")[-1]        
+            pmid = line.strip().strip("</PMID>").split(">")[-1]        
         if line.strip().startswith("<ArticleTitle>"):
             title = line.strip()[14:-15]
         if line.strip().startswith("<AbstractText"):
@@ -54,6 +56,6 @@ if __name__ == "__main__":
             continue
         gz_fpath = os.path.join("corpus/pubmed/baseline", fname)
         titles, abstracts, ids = extract(gz_fpath)
-        saved_text = [json.dumps({"id": "PMID:"+str(ids[i]), "title": titles[i], "content": abstracts[i], "contents": concat(titles[i], abstracts[i])}) for i in range(len(titles))]
+        saved_text = [json.dumps({"id": "PMID:"+str(ids[i]), "title": titles[i], "content": abstracts[i], "contents": concat(titles[i], abstracts[i]), "n_tokens": count_tokens(concat(titles[i], abstracts[i]))}) for i in range(len(titles))]
         with open("corpus/pubmed/chunk/{:s}".format(fname.replace(".xml.gz", ".jsonl")), 'w') as f:
             f.write('\n'.join(saved_text))
\ No newline at end of file
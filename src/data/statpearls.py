@@ -2,6 +2,7 @@ import os
 import json
 import tqdm
 import xml.etree.ElementTree as ET
+from chunk_tokens import count_tokens
 
 def ends_with_ending_punctuation(s):
     ending_punctuation = ('.', '?', '!')
@@ -98,7 +99,8 @@ if __name__ == "__main__":
         os.makedirs("corpus/statpearls/chunk")
     for fname in tqdm.tqdm(fnames):
         fpath = os.path.join("corpus/statpearls/statpearls_NBK430685", fname)
-        saved_text = extract(fpath)
+        saved_text = [json.loads(item) for item in extract(fpath)]
+        saved_text = [json.dumps(dict(item, n_tokens=count_tokens(item["contents"]))) for item in saved_text]
         if len(saved_text) > 0:
             with open("corpus/statpearls/chunk/{:s}".format(fname.replace(".nxml", ".jsonl")), 'w') as f:
                 f.write('\n'.join(saved_text))
\ No newline at end of file
@@ -4,6 +4,7 @@ import json
 import regex as re
 from datasets import load_dataset
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from chunk_tokens import count_tokens
 
 def ends_with_ending_punctuation(s):
     ending_punctuation = ('.', '?', '!')
@@ -31,7 +32,7 @@ if __name__ == "__main__":
         if os.path.exists("corpus/wikipedia/chunk/wiki20220301en{:s}.jsonl".format(str(save_id).rjust(len_just, '0'))):
             continue
         texts = text_splitter.split_text(dat['train'][i]['text'].strip())
-        curr_text = [json.dumps({"id": '_'.join([dat['train'][i]['id'], str(j)]), "title": dat['train'][i]['title'], "content": re.sub("\s+", " ", t), "contents": concat(dat['train'][i]['title'], re.sub("\s+", " ", t))}) for j, t in enumerate(texts)]
+        curr_text = [json.dumps({"id": '_'.join([dat['train'][i]['id'], str(j)]), "title": dat['train'][i]['title'], "content": re.sub("\s+", " ", t), "contents": concat(dat['train'][i]['title'], re.sub("\s+", " ", t)), "n_tokens": count_tokens(concat(dat['train'][i]['title'], re.sub("\s+", " ", t)))}) for j, t in enumerate(texts)]
         saved_text.extend(curr_text)
         if (i + 1) % batch_size == 0:
             with open("corpus/wikipedia/chunk/wiki20220301en{:s}.jsonl".format(str(save_id).rjust(len_just, '0')), 'w') as f:
@@ -1,22 +1,42 @@
-from agents_2 import BaseDoctor, ChiefComplaintDoctor, LabDoctor, ImagingDoctor, PathologyDoctor
+from agents_2 import ChiefComplaintDoctor, LabDoctor, ImagingDoctor, PathologyDoctor
+from medrag import chat_completion, achat_completion, achoose, run_async
+import llm_metrics
+from llm_metrics import call_context, count_cached_tokens
+from llm_scheduler import share_limits
+from event_log import EventLog
 import datetime
 import json
 import random
+import re
 from prettytable import PrettyTable
-from termcolor import cprint
 import os
 import glob
 from multiprocessing import Pool
-from openai import OpenAI
+import asyncio
 
 import traceback  
 from functools import partial 
 import time
 
 MODEL_NAME = "deepseek-chat"  
+# endpoint of the discussion LLM, served by the pooled client shared through medrag.get_openai_client
+CLIENT_KWARGS = {"api_key": "YOUR_API_KEY", "base_url": "https://api.deepseek.com"}
 
 ERROR_LOG = "error_log.txt"
 MAX_RETRIES = 3
+# LLM requests in flight per case during a discussion step (the process-wide cap is medrag.LLM_MAX_CONCURRENCY)
+MAX_CONCURRENCY = int(os.getenv("DISCUSSION_MAX_CONCURRENCY", 8))
+# how yes/no gates are answered: "text", "logprobs" or "stream" (see medrag.choose)
+DECISION_MODE = os.getenv("DECISION_MODE", "text")
+# "separate": a participation check, then one opinion call per target; "fused": one JSON call per doctor and turn
+# that returns both (see MedicalTeam._afused_opinions)
+DISCUSSION_MODE = os.getenv("DISCUSSION_MODE", "separate")
+# share of doctors whose evidence trees must lead with the same disease to end the discussion early ("off": never)
+# DISCUSSION_UPDATE_CONTEXT=on also sends the patient case (as the shared case_context) with the updated-diagnosis
+# calls, which otherwise see only the original diagnosis and the feedback; it costs the case's tokens per doctor and
+# round, mostly served from the provider's prefix cache
+UPDATE_WITH_CASE = os.getenv("DISCUSSION_UPDATE_CONTEXT", "off").lower() == "on"
+CONSENSUS_THRESHOLD = None if os.getenv("CONSENSUS_THRESHOLD", "1.0").lower() == "off" else float(os.getenv("CONSENSUS_THRESHOLD", "1.0"))
 
 # error logging
 def log_error(error_msg, case_file):
@@ -24,6 +44,31 @@ def log_error(error_msg, case_file):
         f.write(f"[{datetime.datetime.now().isoformat()}] File: {case_file}\n")
         f.write(f"Error: {error_msg}\n\n")
 
+# Journal of the completed LLM steps of one case, kept in an append-only event log (one {"step": ..., "value": ...}
+# event per line), so a retried or restarted case resumes after its last completed step
+class StepJournal:
+    def __init__(self, path):
+        self.path = path
+        self.log = EventLog(path, fsync=True)
+        self.steps = {}
+        if self.log.exists():
+            for entry in self.log.read():
+                self.steps[entry["step"]] = entry["value"]
+            print(f"Resuming from {len(self.steps)} journaled steps: {path}")
+
+    def __contains__(self, step):
+        return step in self.steps
+
+    def __getitem__(self, step):
+        return self.steps[step]
+
+    def record(self, step, value):
+        self.steps[step] = value
+        self.log.append("step", step=step, value=value)
+
+    def remove(self):
+        self.log.remove()
+
 def safe_process_case(case_file):
     retries = 0
     while retries < MAX_RETRIES:
@@ -45,16 +90,39 @@ def safe_process_case(case_file):
     return None
 
 
-def chat(cont):
+ANSWER_INSTRUCTION = "Please carefully consider and answer the above questions."
+
+# Messages for one call. With a context (the per-case material shared by every call of a case) the context alone
+# is the system message and cont follows it, so all calls of a case start with the same prefix, which DeepSeek
+# and OpenAI serve from their context cache
+def build_messages(cont, context=None):
+    if context is None:
+        return [
+            {"role": "system", "content": cont},
+            {"role": "user", "content": ANSWER_INSTRUCTION}
+        ]
+    return [
+        {"role": "system", "content": context},
+        {"role": "user", "content": f"{cont}\n\n{ANSWER_INSTRUCTION}"}
+    ]
+
+# Add the token usage of a response to usage (prompt / cached / completion tokens)
+def record_usage(usage, response):
+    if usage is None or response.usage is None:
+        return
+    usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + (response.usage.prompt_tokens or 0)
+    usage["cached_tokens"] = usage.get("cached_tokens", 0) + count_cached_tokens(response.usage)
+    usage["completion_tokens"] = usage.get("completion_tokens", 0) + (response.usage.completion_tokens or 0)
+
+def chat(cont, context=None, usage=None):
     try:
-        response = client.chat.completions.create(
+        response = chat_completion(
+            client_kwargs=CLIENT_KWARGS,
             model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": cont},
-                {"role": "user", "content": "Please carefully consider and answer the above questions."}
-            ],
+            messages=build_messages(cont, context),
             stream=False
         )
+        record_usage(usage, response)
 
         result = response.choices[0].message.content
 
@@ -63,9 +131,95 @@ def chat(cont):
         print(f"API Error calling or parsing response: {str(e)}")
         return None
 
+# json_mode asks for a JSON object (the prompt itself must mention JSON)
+async def achat(cont, timeout=None, context=None, usage=None, json_mode=False):
+    try:
+        response = await achat_completion(
+            client_kwargs=CLIENT_KWARGS,
+            timeout=timeout,
+            model=MODEL_NAME,
+            messages=build_messages(cont, context),
+            stream=False,
+            **({"response_format": {"type": "json_object"}} if json_mode else {})
+        )
+        record_usage(usage, response)
+
+        result = response.choices[0].message.content
+
+        return result
+    except Exception as e: # cancellation (asyncio.CancelledError) is not caught and propagates
+        print(f"API Error calling or parsing response: {str(e) or e.__class__.__name__}")
+        return None
+
+# Constrained yes/no (or multiple-choice) call: returns one of choices, default if the answer names none,
+# or None if the call failed
+async def adecide(cont, choices=("Yes", "No"), default=None, timeout=None, context=None, usage=None):
+    try:
+        choice, response = await achoose(
+            build_messages(cont, context),
+            choices=choices,
+            default=default,
+            mode=DECISION_MODE,
+            client_kwargs=CLIENT_KWARGS,
+            timeout=timeout,
+            return_response=True,
+            model=MODEL_NAME
+        )
+        if response is not None:
+            record_usage(usage, response)
+        return choice
+    except Exception as e: # cancellation (asyncio.CancelledError) is not caught and propagates
+        print(f"API Error calling or parsing response: {str(e) or e.__class__.__name__}")
+        return None
+
+# {"participate": bool, "opinions": {target: opinion}} from the answer of a fused call, None if it is not
+# such a JSON object; opinions are kept for the asked targets only
+def parse_fused_opinions(text, targets):
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if match is None:
+        return None
+    try:
+        answer = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(answer, dict) or not isinstance(answer.get("opinions", {}), dict):
+        return None
+    participate = answer.get("participate")
+    if isinstance(participate, str):
+        participate = participate.strip().lower() in ("yes", "true")
+    opinions = {target: str(answer["opinions"][target]) for target in targets if answer.get("opinions", {}).get(target)}
+    return {"participate": bool(participate) and bool(opinions), "opinions": opinions}
+
+# Top-level diseases of an evidence tree in the order given ("├── Disease" / "└── Disease" lines at the root),
+# normalized for comparison across doctors
+def ranked_diseases(tree):
+    diseases = []
+    for line in (tree or "").splitlines():
+        match = re.match(r"^[├└]──\s*(.+)$", line)
+        if match is None:
+            continue
+        name = re.sub(r"^(disease|疾病)\s*\d+\s*[:：.\-]\s*", "", match.group(1).strip(), flags=re.IGNORECASE)
+        name = re.sub(r"\s+", " ", name).strip(" *:：.").lower()
+        if name and name not in ("...", "…"):
+            diseases.append(name)
+    return diseases
+
+# Share of doctors whose tree leads with the most common leading disease (0 unless every tree names one)
+def consensus(opinions):
+    leading = [ranked_diseases(opinion)[:1] for opinion in opinions.values()]
+    if len(leading) < 2 or not all(leading):
+        return 0.0
+    leading = [diseases[0] for diseases in leading]
+    return max(leading.count(disease) for disease in set(leading)) / len(leading)
+
 class MedicalTeam:
-    def __init__(self, patient_case):
+    def __init__(self, patient_case, max_concurrency=MAX_CONCURRENCY, discussion_mode=DISCUSSION_MODE, update_with_case=UPDATE_WITH_CASE):
+        if discussion_mode not in ("separate", "fused"):
+            raise ValueError("discussion mode must be separate or fused, got {:s}".format(str(discussion_mode)))
         self.patient_case = patient_case
+        self.max_concurrency = max_concurrency
+        self.discussion_mode = discussion_mode
+        self.update_with_case = update_with_case
         self.doctors = {
             "chief_complaint": ChiefComplaintDoctor(),
             "lab": LabDoctor(),
@@ -80,10 +234,24 @@ class MedicalTeam:
         
         self.interaction_log = {}
         self.round_opinions = {}
+        self.stopped_round = None
         self.options = patient_case[1].get("options", "No specific options available")
+        # leading block of every discussion call of this case, kept byte-identical for provider prefix caching
+        self.case_context = f"""Patient case:
+{json.dumps(patient_case[0], ensure_ascii=False, indent=2)}
+"""
+        self.token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
 
-    # Obtain initial diagnoses from various doctors 
+    # Obtain initial diagnoses from various doctors (the sync wrappers run an event loop of their own per call;
+    # inside a case, use the async methods on the case's loop, see aprocess_case)
     def get_initial_diagnoses(self, original_filename):
+        return run_async(self.aget_initial_diagnoses(original_filename))
+
+    async def aget_initial_diagnoses(self, original_filename):
+        '''
+        The specialists run concurrently, each retrieving in a worker thread while the others generate.
+        A failing specialist is retried on its own; if it still fails the case fails once the others are done
+        '''
         print("Obtaining initial diagnosis~")
         base_filename = os.path.basename(original_filename)
         filename = f"step2_{base_filename}"
@@ -94,35 +262,27 @@ class MedicalTeam:
             with open(filepath, 'r', encoding='utf-8') as f:
                 return json.load(f)
         
+        specialists = [
+            ("chief_complaint", "patient_info", self.doctors["chief_complaint"].aexamine_patient),
+            ("lab", "lab_results", self.doctors["lab"].aanalyze_results),
+            ("imaging", "imaging_results", self.doctors["imaging"].aanalyze_images),
+            ("pathology", "pathology_results", self.doctors["pathology"].aanalyze_pathology),
+        ]
+        specialists = [(doctor, method, self.patient_case[0][field]) for doctor, field, method in specialists if self.patient_case[0][field]]
+        answers = await asyncio.gather(
+            *[self._aconsult(doctor, method, data) for doctor, method, data in specialists],
+            return_exceptions=True
+        )
+        for answer in answers:
+            if isinstance(answer, BaseException):
+                raise answer
+        
+        # fixed specialist order, whichever finished first
         diagnoses = {}
         retrieved_info = {}
-        if self.patient_case[0]["patient_info"]:
-            ans = self.doctors["chief_complaint"].examine_patient(
-                self.patient_case[0]["patient_info"]
-            )
-            diagnoses["chief_complaint"] = ans["response"]
-            retrieved_info["chief_complaint"] = ans["retrieved_info"]
-            
-        if self.patient_case[0]["lab_results"]:
-            ans = self.doctors["lab"].analyze_results(
-                self.patient_case[0]["lab_results"]
-            )
-            diagnoses["lab"] = ans["response"]
-            retrieved_info["lab"] = ans["retrieved_info"]
-                
-        if self.patient_case[0]["imaging_results"]:
-            ans = self.doctors["imaging"].analyze_images(
-                self.patient_case[0]["imaging_results"]
-            )
-            diagnoses["imaging"] = ans["response"]
-            retrieved_info["imaging"] = ans["retrieved_info"]
-            
-        if self.patient_case[0]["pathology_results"]:
-            ans = self.doctors["pathology"].analyze_pathology(
-                self.patient_case[0]["pathology_results"]
-            )
-            diagnoses["pathology"] = ans["response"]
-            retrieved_info["pathology"] = ans["retrieved_info"]
+        for (doctor, _, _), ans in zip(specialists, answers):
+            diagnoses[doctor] = ans["response"]
+            retrieved_info[doctor] = ans["retrieved_info"]
             
         os.makedirs(result_dir, exist_ok=True) 
         with open(filepath, 'w', encoding='utf-8') as f:
@@ -137,12 +297,41 @@ class MedicalTeam:
         print(diagnoses)
         return diagnoses
 
+    # Run one specialist, retrying it alone on failure
+    async def _aconsult(self, doctor, method, data):
+        retries = 0
+        while True:
+            try:
+                with call_context(phase="initial_diagnosis", doctor=doctor):
+                    return await method(data)
+            except Exception as e:
+                retries += 1
+                if retries == MAX_RETRIES:
+                    print(f"{doctor} doctor failed after {retries} attempts: {str(e)}")
+                    raise
+                print(f"{doctor} doctor failed ({str(e)}), retrying ({retries}/{MAX_RETRIES})...")
+                await asyncio.sleep(2 ** retries)
+
     # Conduct multiple rounds of discussion
-    def conduct_discussion(self, case_file, num_rounds=1, num_turns=1):
+    def conduct_discussion(self, case_file, num_rounds=1, num_turns=1, consensus_threshold=CONSENSUS_THRESHOLD):
+        return run_async(self.aconduct_discussion(case_file, num_rounds, num_turns, consensus_threshold))
+
+    async def aconduct_discussion(self, case_file, num_rounds=1, num_turns=1, consensus_threshold=CONSENSUS_THRESHOLD):
+        '''
+        Within a turn the doctors do not depend on each other, so every step is issued at once: all participation
+        checks, then all opinions of the participants, then (after the turns) all updated diagnoses.
+        Targets are drawn and results are logged in doctor order, so interaction_log is the same as a serial run.
+        The discussion ends early once the share of doctors leading with the same disease (see consensus) reaches
+        consensus_threshold, checked on the initial diagnoses and after every round; stopped_round is the last
+        round held (0: none)
+        '''
         print("\n=== Start doctor team discussion ===")
         
-        initial_diagnoses = self.get_initial_diagnoses(case_file)
+        initial_diagnoses = await self.aget_initial_diagnoses(case_file)
         active_doctors = {k: v for k, v in initial_diagnoses.items() if v is not None}
+        doctor_order = list(active_doctors.keys())
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.journal = StepJournal(os.path.join("result", f"journal_{os.path.splitext(os.path.basename(case_file))[0]}.jsonl"))
         
         self.interaction_log = {
             f'Round {round_num}': {
@@ -157,6 +346,10 @@ class MedicalTeam:
         self.round_opinions = {round_num: {} for round_num in range(1, num_rounds + 1)}
         self.round_opinions[1] = initial_diagnoses
         
+        self.stopped_round = num_rounds
+        if self._reached_consensus(active_doctors, consensus_threshold):
+            num_rounds = self.stopped_round = 0
+        
         # Conduct multiple rounds of discussion
         for round_num in range(1, num_rounds + 1):
             print(f"\n== Round {round_num} Discussion ==")
@@ -164,65 +357,128 @@ class MedicalTeam:
             for turn_num in range(1, num_turns + 1):
                 print(f"\n- Round {turn_num} -")
                 
-                for source_doctor, source_opinion in active_doctors.items():
-                    source_emoji = self.agent_emoji[list(active_doctors.keys()).index(source_doctor)]
-                    
-                    discussion_prompt = self._generate_discussion_prompt(
-                        round_num, turn_num, source_doctor, active_doctors
-                    )
-                    
-                    participate = self._should_participate(source_doctor, discussion_prompt)
-                    
+                prompts = {
+                    source_doctor: self._generate_discussion_prompt(round_num, turn_num, source_doctor, active_doctors)
+                    for source_doctor in doctor_order
+                }
+                if self.discussion_mode == "fused":
+                    participates, pairs, opinions = await self._afused_turn(round_num, turn_num, doctor_order, prompts, active_doctors)
+                else:
+                    with call_context(round=round_num, turn=turn_num):
+                        participates = await asyncio.gather(*[
+                            self._astep(f"participation/{round_num}/{turn_num}/{source_doctor}",
+                                        partial(self._ashould_participate, source_doctor, prompts[source_doctor]))
+                            for source_doctor in doctor_order
+                        ])
+                
+                    # targets are drawn sequentially so the random stream is consumed as in a serial run,
+                    # and journaled so a resumed case asks the same doctors
+                    pairs = []
+                    for source_doctor, participate in zip(doctor_order, participates):
+                        if participate:
+                            step = f"targets/{round_num}/{turn_num}/{source_doctor}"
+                            if step not in self.journal:
+                                self.journal.record(step, self._choose_discussion_targets(source_doctor, active_doctors.keys()))
+                            for target_doctor in self.journal[step]:
+                                pairs.append((source_doctor, target_doctor))
+                
+                    with call_context(round=round_num, turn=turn_num):
+                        opinions = await asyncio.gather(*[
+                            self._astep(f"opinion/{round_num}/{turn_num}/{source_doctor}/{target_doctor}",
+                                        partial(self._agenerate_opinion, source_doctor, target_doctor, prompts[source_doctor]))
+                            for source_doctor, target_doctor in pairs
+                        ])
+                
+                for (source_doctor, target_doctor), opinion in zip(pairs, opinions):
+                    self.interaction_log[f'Round {round_num}'][f'Turn {turn_num}'][source_doctor][target_doctor] = opinion
+                
+                for source_doctor, participate in zip(doctor_order, participates):
+                    source_emoji = self.agent_emoji[doctor_order.index(source_doctor)]
                     if participate:
-                        target_doctors = self._choose_discussion_targets(
-                            source_doctor, active_doctors.keys()
-                        )
-                        
-                        for target_doctor in target_doctors:
-                            target_emoji = self.agent_emoji[list(active_doctors.keys()).index(target_doctor)]
-                            
-                            opinion = self._generate_opinion(
-                                source_doctor, target_doctor, discussion_prompt
-                            )
-                            
-                            self.interaction_log[f'Round {round_num}'][f'Turn {turn_num}'][source_doctor][target_doctor] = opinion
-                            
-                            print(f" {source_emoji} {source_doctor} -> {target_emoji} {target_doctor}: {opinion}")
+                        for (pair_source, target_doctor), opinion in zip(pairs, opinions):
+                            if pair_source == source_doctor:
+                                target_emoji = self.agent_emoji[doctor_order.index(target_doctor)]
+                                print(f" {source_emoji} {source_doctor} -> {target_emoji} {target_doctor}: {opinion}")
                     else:
                         print(f" {source_emoji} {source_doctor}: \U0001f910 (Not participate in the discussion this round.)")
             
-            updated_opinions = self._collect_updated_opinions(round_num, active_doctors)
+            with call_context(round=round_num):
+                updated_opinions = await self._acollect_updated_opinions(round_num, active_doctors)
             self.round_opinions[round_num + 1] = updated_opinions
+            if round_num < num_rounds and self._reached_consensus(updated_opinions, consensus_threshold):
+                self.stopped_round = round_num
+                break
+        
+        # drop the rounds that were not held, so the final decision reads the last opinions
+        self.round_opinions = {k: v for k, v in self.round_opinions.items() if k <= self.stopped_round + 1}
+        self.interaction_log = {k: v for k, v in self.interaction_log.items() if int(k.split()[-1]) <= self.stopped_round}
             
-        return self._make_final_decision()
+        if "final_decision" not in self.journal:
+            final_decision = await self._amake_final_decision()
+            if final_decision is not None:
+                self.journal.record("final_decision", final_decision)
+        else:
+            final_decision = self.journal["final_decision"]
+        prompt_tokens = self.token_usage["prompt_tokens"]
+        print(f"Prompt cache: {self.token_usage['cached_tokens']}/{prompt_tokens} prompt tokens served from the provider cache"
+              + (f" ({100 * self.token_usage['cached_tokens'] / prompt_tokens:.1f}%)" if prompt_tokens else ""))
+        return final_decision
 
-    # Generate discussion prompts
+    def _reached_consensus(self, opinions, consensus_threshold):
+        if consensus_threshold is None:
+            return False
+        agreement = consensus(opinions)
+        if agreement < consensus_threshold:
+            return False
+        print(f"Consensus reached ({agreement:.0%} of the doctors lead with the same disease), ending the discussion")
+        return True
+
+    # Run one LLM step unless the journal already holds its result; failed steps (None) are not journaled
+    async def _astep(self, step, compute):
+        if step in self.journal:
+            return self.journal[step]
+        value = await compute()
+        if value is not None:
+            self.journal.record(step, value)
+        return value
+
+    # Bounded LLM call shared by all discussion steps, tagged with its call site (phase, doctor, ...) for llm_metrics;
+    # with_case=False sends cont alone, without the case_context
+    async def _achat(self, cont, json_mode=False, with_case=True, **site):
+        with call_context(**site):
+            async with self._semaphore:
+                return await achat(cont, context=self.case_context if with_case else None, usage=self.token_usage, json_mode=json_mode)
+
+    # Generate discussion prompts (the patient case itself is sent as the shared case_context)
     def _generate_discussion_prompt(self, round_num, turn_num, source_doctor, active_doctors):
-        prompt = f"""
-1. Patient case:
-{json.dumps(self.patient_case[0], ensure_ascii=False, indent=2)}
-
-2. Current round: Round {round_num}, Turn {turn_num}
-
-3. Diagnosis opinions from each doctor:
+        prompt = """Diagnosis opinions from each doctor:
 """
         for doctor, opinion in self.round_opinions[round_num].items():
             prompt += f"\n{doctor}: {opinion}"
+
+        prompt += f"\n\nCurrent round: Round {round_num}, Turn {turn_num}"
                 
         return prompt    
 
+    # Opening block of the participation, opinion and fused prompts: byte-identical across them (and across the
+    # doctors of a turn), so the provider's prompt cache serves it and only the instructions after it differ
+    def _situation_block(self, prompt):
+        return f"""Current situation:
+{prompt}
+
+"""
+
     # Deciding whether to participate in the discussion
-    def _should_participate(self, doctor_type, prompt):
-        participation_prompt = f"""
-Based on the current discussion situation, actively identify areas where your perspective differs from others'. Consider if providing your unique viewpoint could help resolve disagreements or improve the diagnosis. You should participate whenever there's an opportunity to clarify your position or persuade others, even if some opinions have already been expressed.
+    async def _ashould_participate(self, doctor_type, prompt):
+        participation_prompt = self._situation_block(prompt) + """Based on the current discussion situation, actively identify areas where your perspective differs from others'. Consider if providing your unique viewpoint could help resolve disagreements or improve the diagnosis. You should participate whenever there's an opportunity to clarify your position or persuade others, even if some opinions have already been expressed.
 Do you need to provide new insights or engage in discussion with other doctors?
 Please answer only with "Yes" or "No".
-
-Current situation:
-{prompt}
 """
-        response = chat(participation_prompt)
-        return "Yes" in response
+        with call_context(phase="participation", doctor=doctor_type):
+            async with self._semaphore:
+                choice = await adecide(participation_prompt, ("Yes", "No"), default="No", context=self.case_context, usage=self.token_usage)
+        # a failed call (None) is not journaled and counts as not participating in this turn
+        return None if choice is None else choice == "Yes"
 
     # Choose which doctors to discuss with
     def _choose_discussion_targets(self, source_doctor, available_doctors):
@@ -234,25 +490,81 @@ Current situation:
         return targets
 
     # Generate opinions for specific target doctors
-    def _generate_opinion(self, source_doctor, target_doctor, prompt):
+    async def _agenerate_opinion(self, source_doctor, target_doctor, prompt):
         
-        opinion_prompt = f"""As the {source_doctor} doctor, please provide your professional opinion on the diagnosis from the {target_doctor} doctor:
-
-{prompt}
+        opinion_prompt = self._situation_block(prompt) + f"""As the {source_doctor} doctor, please provide your professional opinion on the diagnosis from the {target_doctor} doctor.
 
 Please concisely express your views, focusing on:
 1. Which aspects of the other doctor's opinion you agree or disagree with
 2. What additional insights or suggestions you have based on your expertise
 3. How to integrate both professional perspectives to improve the diagnosis
 """
-        return chat(opinion_prompt)
+        return await self._achat(opinion_prompt, phase="opinion", doctor=source_doctor, target=target_doctor)
+
+    # One turn in fused mode: targets are drawn (and journaled) for every doctor up front, then each doctor with
+    # targets is asked once for its participation and all its opinions. Returns what the separate steps return
+    async def _afused_turn(self, round_num, turn_num, doctor_order, prompts, active_doctors):
+        targets = {}
+        for source_doctor in doctor_order:
+            step = f"targets/{round_num}/{turn_num}/{source_doctor}"
+            if step not in self.journal:
+                self.journal.record(step, self._choose_discussion_targets(source_doctor, active_doctors.keys()))
+            targets[source_doctor] = self.journal[step]
+        
+        async def no_targets():
+            return {"participate": False, "opinions": {}}
+        with call_context(round=round_num, turn=turn_num):
+            answers = await asyncio.gather(*[
+                self._astep(f"fused/{round_num}/{turn_num}/{source_doctor}",
+                            partial(self._afused_opinions, source_doctor, targets[source_doctor], prompts[source_doctor])
+                            if targets[source_doctor] else no_targets)
+                for source_doctor in doctor_order
+            ])
+        
+        # a failed or unparsable answer (None) counts as not participating in this turn
+        participates = [answer is not None and answer["participate"] for answer in answers]
+        pairs, opinions = [], []
+        for source_doctor, answer, participate in zip(doctor_order, answers, participates):
+            if participate:
+                for target_doctor in targets[source_doctor]:
+                    if target_doctor in answer["opinions"]:
+                        pairs.append((source_doctor, target_doctor))
+                        opinions.append(answer["opinions"][target_doctor])
+        return participates, pairs, opinions
+
+    # Participation decision and opinions on all targets in one JSON answer
+    async def _afused_opinions(self, source_doctor, targets, prompt):
+        fused_prompt = self._situation_block(prompt) + f"""As the {source_doctor} doctor, actively identify areas where your perspective differs from the diagnoses of these doctors: {", ".join(targets)}. Consider if providing your unique viewpoint could help resolve disagreements or improve the diagnosis. You should participate whenever there's an opportunity to clarify your position or persuade others, even if some opinions have already been expressed.
+
+If you participate, provide your professional opinion on the diagnosis of each of these doctors, concisely focusing on:
+1. Which aspects of the other doctor's opinion you agree or disagree with
+2. What additional insights or suggestions you have based on your expertise
+3. How to integrate both professional perspectives to improve the diagnosis
+
+Answer only with a JSON object of the form {{"participate": true or false, "opinions": {{"<doctor>": "<your opinion>"}}}}, with one opinion for each of {", ".join(targets)} if you participate and no opinions otherwise.
+"""
+        answer = await self._achat(fused_prompt, json_mode=True, phase="fused_opinion", doctor=source_doctor)
+        return None if answer is None else parse_fused_opinions(answer, targets)
 
     # Collect and update the viewpoints after this round of discussion
-    def _collect_updated_opinions(self, round_num, active_doctors):
-        updated_opinions = {}
+    async def _acollect_updated_opinions(self, round_num, active_doctors):
+        update_prompts = {}
         
         for doctor_type in active_doctors.keys():
-            update_prompt = f"""As the {doctor_type} doctor, please generate an UPDATED diagnostic tree based on original assessment and new feedback. 
+            update_prompt = f"""1. Original diagnosis of the {doctor_type} doctor:
+{self.round_opinions[1][doctor_type]}
+
+2. Feedback received in this round:
+"""
+
+            for turn in self.interaction_log[f'Round {round_num}'].values():
+                for source, targets in turn.items():
+                    if targets[doctor_type]:
+                        update_prompt += f"\n{source}: {targets[doctor_type]}"
+
+            update_prompt += f"""
+
+As the {doctor_type} doctor, please generate an UPDATED diagnostic tree based on original assessment and new feedback. 
 
 Output Format:       
 {doctor_type} Doctor Reasoning Pathway
@@ -268,39 +580,29 @@ Output Format:
 │       └── Evidence 3: ...
 └── ...
 Please ensure that the output strictly follows the above format and only includes the evidence tree structure. Avoid any additional text or explanations outside the tree structure.
-
-1. Original diagnosis:
-{self.round_opinions[1][doctor_type]}
-
-2. Feedback received in this round:
 """
-
-            for turn in self.interaction_log[f'Round {round_num}'].values():
-                for source, targets in turn.items():
-                    if targets[doctor_type]:
-                        update_prompt += f"\n{source}: {targets[doctor_type]}"
                         
-            updated_opinion = chat(update_prompt)
-            updated_opinions[doctor_type] = updated_opinion
+            update_prompts[doctor_type] = update_prompt
             
-        return updated_opinions
+        updated_opinions = await asyncio.gather(*[
+            self._astep(f"update/{round_num}/{doctor_type}", partial(self._achat, update_prompt, with_case=self.update_with_case, phase="update", doctor=doctor_type))
+            for doctor_type, update_prompt in update_prompts.items()
+        ])
+        return dict(zip(update_prompts.keys(), updated_opinions))
 
     # Make the final decision
-    def _make_final_decision(self):
-        final_prompt = f"""As the head of the medical team, please make the final diagnosis based on the following information:
-
-1. Patient case:
-{json.dumps(self.patient_case[0], ensure_ascii=False, indent=2)}
-
-2. Diagnosis opinions from the last round:
+    async def _amake_final_decision(self):
+        final_prompt = """1. Diagnosis opinions from the last round:
 """
         last_round_opinions = self.round_opinions[max(self.round_opinions.keys())]
         for doctor, opinion in last_round_opinions.items():
             final_prompt += f"{doctor}: {opinion}\n"
             
-        final_prompt += f"\n3. Diagnosis options:\n{self.options}"
+        final_prompt += f"\n2. Diagnosis options:\n{self.options}"
 
         final_prompt += """
+
+As the head of the medical team, please make the final diagnosis based on the patient case and the information above.
 The output should include:
 1. The final diagnosis result (please select the appropriate letter from the options)
 2. The evidence tree structure, formatted as follows:
@@ -323,8 +625,7 @@ The result should be output in JSON format, strictly following the format below.
 }
 """
         
-        final_decision = chat(final_prompt)
-        return final_decision
+        return await self._achat(final_prompt, phase="final_decision")
 
     # Visualize the interaction between doctors
     def visualize_interactions(self):
@@ -361,7 +662,11 @@ The result should be output in JSON format, strictly following the format below.
         print("\n=== Interaction among doctor teams ===")
         print(table)
 
+# One event loop per case: its pooled async clients serve every call of the case and are closed when it ends
 def process_case(case_file):
+    return run_async(aprocess_case(case_file))
+
+async def aprocess_case(case_file):
     print("Reading case files~")
     with open(case_file, 'r', encoding='utf-8') as f:
         case_data = json.load(f)
@@ -404,7 +709,8 @@ def process_case(case_file):
         print("Creating medical team and discussing~")
 
         team = MedicalTeam(processed_case)
-        final_decision = team.conduct_discussion(case_file)
+        with call_context(case=base_filename):
+            final_decision = await team.aconduct_discussion(case_file)
     except Exception as e:
         print(f"An uncaught exception occurred during case handling: {str(e)}")
         raise 
@@ -415,7 +721,9 @@ def process_case(case_file):
         "timestamp": datetime.datetime.now().isoformat(),
         "case_info": processed_case,
         "discussion_process": {
-            "round_opinions": team.round_opinions
+            "round_opinions": team.round_opinions,
+            "stopped_round": team.stopped_round,
+            "token_usage": team.token_usage
         },
         "final_decision": final_decision
     }
@@ -424,26 +732,34 @@ def process_case(case_file):
     with open(filepath, 'w', encoding='utf-8') as f:
         json.dump(result, f, ensure_ascii=False, indent=2)
     
+    # the step3_ result supersedes the journal of the discussion
+    team.journal.remove()
+
     print(f"\nThe result has been saved to: {filename}")
     return result
 
 
 
 if __name__ == "__main__":  
-    client = OpenAI(api_key="YOUR_API_KEY", base_url="https://api.deepseek.com")
-
     with open(ERROR_LOG, "w", encoding="utf-8") as f:
         f.write("Error Log\n---------\n\n")
 
+    # every LLM call of this run is recorded here and summarized once all cases are done
+    llm_metrics.configure(os.path.join("result", "llm_metrics.jsonl"))
+
     case_dir = "YOUR_INPUT_DATA_PATH"
     case_files = glob.glob(os.path.join(case_dir, "*.json"))
     print("Processing~")
 
-    with Pool(processes=2) as pool:
+    # the workers split LLM_RPM / LLM_TPM between them, so the run as a whole stays within them
+    n_workers = 2
+    with Pool(processes=n_workers, initializer=share_limits, initargs=(n_workers,)) as pool:
         results = []
         for i, result in enumerate(pool.imap_unordered(safe_process_case, case_files)):
             if result is not None:
                 results.append(result)
             print(f"Completed {i+1}/{len(case_files)} files")
 
+    llm_metrics.print_summary()
+
     print(f"Processing completed, see error log: {ERROR_LOG}")
\ No newline at end of file
@@ -0,0 +1,119 @@
+import os
+import json
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # not on Windows: appends are then not locked across processes
+    fcntl = None
+
+
+class EventLog:
+    '''
+    Append-only JSONL log of events {"event": kind, **fields}. Each append writes one line, so logging a step costs
+    the size of that step however long the log is, and read() replays the events to rebuild the state.
+    A torn last line left by a crashed writer is skipped on read
+    fsync (bool): make every append durable before returning, for logs that resumes rely on
+    '''
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _open_locked(self):
+        # the file at path, opened for appending and locked; if replace() renamed another file over it while we
+        # waited for the lock, the lock is on the old file, so open the new one
+        while True:
+            f = open(self.path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    @contextmanager
+    def locked(self):
+        '''
+        Hold the lock that append takes, for a read-modify-write of the log such as replace()
+        '''
+        with self._open_locked():
+            yield
+
+    def replace(self, events):
+        '''
+        Replace the log with events, (kind, fields) pairs: they are written to a temporary file in the same directory,
+        which is then renamed over the log, so readers see the old log or the new one and never a partial one.
+        Call it inside locked()
+        '''
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            for kind, fields in events:
+                f.write((json.dumps({"event": kind, **fields}, ensure_ascii=False) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def append(self, kind, **fields):
+        line = (json.dumps({"event": kind, **fields}, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._open_locked() as f:
+            # a crashed writer may have left a torn line without its newline: end it first, so this event gets a
+            # line of its own instead of being merged into the torn one (which read() skips)
+            size = f.seek(0, os.SEEK_END)
+            if size > 0:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def read(self, kind=None):
+        '''
+        Events in the order they were appended, only those of kind if given
+        '''
+        events = []
+        if not os.path.exists(self.path):
+            return events
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if kind is None or event.get("event") == kind:
+                    events.append(event)
+        return events
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def clear(self):
+        # start a new log at the same path
+        open(self.path, 'w').close()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def transcript_log_path(save_path):
+    # event log of the messages of an i_medrag_answer transcript while the call runs
+    return save_path + ".jsonl"
+
+def read_messages(path):
+    '''
+    Chat messages of an i_medrag_answer transcript, in order: the JSON list written to its save_path when the call
+    returns, else the messages logged so far to transcript_log_path(save_path), e.g. by a call that crashed.
+    path may also be such an event log itself
+    '''
+    if not os.path.exists(path) and os.path.exists(transcript_log_path(path)):
+        path = transcript_log_path(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        if f.read(1) == "[":
+            f.seek(0)
+            return json.load(f)
+    return [event["message"] for event in EventLog(path).read("message")]
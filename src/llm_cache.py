@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import atexit
+import threading
+
+from utils import parse_size
+
+# LLM_CACHE: "on" (read and write), "refresh" (write only, to re-pay calls on purpose) or "off" (bypass, the default,
+# so a run does not replay the completions of earlier runs unless asked to)
+LLM_CACHE = os.getenv("LLM_CACHE", "off").lower()
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".", "llm_cache", "responses.sqlite"))
+LLM_CACHE_SIZE = os.getenv("LLM_CACHE_SIZE", "2G")
+
+# access times of cache hits are written in batches of this many (and before every put), so a hit takes no write lock
+ACCESS_BATCH = 64
+# parameters that change how a request is sent, not what is generated
+UNKEYED_PARAMS = {"timeout", "stream", "extra_headers", "user"}
+
+
+class ResponseCache:
+    '''
+    Disk-backed LLM response cache, content-addressed by a hash of (model, messages, generation params)
+    and bounded to max_size bytes of stored responses by evicting the least-recently-used ones.
+    Backed by sqlite in WAL mode so multiprocessing.Pool workers can share one file; triggers keep the total size in
+    the meta table, so a put does not sum the whole table. Hits only read: their access times are kept in memory
+    and written ACCESS_BATCH at a time, before a put evicts, and at exit
+    '''
+
+    def __init__(self, path=LLM_CACHE_PATH, max_size=LLM_CACHE_SIZE, mode=LLM_CACHE):
+        if mode not in ("on", "refresh", "off"):
+            raise ValueError("LLM cache mode must be one of on / refresh / off, got {:s}".format(str(mode)))
+        self.path = path
+        self.max_size = parse_size(max_size)
+        self.mode = mode
+        self.local = threading.local()
+        self.accessed = {} # key -> time of the hits whose access time is not written yet
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN "
+                         "UPDATE meta SET value = value + NEW.size WHERE key = 'size'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN "
+                         "UPDATE meta SET value = value + NEW.size - OLD.size WHERE key = 'size'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN "
+                         "UPDATE meta SET value = value - OLD.size WHERE key = 'size'; END")
+            # a cache written before the meta table is summed once, after the triggers exist so no write is missed
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'size', COALESCE(SUM(size), 0) FROM responses")
+
+    def connect(self):
+        # one connection per thread, reopened in forked children
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def key(model, messages, params=None):
+        '''
+        Hash of the request, or None if the params cannot be serialized (such requests are not cached)
+        '''
+        params = {k: v for k, v in (params or {}).items() if k not in UNKEYED_PARAMS}
+        try:
+            payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        except TypeError:
+            return None
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key is None or self.mode != "on":
+            return None
+        row = self.connect().execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        with self.lock:
+            self.accessed[key] = time.time()
+            full = len(self.accessed) >= ACCESS_BATCH
+        if full:
+            self.flush()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def flush(self):
+        '''
+        Write the pending access times of cache hits
+        '''
+        with self.connect() as conn:
+            self._write_accessed(conn)
+
+    def _write_accessed(self, conn):
+        with self.lock:
+            accessed, self.accessed = self.accessed, {}
+        conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(t, key) for key, t in accessed.items()])
+
+    def put(self, key, model, response):
+        if key is None or self.mode == "off":
+            return
+        response = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            # eviction must see the recent hits
+            self._write_accessed(conn)
+            # an upsert rather than INSERT OR REPLACE, whose implicit delete does not fire the delete trigger
+            conn.execute(
+                "INSERT INTO responses (key, model, response, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET model = excluded.model, response = excluded.response, "
+                "size = excluded.size, created = excluded.created, accessed = excluded.accessed",
+                (key, model, response, len(response), now, now)
+            )
+            self.evict(conn)
+
+    def evict(self, conn):
+        if self.max_size is None:
+            return
+        total = conn.execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+        if total <= self.max_size:
+            return
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total <= self.max_size:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        count, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"mode": self.mode, "entries": count, "size": size, "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    '''
+    Process-wide ResponseCache, or None when LLM_CACHE is "off"
+    '''
+    global _response_cache
+    if LLM_CACHE == "off":
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+            atexit.register(_response_cache.flush)
+    return _response_cache
+
+def set_cache_mode(mode):
+    '''
+    Switch the process-wide cache between "on", "refresh" and "off" (e.g. from a command line flag)
+    '''
+    global LLM_CACHE
+    if mode not in ("on", "refresh", "off"):
+        raise ValueError("LLM cache mode must be one of on / refresh / off, got {:s}".format(str(mode)))
+    LLM_CACHE = mode
+    if _response_cache is not None:
+        _response_cache.mode = mode
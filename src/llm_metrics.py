@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# LLM_METRICS_PATH: JSONL file that every LLM call is appended to (unset: calls are not recorded)
+LLM_METRICS_PATH = os.getenv("LLM_METRICS_PATH")
+# calls of one run share a run id, inherited by multiprocessing workers through the environment
+RUN_ID = os.getenv("LLM_METRICS_RUN") or uuid.uuid4().hex[:12]
+
+# where a call is made from: case, phase, doctor, target, round, turn
+_call_site = contextvars.ContextVar("llm_call_site", default={})
+# HTTP attempts of the call in progress, counted by the client's request hook
+_attempts = contextvars.ContextVar("llm_attempts", default=None)
+_write_lock = threading.Lock()
+
+
+def configure(path, run_id=None):
+    '''
+    Record calls to path from now on; run_id (default: a new one) is exported for worker processes
+    '''
+    global LLM_METRICS_PATH, RUN_ID
+    LLM_METRICS_PATH = path
+    RUN_ID = run_id or uuid.uuid4().hex[:12]
+    os.environ["LLM_METRICS_PATH"] = path
+    os.environ["LLM_METRICS_RUN"] = RUN_ID
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return RUN_ID
+
+@contextmanager
+def call_context(**site):
+    '''
+    Tag the LLM calls made inside the block (and in tasks / threads started from it) with site fields
+    '''
+    token = _call_site.set({**_call_site.get(), **site})
+    try:
+        yield
+    finally:
+        _call_site.reset(token)
+
+def count_cached_tokens(usage):
+    '''
+    Prompt tokens a provider served from its context cache: DeepSeek reports prompt_cache_hit_tokens,
+    OpenAI prompt_tokens_details.cached_tokens
+    '''
+    if usage is None:
+        return 0
+    cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached is None:
+        cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    return cached or 0
+
+def count_attempt(request):
+    # httpx request hook of the shared clients: one call per HTTP attempt, so retries = attempts - 1
+    attempts = _attempts.get()
+    if attempts is not None:
+        attempts[0] += 1
+
+async def acount_attempt(request):
+    count_attempt(request)
+
+
+class CallRecord:
+    '''
+    Metrics of one LLM call, filled in by the caller and written when the track() block exits
+    '''
+
+    def __init__(self, model, **fields):
+        self.fields = {"run": RUN_ID, "pid": os.getpid(), **_call_site.get(), "model": model, **fields}
+        self.start = time.time()
+        self.first_token = None
+        self.usage = None
+
+    def mark_first_token(self):
+        if self.first_token is None:
+            self.first_token = time.time()
+
+    def set_usage(self, usage):
+        self.usage = usage
+
+    def to_dict(self, attempts, error=None):
+        end = time.time()
+        record = dict(self.fields)
+        record.update({
+            "start": self.start,
+            "wall_time": end - self.start,
+            "ttft": (self.first_token or end) - self.start,
+            "prompt_tokens": getattr(self.usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(self.usage, "completion_tokens", 0) or 0,
+            "cached_tokens": count_cached_tokens(self.usage),
+            "retries": max(attempts - 1, 0),
+            "error": error,
+        })
+        return record
+
+@contextmanager
+def track(model, **fields):
+    '''
+    Time one LLM call and append its record to LLM_METRICS_PATH. Without streaming the whole answer arrives at once,
+    so time-to-first-token equals the wall time unless the caller marks the first token
+    '''
+    record = CallRecord(model, **fields)
+    attempts = [0]
+    token = _attempts.set(attempts)
+    try:
+        yield record
+    except BaseException as e:
+        write(record.to_dict(attempts[0], error=e.__class__.__name__))
+        raise
+    else:
+        write(record.to_dict(attempts[0]))
+    finally:
+        _attempts.reset(token)
+
+def record_cache_hit(model):
+    '''
+    Record a call answered from the response cache without timing anything
+    '''
+    with track(model, response_cache_hit=True):
+        pass
+
+def write(record):
+    if LLM_METRICS_PATH is None:
+        return
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    # one O_APPEND write per record, so lines from Pool workers do not interleave
+    with _write_lock:
+        fd = os.open(LLM_METRICS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+
+def load(path=None, run_id=None):
+    path = path or LLM_METRICS_PATH
+    records = []
+    if path is None or not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if run_id is None or record.get("run") == run_id:
+                    records.append(record)
+    return records
+
+def aggregate(records, by):
+    '''
+    Totals of records grouped by the call-site field by (e.g. "phase" or "case")
+    '''
+    groups = {}
+    for record in records:
+        group = groups.setdefault(str(record.get(by, "-")), {
+            "calls": 0, "cache_hits": 0, "errors": 0, "retries": 0, "wall_time": 0.0, "max_wall_time": 0.0, "ttft": 0.0,
+            "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+        })
+        group["calls"] += 1
+        group["cache_hits"] += bool(record.get("response_cache_hit"))
+        group["errors"] += record["error"] is not None
+        group["retries"] += record["retries"]
+        group["wall_time"] += record["wall_time"]
+        group["max_wall_time"] = max(group["max_wall_time"], record["wall_time"])
+        group["ttft"] += record["ttft"]
+        for key in ["prompt_tokens", "cached_tokens", "completion_tokens"]:
+            group[key] += record[key]
+    for group in groups.values():
+        group["mean_wall_time"] = group["wall_time"] / group["calls"]
+        group["mean_ttft"] = group["ttft"] / group["calls"]
+    return groups
+
+def summarize(path=None, run_id=None, save_path=None):
+    '''
+    Per-phase, per-case and whole-run totals of a run (default: the current one), also written to save_path
+    (default: <metrics file>.summary.json)
+    '''
+    path = path or LLM_METRICS_PATH
+    run_id = run_id or RUN_ID
+    records = load(path, run_id)
+    summary = {
+        "run": run_id,
+        "phases": aggregate(records, "phase"),
+        "cases": aggregate(records, "case"),
+        "total": aggregate(records, "run").get(run_id, {}),
+    }
+    save_path = save_path or (os.path.splitext(path)[0] + ".summary.json" if path else None)
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+def print_summary(path=None, run_id=None):
+    from prettytable import PrettyTable
+    summary = summarize(path, run_id)
+    table = PrettyTable(["phase", "calls", "cache hits", "errors", "retries", "wall time (s)", "mean (s)", "max (s)",
+                         "mean ttft (s)", "prompt tok", "cached tok", "completion tok"])
+    rows = list(summary["phases"].items())
+    if summary["total"]:
+        rows.append(("total", summary["total"]))
+    for phase, group in rows:
+        table.add_row([
+            phase, group["calls"], group["cache_hits"], group["errors"], group["retries"],
+            f"{group['wall_time']:.1f}", f"{group['mean_wall_time']:.2f}", f"{group['max_wall_time']:.2f}",
+            f"{group['mean_ttft']:.2f}", group["prompt_tokens"], group["cached_tokens"], group["completion_tokens"]
+        ])
+    print(f"\n=== LLM calls of run {summary['run']} ({len(summary['cases'])} cases) ===")
+    print(table)
+    return summary
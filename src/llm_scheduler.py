@@ -0,0 +1,291 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from contextlib import contextmanager, asynccontextmanager
+
+import openai
+
+# LLM_SCHEDULER=off leaves retries to the openai client (max_retries) as before
+LLM_SCHEDULER = os.getenv("LLM_SCHEDULER", "on").lower() != "off"
+# requests / tokens per minute of the run, split between worker processes by share_limits (unset: not shaped)
+LLM_RPM = os.getenv("LLM_RPM")
+LLM_TPM = os.getenv("LLM_TPM")
+# attempts per request and backoff bounds (seconds)
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 8))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", 60))
+# completion tokens reserved for a request without max_tokens, refunded once its usage is known
+DEFAULT_COMPLETION_TOKENS = 1024
+
+
+class TokenBucket:
+    '''
+    Refills rate_per_minute units per minute, up to one minute's worth. reserve() books units and returns how long the
+    caller must wait before using them, so waiting callers are served in order and never overdraw the bucket
+    '''
+
+    def __init__(self, rate_per_minute):
+        self.rate = float(rate_per_minute) / 60
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            # a single request larger than the bucket waits for a full bucket instead of forever
+            amount = min(amount, self.capacity)
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount):
+        # negative amounts charge requests that used more than was reserved
+        with self.lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveLimit:
+    '''
+    Concurrency limit adjusted AIMD-style: +1 per limit successful requests, halved on a rate-limit or timeout error
+    (at most once per window, since the requests in flight fail together)
+    '''
+
+    def __init__(self, limit, min_limit=1, max_limit=None, window=1.0):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.window = window
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def try_acquire(self):
+        with self.cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        # shared with threads, so async callers poll instead of waiting on an asyncio primitive
+        delay = 0.01
+        while not self.try_acquire():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def release(self, congested=False):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if congested:
+                if now - self.last_decrease > self.window:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease = now
+                    print(f"LLM rate limited, concurrency lowered to {int(self.limit)}")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+def is_retryable(e):
+    if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code in (408, 409, 429, 502, 503, 504, 529)
+
+def is_congestion(e):
+    # errors that mean the provider is at its limit, as opposed to a transient network failure
+    if isinstance(e, (openai.RateLimitError, openai.APITimeoutError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code in (429, 503, 529)
+
+def retry_after(e):
+    '''
+    Seconds the provider asked to wait (retry-after-ms / retry-after headers), or None
+    '''
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(params):
+    # ~4 characters per token for the prompt plus the completion budget, corrected by refund() afterwards
+    prompt = sum(len(str(message.get("content", ""))) for message in params.get("messages", [])) // 4
+    return prompt + (params.get("max_tokens") or params.get("max_completion_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+class RequestScheduler:
+    '''
+    Client-side scheduling of LLM requests shared by all call sites of a process: requests / tokens per minute
+    are shaped with token buckets, concurrency follows AdaptiveLimit, and failed requests are retried one by one
+    with full-jitter exponential backoff that honors Retry-After
+    '''
+
+    def __init__(self, rpm=LLM_RPM, tpm=LLM_TPM, max_concurrency=None, max_attempts=LLM_MAX_ATTEMPTS,
+                 backoff_base=LLM_BACKOFF_BASE, backoff_cap=LLM_BACKOFF_CAP):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 64))
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.limit = AdaptiveLimit(max_concurrency)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def _reserve(self, tokens=0):
+        # wait before an attempt: every attempt is a request, but the tokens of a request are booked once (tokens=0
+        # on its retries)
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.reserve(tokens))
+        return delay
+
+    def _settle(self, estimate, response=None):
+        # return the booked tokens the request did not use, all of them if it failed (response None)
+        if self.tokens is None:
+            return
+        reserved = min(estimate, self.tokens.capacity)
+        usage = getattr(response, "usage", None)
+        if response is None:
+            self.tokens.refund(reserved)
+        elif usage is not None and usage.total_tokens:
+            self.tokens.refund(reserved - usage.total_tokens)
+
+    def _backoff(self, attempt, e):
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        hint = retry_after(e)
+        if hint is not None:
+            delay = max(delay, hint)
+        return delay
+
+    def run(self, request, params, hold=False):
+        '''
+        Call request() (one chat completion with params) under the scheduler
+        hold: keep the concurrency slot after returning, for the caller to release (see stream)
+        '''
+        estimate = estimate_tokens(params)
+        for attempt in range(self.max_attempts):
+            time.sleep(self._reserve(estimate if attempt == 0 else 0))
+            self.limit.acquire()
+            try:
+                response = request()
+            except BaseException as e:
+                self.limit.release(congested=is_congestion(e))
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    self._settle(estimate)
+                    raise
+                delay = self._backoff(attempt, e)
+                print(f"LLM request failed ({e.__class__.__name__}), retrying in {delay:.1f}s ({attempt + 1}/{self.max_attempts})")
+                time.sleep(delay)
+                continue
+            if not hold:
+                self.limit.release()
+            self._settle(estimate, response)
+            return response
+
+    async def arun(self, request, params, hold=False):
+        '''
+        Async run: request() returns an awaitable
+        '''
+        estimate = estimate_tokens(params)
+        for attempt in range(self.max_attempts):
+            await asyncio.sleep(self._reserve(estimate if attempt == 0 else 0))
+            await self.limit.aacquire()
+            try:
+                response = await request()
+            except BaseException as e: # cancellation included, which is not retried
+                self.limit.release(congested=is_congestion(e))
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    self._settle(estimate)
+                    raise
+                delay = self._backoff(attempt, e)
+                print(f"LLM request failed ({e.__class__.__name__}), retrying in {delay:.1f}s ({attempt + 1}/{self.max_attempts})")
+                await asyncio.sleep(delay)
+                continue
+            if not hold:
+                self.limit.release()
+            self._settle(estimate, response)
+            return response
+
+    @contextmanager
+    def stream(self, request, params):
+        '''
+        run for a streamed request: the concurrency slot is held until the with block is done with the stream
+        '''
+        stream = self.run(request, params, hold=True)
+        try:
+            yield stream
+        finally:
+            self.limit.release()
+
+    @asynccontextmanager
+    async def astream(self, request, params):
+        stream = await self.arun(request, params, hold=True)
+        try:
+            yield stream
+        finally:
+            self.limit.release()
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+# processes the limits are split between (see share_limits)
+_workers = 1
+
+def _reset_scheduler():
+    # a forked worker gets its own buckets and limit
+    global _scheduler, _scheduler_lock
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_scheduler)
+
+def share_limits(workers):
+    '''
+    Split LLM_RPM, LLM_TPM and LLM_MAX_CONCURRENCY evenly between workers processes, so that together they stay
+    within the limits: the buckets and the concurrency limit live in each process. Pass it as the initializer
+    of a pool, e.g. Pool(processes=n, initializer=share_limits, initargs=(n,))
+    '''
+    global _workers, _scheduler
+    with _scheduler_lock:
+        _workers = max(1, int(workers))
+        _scheduler = None
+
+def get_scheduler():
+    '''
+    Process-wide RequestScheduler, or None when LLM_SCHEDULER is off
+    '''
+    global _scheduler
+    if not LLM_SCHEDULER:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 64))
+            _scheduler = RequestScheduler(rpm=float(LLM_RPM) / _workers if LLM_RPM else None,
+                                          tpm=float(LLM_TPM) / _workers if LLM_TPM else None,
+                                          max_concurrency=max(1, max_concurrency // _workers))
+    return _scheduler
@@ -10,9 +10,23 @@ from transformers import AutoTokenizer
 import openai
 from transformers import StoppingCriteria, StoppingCriteriaList
 import tiktoken
+import asyncio
+import weakref
+import types
+import copy
+import hashlib
+import contextlib
+from collections import OrderedDict
+import threading
+import queue
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 sys.path.append("src")
-from utils import RetrievalSystem, DocExtracter
+from utils import RetrievalSystem, DocExtracter, dedup_snippets, select_by_token_budget, parse_size
+from llm_cache import get_response_cache
+import llm_metrics
+from llm_scheduler import get_scheduler
+from event_log import EventLog, transcript_log_path
 from template import *
 
 from config import config
@@ -30,20 +44,749 @@ if openai.__version__.startswith("0"):
 else:
     if openai.api_type == "azure":
         openai.azure_endpoint = openai.azure_endpoint or os.getenv("OPENAI_ENDPOINT") or config.get("azure_endpoint")
-        openai_client = lambda **x: openai.AzureOpenAI(
-            api_version=openai.api_version,
-            azure_endpoint=openai.azure_endpoint,
-            api_key=openai.api_key,
-        ).chat.completions.create(**x).choices[0].message.content
+    openai_client = lambda **x: chat_completion(**x).choices[0].message.content
+
+# connection pool shared by all requests of a process (sizes / timeouts can be overridden per client)
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", 64))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 600))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", 10))
+# requests in flight at once on one event loop (async API)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 64))
+# local models: prompts run through the model together, and how long a single call waits for others to join it
+LOCAL_BATCH_SIZE = int(os.getenv("LOCAL_BATCH_SIZE", 8))
+LOCAL_BATCH_WAIT = float(os.getenv("LOCAL_BATCH_WAIT", 0.01))
+# memory for precomputed past key values of shared prompt prefixes (0 disables the prefix cache)
+LOCAL_PREFIX_CACHE_SIZE = os.getenv("LOCAL_PREFIX_CACHE_SIZE", "1G")
+# retrieval collapses overlapping / near-duplicate snippets by default (see dedup_snippets); MEDRAG_DEDUP=off disables it
+MEDRAG_DEDUP = os.getenv("MEDRAG_DEDUP", "on").lower() == "on"
+# i-MedRAG replies of API models requested as JSON: "json_schema", "json" (JSON mode) or unset (markdown sections);
+# either way replies are parsed locally, see parse_follow_up
+I_MEDRAG_STRUCTURED = os.getenv("I_MEDRAG_STRUCTURED")
+
+_clients = {}
+_clients_lock = threading.Lock()
+# async clients and the concurrency semaphore are bound to the event loop they were created on
+_async_clients = weakref.WeakKeyDictionary()
+_semaphores = weakref.WeakKeyDictionary()
+
+def _reset_clients():
+    '''
+    Forget the parent's clients in a forked child (e.g. multiprocessing.Pool workers): their pooled sockets
+    and TLS sessions belong to the parent, so they are dropped without being closed and rebuilt on demand
+    '''
+    global _clients, _clients_lock, _async_clients, _semaphores
+    _clients = {}
+    _clients_lock = threading.Lock()
+    _async_clients = weakref.WeakKeyDictionary()
+    _semaphores = weakref.WeakKeyDictionary()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients)
+
+def get_openai_client(api_key=None, base_url=None, pool_size=None, timeout=None, connect_timeout=None, max_retries=2):
+    '''
+    Thread-safe OpenAI (or AzureOpenAI, following openai.api_type) client with a keep-alive connection pool,
+    created once per process and endpoint and reused by every call
+    '''
+    import httpx
+    api_key = api_key if api_key is not None else openai.api_key
+    azure = openai.api_type == "azure" and base_url is None
+    key = (os.getpid(), api_key, base_url, azure, pool_size, timeout, connect_timeout, max_retries)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        if key not in _clients:
+            pool_size = pool_size or OPENAI_POOL_SIZE
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(timeout or OPENAI_TIMEOUT, connect=connect_timeout or OPENAI_CONNECT_TIMEOUT),
+                event_hooks={"request": [llm_metrics.count_attempt]},
+            )
+            if azure:
+                _clients[key] = openai.AzureOpenAI(
+                    api_version=openai.api_version,
+                    azure_endpoint=openai.azure_endpoint,
+                    api_key=api_key,
+                    max_retries=max_retries,
+                    http_client=http_client,
+                )
+            else:
+                _clients[key] = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=max_retries,
+                    http_client=http_client,
+                )
+        return _clients[key]
+
+def get_async_openai_client(api_key=None, base_url=None, pool_size=None, timeout=None, connect_timeout=None, max_retries=2):
+    '''
+    Async counterpart of get_openai_client, one per running event loop and endpoint
+    '''
+    import httpx
+    api_key = api_key if api_key is not None else openai.api_key
+    azure = openai.api_type == "azure" and base_url is None
+    key = (api_key, base_url, azure, pool_size, timeout, connect_timeout, max_retries)
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in clients:
+        pool_size = pool_size or OPENAI_POOL_SIZE
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout or OPENAI_TIMEOUT, connect=connect_timeout or OPENAI_CONNECT_TIMEOUT),
+            event_hooks={"request": [llm_metrics.acount_attempt]},
+        )
+        if azure:
+            clients[key] = openai.AsyncAzureOpenAI(
+                api_version=openai.api_version,
+                azure_endpoint=openai.azure_endpoint,
+                api_key=api_key,
+                max_retries=max_retries,
+                http_client=http_client,
+            )
+        else:
+            clients[key] = openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=max_retries,
+                http_client=http_client,
+            )
+    return clients[key]
+
+async def aclose_async_clients():
+    '''
+    Close the async clients created on the running event loop, and their connection pools
+    '''
+    for client in _async_clients.pop(asyncio.get_running_loop(), {}).values():
+        await client.close()
+
+def run_async(coro):
+    '''
+    asyncio.run(coro) for a synchronous caller, closing the async clients of its event loop once coro is done.
+    Each call starts a new loop with clients of its own, so run everything of a unit of work (e.g. a case) in one
+    '''
+    async def main():
+        try:
+            return await coro
+        finally:
+            await aclose_async_clients()
+    return asyncio.run(main())
+
+def get_llm_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _semaphores[loop]
+
+def _completion_cache_key(cache, client_kwargs, params):
+    # streamed responses are not cached; the endpoint is part of the key since providers share model names
+    if cache is None or params.get("stream"):
+        return None
+    params = dict(params)
+    return cache.key(params.pop("model", None), params.pop("messages", None), dict(params, base_url=(client_kwargs or {}).get("base_url")))
+
+def _scheduled_client_kwargs(scheduler, client_kwargs):
+    # the scheduler retries failed requests itself, so the client must not retry them again
+    client_kwargs = dict(client_kwargs or {})
+    if scheduler is not None:
+        client_kwargs.setdefault("max_retries", 0)
+    return client_kwargs
+
+def chat_completion(client_kwargs=None, **params):
+    '''
+    Run one chat completion on the shared client for client_kwargs (see get_openai_client) and return the response,
+    served from the persistent response cache (see llm_cache) when the same request was made before.
+    Requests go through the process-wide scheduler (see llm_scheduler), which retries them and shapes the rate
+    '''
+    cache = get_response_cache()
+    key = _completion_cache_key(cache, client_kwargs, params)
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            with llm_metrics.track(params.get("model"), response_cache_hit=True):
+                return openai.types.chat.ChatCompletion.model_validate(cached)
+    scheduler = get_scheduler()
+    client = get_openai_client(**_scheduled_client_kwargs(scheduler, client_kwargs))
+    with llm_metrics.track(params.get("model")) as call:
+        if scheduler is not None:
+            response = scheduler.run(lambda: client.chat.completions.create(**params), params)
+        else:
+            response = client.chat.completions.create(**params)
+        call.set_usage(getattr(response, "usage", None))
+    if key is not None:
+        cache.put(key, params.get("model"), response.model_dump())
+    return response
+
+async def achat_completion(client_kwargs=None, timeout=None, **params):
+    '''
+    Async chat_completion: at most LLM_MAX_CONCURRENCY requests per event loop are in flight, and the request is
+    cancelled (asyncio.TimeoutError) after timeout seconds, waiting for a free slot included.
+    Cache hits are served without taking a slot
+    '''
+    cache = get_response_cache()
+    key = _completion_cache_key(cache, client_kwargs, params)
+    if key is not None:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            with llm_metrics.track(params.get("model"), response_cache_hit=True):
+                return openai.types.chat.ChatCompletion.model_validate(cached)
+    scheduler = get_scheduler()
+    async def create():
+        async with get_llm_semaphore():
+            client = get_async_openai_client(**_scheduled_client_kwargs(scheduler, client_kwargs))
+            # timed from when a slot is free, so queueing behind the semaphore is not counted as latency
+            with llm_metrics.track(params.get("model")) as call:
+                if scheduler is not None:
+                    response = await scheduler.arun(lambda: client.chat.completions.create(**params), params)
+                else:
+                    response = await client.chat.completions.create(**params)
+                call.set_usage(getattr(response, "usage", None))
+                return response
+    response = await asyncio.wait_for(create(), timeout)
+    if key is not None:
+        await asyncio.to_thread(cache.put, key, params.get("model"), response.model_dump())
+    return response
+
+# completion budget of a decision call: room for the choice plus stray markup such as "**Yes**."
+DECISION_MAX_TOKENS = 8
+
+def parse_choice(text, choices, complete=True):
+    '''
+    The first of choices named in text, or None. Words are matched case-insensitively as whole words.
+    Single letters (multiple-choice options) only count as capitals in an answer position: the whole text,
+    "(C)", "C." / "C)" before a space, "**C**", or after "answer is" / "option" / "choice", which wins over the
+    other positions; a letter in prose ("A diagnosis of ...") is not an answer.
+    With complete=False (a partial stream) a match must be followed by another character, so "No" is not taken
+    from the start of "Not"
+    '''
+    if not text:
+        return None
+    words = [choice for choice in choices if len(choice) > 1]
+    letters = [choice for choice in choices if len(choice) == 1]
+    end = "(?![A-Za-z])" if complete else "(?=[^A-Za-z])"
+    found = [] # (priority, position, choice)
+    if words:
+        alternatives = ["(?i:" + re.escape(word) + ")" for word in sorted(words, key=len, reverse=True)]
+        for match in re.finditer("(?<![A-Za-z])(" + "|".join(alternatives) + ")" + end, text):
+            found.append((1, match.start(), match.group(1)))
+            break
+    if letters:
+        letter = "(" + "|".join(re.escape(choice) for choice in letters) + ")"
+        explicit = r"(?i:answer|option|choice)(?:\s+is|\s*[:\uff1a])?\s*[(*]*\s*" + letter + end
+        positions = [
+            r"^\W*" + letter + r"\W*$" if complete else None,
+            r"\(\s*" + letter + r"\s*\)",
+            r"\*\*\s*" + letter + r"\s*\*\*",
+            r"(?<![A-Za-z0-9])" + letter + (r"[.)](?=\s|$)" if complete else r"[.)](?=\s)"),
+        ]
+        match = re.search(explicit, text)
+        if match is not None:
+            found.append((0, match.start(), match.group(1)))
+        for pattern in positions:
+            match = re.search(pattern, text) if pattern is not None else None
+            if match is not None:
+                found.append((1, match.start(1), match.group(1)))
+    if not found:
+        return None
+    name = min(found)[2]
+    return next(choice for choice in choices if choice.lower() == name.lower())
+
+def choice_from_logprobs(response, choices):
+    '''
+    The most likely of choices among the top alternatives of the first answer token that names one, or None
+    '''
+    logprobs = response.choices[0].logprobs
+    for token in (logprobs.content or []) if logprobs is not None else []:
+        ranked = [(alternative.logprob, parse_choice(alternative.token.strip(), choices)) for alternative in token.top_logprobs or []]
+        ranked = [(logprob, choice) for logprob, choice in ranked if choice is not None]
+        if ranked:
+            return max(ranked)[1]
+    return None
+
+def choose(messages, choices=("Yes", "No"), default=None, mode="text", client_kwargs=None, return_response=False, **params):
+    '''
+    Constrained decision call: the answer is capped at DECISION_MAX_TOKENS and parsed into one of choices
+    (default when none is named).
+    mode "text" parses the answer, "logprobs" picks the likeliest choice from the first answer token's
+    top_logprobs, "stream" cancels the stream as soon as a choice has arrived (streams bypass the response cache).
+    return_response: also return the response (None for streams), e.g. for its usage
+    '''
+    params = dict(params, messages=messages, max_tokens=params.get("max_tokens", DECISION_MAX_TOKENS))
+    response = None
+    if mode == "logprobs":
+        response = chat_completion(client_kwargs=client_kwargs, logprobs=True, top_logprobs=5, **params)
+        choice = choice_from_logprobs(response, choices) or parse_choice(response.choices[0].message.content, choices)
+    elif mode == "stream":
+        scheduler = get_scheduler()
+        client = get_openai_client(**_scheduled_client_kwargs(scheduler, client_kwargs))
+        request = lambda: client.chat.completions.create(stream=True, **params)
+        with llm_metrics.track(params.get("model"), decision="stream") as call:
+            # the scheduler's concurrency slot is held until the stream is consumed
+            with scheduler.stream(request, params) if scheduler is not None else contextlib.nullcontext(request()) as stream:
+                text, choice = "", None
+                try:
+                    for chunk in stream:
+                        call.mark_first_token()
+                        if chunk.choices:
+                            text += chunk.choices[0].delta.content or ""
+                            choice = parse_choice(text, choices, complete=False)
+                            if choice is not None:
+                                break
+                finally:
+                    stream.close()
+        choice = choice or parse_choice(text, choices)
+    else:
+        response = chat_completion(client_kwargs=client_kwargs, **params)
+        choice = parse_choice(response.choices[0].message.content, choices)
+    return (choice or default, response) if return_response else choice or default
+
+async def achoose(messages, choices=("Yes", "No"), default=None, mode="text", client_kwargs=None, timeout=None, return_response=False, **params):
+    '''
+    Async choose
+    '''
+    params = dict(params, messages=messages, max_tokens=params.get("max_tokens", DECISION_MAX_TOKENS))
+    response = None
+    if mode == "logprobs":
+        response = await achat_completion(client_kwargs=client_kwargs, timeout=timeout, logprobs=True, top_logprobs=5, **params)
+        choice = choice_from_logprobs(response, choices) or parse_choice(response.choices[0].message.content, choices)
+    elif mode == "stream":
+        scheduler = get_scheduler()
+        async def decide():
+            async with get_llm_semaphore():
+                client = get_async_openai_client(**_scheduled_client_kwargs(scheduler, client_kwargs))
+                request = lambda: client.chat.completions.create(stream=True, **params)
+                with llm_metrics.track(params.get("model"), decision="stream") as call:
+                    # the scheduler's concurrency slot is held until the stream is consumed
+                    held = scheduler.astream(request, params) if scheduler is not None else contextlib.nullcontext(await request())
+                    async with held as stream:
+                        text = ""
+                        try:
+                            async for chunk in stream:
+                                call.mark_first_token()
+                                if chunk.choices:
+                                    text += chunk.choices[0].delta.content or ""
+                                    choice = parse_choice(text, choices, complete=False)
+                                    if choice is not None:
+                                        return choice
+                        finally:
+                            await stream.close()
+                        return parse_choice(text, choices)
+        choice = await asyncio.wait_for(decide(), timeout)
     else:
-        openai_client = lambda **x: openai.OpenAI(
-            api_key=openai.api_key,
-        ).chat.completions.create(**x).choices[0].message.content
+        response = await achat_completion(client_kwargs=client_kwargs, timeout=timeout, **params)
+        choice = parse_choice(response.choices[0].message.content, choices)
+    return (choice or default, response) if return_response else choice or default
+
+def load_qa_cache(qa_log):
+    '''
+    Contexts of the completed i-MedRAG rounds in an EventLog. A cache written before the log existed (one JSON list)
+    is converted to a log, replacing the file atomically under the log's lock
+    '''
+    with open(qa_log.path, 'r', encoding='utf-8') as f:
+        legacy = f.read(1) == "["
+    if not legacy:
+        return [event["context"] for event in qa_log.read("qa")]
+    with qa_log.locked():
+        # another worker may have converted it meanwhile
+        with open(qa_log.path, 'r', encoding='utf-8') as f:
+            legacy = f.read(1) == "["
+            f.seek(0)
+            qa_cache = json.load(f) if legacy else None
+        if legacy:
+            qa_log.replace([("qa", {"context": context}) for context in qa_cache])
+    if not legacy:
+        return [event["context"] for event in qa_log.read("qa")]
+    return qa_cache
+
+FOLLOW_UP_SCHEMAS = {
+    "queries": {
+        "type": "object",
+        "properties": {"analysis": {"type": "string"}, "queries": {"type": "array", "items": {"type": "string"}}},
+        "required": ["analysis", "queries"],
+        "additionalProperties": False,
+    },
+    "answer": {
+        "type": "object",
+        "properties": {"analysis": {"type": "string"}, "answer": {"type": "string"}},
+        "required": ["analysis", "answer"],
+        "additionalProperties": False,
+    },
+}
+FOLLOW_UP_JSON = {
+    "queries": 'Reply with a JSON object {"analysis": "...", "queries": ["query 1", ..., "query N"]} instead of the sections.',
+    "answer": 'Reply with a JSON object {"analysis": "...", "answer": "..."} instead of the sections.',
+}
+
+def follow_up_format(structured, kind):
+    '''
+    response_format of an i-MedRAG reply of kind ("queries" or "answer") for the structured mode
+    '''
+    if structured == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": f"follow_up_{kind}", "schema": FOLLOW_UP_SCHEMAS[kind], "strict": True}}
+    if structured == "json":
+        return {"type": "json_object"}
+    raise ValueError("structured output must be json_schema or json, got {:s}".format(str(structured)))
+
+def parse_sections(text):
+    '''
+    Markdown sections of a reply as {title (lowercase): body}
+    '''
+    parts = re.split(r"^[ \t]*#{2,}[ \t]*(.+?)[ \t#:]*$", text, flags=re.MULTILINE)
+    return {title.strip().lower(): body.strip() for title, body in zip(parts[1::2], parts[2::2])}
+
+def parse_queries(text):
+    '''
+    Queries of a ## Queries section: a JSON list, or one per line with or without numbering / bullets
+    '''
+    try:
+        queries = json.loads(text)
+        if isinstance(queries, list):
+            return [str(query).strip() for query in queries if str(query).strip()]
+    except json.JSONDecodeError:
+        pass
+    queries = []
+    for line in text.splitlines():
+        line = re.sub(r"^\s*(?:[-*\u2022]|\(?\d+[.):])\s*", "", line).strip()
+        line = re.sub(r"^\*\*(.*)\*\*$", r"\1", line).strip().strip('"').strip()
+        if line:
+            queries.append(line)
+    return queries
+
+def parse_follow_up(text):
+    '''
+    Queries and answer of an i-MedRAG reply, from a JSON object or else from the ## Queries / ## Answer sections;
+    either is None if the reply has none
+    '''
+    reply = {"queries": None, "answer": None}
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if match is not None:
+        try:
+            parsed = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            parsed = None
+        if isinstance(parsed, dict) and ("queries" in parsed or "answer" in parsed):
+            if isinstance(parsed.get("queries"), list):
+                reply["queries"] = [str(query).strip() for query in parsed["queries"] if str(query).strip()]
+            if parsed.get("answer"):
+                reply["answer"] = str(parsed["answer"])
+            return reply
+    sections = parse_sections(text or "")
+    if "queries" in sections:
+        reply["queries"] = parse_queries(sections["queries"])
+    if "answer" in sections:
+        reply["answer"] = sections["answer"]
+    elif "answer is" in (text or "").lower():
+        reply["answer"] = text[text.lower().rindex("answer is"):]
+    return reply
+
+def parse_answer_choice(answer, choices):
+    '''
+    The option chosen in the answer of a reply (see parse_choice for the positions an option letter is read from),
+    or None
+    '''
+    return parse_choice(answer, choices)
+
+class PrefixKVCache:
+    '''
+    LRU of past key values (transformers Cache objects) for prompt prefixes, keyed by a hash of the prefix token ids
+    and bounded to max_size bytes. lookup() returns the longest cached prefix of a prompt
+    '''
+
+    def __init__(self, max_size=LOCAL_PREFIX_CACHE_SIZE):
+        self.max_size = parse_size(max_size)
+        self.entries = OrderedDict() # hash -> (length, past_key_values, size)
+        self.lengths = {} # prefix length -> number of entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(ids):
+        return hashlib.sha1(ids.cpu().numpy().tobytes()).hexdigest()
+
+    @staticmethod
+    def nbytes(past_key_values):
+        layers = getattr(past_key_values, "layers", None)
+        if layers is not None:
+            tensors = [tensor for layer in layers for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+        else:
+            tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors if tensor is not None)
+
+    def lookup(self, ids):
+        '''
+        (past_key_values, length) of the longest cached prefix of ids (1-d token ids), or (None, 0)
+        '''
+        with self.lock:
+            for length in sorted(self.lengths, reverse=True):
+                if length > len(ids):
+                    continue
+                key = self.key(ids[:length])
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key][1], length
+            self.misses += 1
+            return None, 0
+
+    def put(self, ids, past_key_values):
+        size = self.nbytes(past_key_values)
+        if self.max_size is not None and size > self.max_size:
+            return
+        key = self.key(ids)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (len(ids), past_key_values, size)
+            self.lengths[len(ids)] = self.lengths.get(len(ids), 0) + 1
+            self.size += size
+            while self.max_size is not None and self.size > self.max_size:
+                _, (length, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.lengths[length] -= 1
+                if self.lengths[length] == 0:
+                    del self.lengths[length]
+
+    def __contains__(self, ids):
+        with self.lock:
+            return self.key(ids) in self.entries
+
+class MicroBatcher:
+    '''
+    Collects single generate calls made concurrently (threads, asyncio.to_thread) into batches of up to batch_size,
+    waiting at most max_wait seconds for a batch to fill. run_batch(prompts, prefix_hints, prefix_cache=..., **kwargs)
+    returns their completions; only calls with the same generation kwargs and prefix cache share a batch
+    '''
+
+    def __init__(self, run_batch, batch_size=LOCAL_BATCH_SIZE, max_wait=LOCAL_BATCH_WAIT):
+        self.run_batch = run_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # (re)started lazily, since the worker thread does not survive a fork
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                threading.Thread(target=self._worker, daemon=True).start()
+                self.pid = os.getpid()
+
+    def submit(self, prompt, prefix_hints=None, prefix_cache=None, **kwargs):
+        try:
+            group = (id(prefix_cache), json.dumps(kwargs, sort_keys=True))
+        except TypeError: # e.g. a stopping criteria object: not batchable
+            return self.run_batch([prompt], [prefix_hints], prefix_cache=prefix_cache, **kwargs)[0]
+        if self.pid != os.getpid():
+            self._start()
+        future = Future()
+        self.queue.put((group, prefix_cache, (prompt, prefix_hints), future))
+        return future.result()
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups = {}
+            for group, prefix_cache, prompt, future in batch:
+                groups.setdefault(group, (prefix_cache, []))[1].append((prompt, future))
+            for (_, kwargs), (prefix_cache, entries) in groups.items():
+                try:
+                    completions = self.run_batch([prompt for (prompt, _), _ in entries], [hint for (_, hint), _ in entries],
+                                                 prefix_cache=prefix_cache, **json.loads(kwargs))
+                except Exception as e:
+                    for _, future in entries:
+                        future.set_exception(e)
+                    continue
+                for (_, future), completion in zip(entries, completions):
+                    future.set_result(completion)
+
+class LocalLLM:
+    '''
+    A local model loaded once per process and shared by every MedRAG using it (e.g. one per doctor agent): the
+    pipeline, the tokenizer, a lock that serializes generate calls on the weights, and a micro-batcher and prefix
+    cache set up on first use. Settings that differ between instances (max_length, whether to use the prefix cache)
+    are passed with each call
+    '''
+
+    def __init__(self, pipeline, tokenizer, llm_name):
+        self.pipeline = pipeline
+        self.tokenizer = tokenizer
+        self.llm_name = llm_name
+        self.lock = threading.Lock()
+        self.batcher = None
+        self.prefix_cache = None
+
+    def get_batcher(self, batch_size):
+        '''
+        The MicroBatcher of the model, batching up to the largest batch_size asked for
+        '''
+        with self.lock:
+            if self.batcher is None:
+                self.batcher = MicroBatcher(self.generate, batch_size)
+            self.batcher.batch_size = max(self.batcher.batch_size, batch_size)
+            return self.batcher
+
+    def get_prefix_cache(self, max_size):
+        '''
+        The PrefixKVCache of the model (its entries depend only on the weights and the token ids), holding up to the
+        largest max_size asked for
+        '''
+        with self.lock:
+            if self.prefix_cache is None:
+                self.prefix_cache = PrefixKVCache(max_size)
+            elif self.prefix_cache.max_size is not None:
+                self.prefix_cache.max_size = max(self.prefix_cache.max_size, parse_size(max_size))
+            return self.prefix_cache
+
+    def generate(self, prompts, prefix_hints=None, prefix_cache=None, max_length=2048, **kwargs):
+        '''
+        Greedy completions of prompts (chat-templated strings) by the local model, run as one batch.
+        Rows stop on their own (eos or, for meditron, a stop word), finished rows are padded until all are done.
+        With the prefix cache, the rows start from the longest cached prefix they all share (a batch whose rows share
+        an uncached prefix prefills it once and caches it), so only the rest is prefilled; the rows then continue
+        after padding placed between the prefix and their own tokens. A single prompt is cached for later calls,
+        with the prefixes in its prefix_hints (texts the prompt starts with, e.g. the rendered system message or
+        the i-MedRAG context)
+        prefix_cache (PrefixKVCache): the cache to use, or None; max_length (int): prompt and completion tokens
+        '''
+        if prefix_cache is None:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True, max_length=max_length, add_special_tokens=False)
+            inputs = inputs.to(self.pipeline.model.device)
+            output = self._generate_ids(inputs["input_ids"], inputs["attention_mask"], max_length, **kwargs)
+            return self.tokenizer.batch_decode(output[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+        device = self.pipeline.model.device
+        rows = [torch.tensor(ids, dtype=torch.long, device=device) for ids in self.tokenizer(prompts, truncation=True, max_length=max_length, add_special_tokens=False)["input_ids"]]
+        # every row keeps at least one token of its own to prefill
+        shared = min(len(ids) for ids in rows) - 1
+        for ids in rows[1:]:
+            mismatch = (ids[:shared] != rows[0][:shared]).nonzero()
+            if len(mismatch):
+                shared = int(mismatch[0])
+        past_key_values, length = prefix_cache.lookup(rows[0])
+        if len(rows) > 1 and shared > length:
+            past_key_values, length = self._prefill(rows[0][:shared]), shared
+            prefix_cache.put(rows[0][:shared], past_key_values)
+        if past_key_values is not None:
+            # generate extends the cache in place
+            past_key_values = copy.deepcopy(past_key_values)
+            if length > shared:
+                past_key_values.crop(shared - length)
+                length = shared
+            if len(rows) > 1:
+                past_key_values.batch_repeat_interleave(len(rows))
+        width = max(len(ids) for ids in rows) - length
+        input_ids = torch.full((len(rows), length + width), self.tokenizer.pad_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, ids in enumerate(rows):
+            input_ids[i, :length] = ids[:length]
+            input_ids[i, length + width - (len(ids) - length):] = ids[length:]
+            attention_mask[i, :length] = 1
+            attention_mask[i, length + width - (len(ids) - length):] = 1
+        output = self._generate_ids(input_ids, attention_mask, max_length, past_key_values=past_key_values, return_dict_in_generate=True, **kwargs)
+        if len(rows) == 1:
+            self._cache_prefixes(prefix_cache, rows[0], (prefix_hints or [None])[0], output.past_key_values)
+        return self.tokenizer.batch_decode(output.sequences[:, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def _generate_ids(self, input_ids, attention_mask, max_length, **kwargs):
+        stopping_criteria = None
+        if "meditron" in self.llm_name.lower():
+            stopping_criteria = StoppingCriteriaList([CustomStoppingCriteria(["###", "User:", "\n\n\n"], self.tokenizer, input_ids.shape[1])])
+        if "llama-3" in self.llm_name.lower():
+            eos_token_id = [self.tokenizer.eos_token_id, self.tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+        else:
+            eos_token_id = self.tokenizer.eos_token_id
+        # one generate at a time on the shared weights
+        with self.lock, torch.no_grad():
+            return self.pipeline.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                do_sample=False,
+                eos_token_id=eos_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
+                max_length=max_length,
+                stopping_criteria=stopping_criteria,
+                **kwargs
+            )
+
+    def _prefill(self, ids):
+        # past key values of ids (1-d token ids) alone
+        with self.lock, torch.no_grad():
+            return self.pipeline.model(input_ids=ids[None], use_cache=True).past_key_values
+
+    def _cache_prefixes(self, prefix_cache, ids, prefix_hints, past_key_values):
+        # past_key_values also hold the generated tokens: keep the prompt, and each hinted prefix up to the first
+        # token where the hint alone tokenizes differently from the prompt
+        prefixes = [len(ids)]
+        for hint in prefix_hints or []:
+            hint_ids = self.tokenizer(hint, return_tensors="pt", add_special_tokens=False)["input_ids"][0].to(ids.device)
+            length = min(len(hint_ids), len(ids) - 1)
+            mismatch = (ids[:length] != hint_ids[:length]).nonzero()
+            if len(mismatch):
+                length = int(mismatch[0])
+            if length > 0:
+                prefixes.append(length)
+        for length in prefixes:
+            if ids[:length] not in prefix_cache:
+                prefix = copy.deepcopy(past_key_values)
+                # negative crop (drop that many trailing tokens) works across transformers versions
+                if prefix.get_seq_length() > length:
+                    prefix.crop(length - prefix.get_seq_length())
+                prefix_cache.put(ids[:length], prefix)
+
+_local_llms = {}
+_local_llms_lock = threading.Lock()
+
+def get_local_llm(llm_name, torch_dtype=torch.bfloat16, cache_dir=None):
+    '''
+    Process-wide LocalLLM of (llm_name, torch_dtype), loaded on first use
+    '''
+    key = (llm_name, str(torch_dtype))
+    with _local_llms_lock:
+        if key not in _local_llms:
+            tokenizer = AutoTokenizer.from_pretrained(llm_name, cache_dir=cache_dir)
+            pipeline = transformers.pipeline(
+                "text-generation",
+                model=llm_name,
+                tokenizer=tokenizer,
+                torch_dtype=torch_dtype,
+                device_map="auto",
+                model_kwargs={"cache_dir":cache_dir},
+            )
+            _local_llms[key] = LocalLLM(pipeline, tokenizer, llm_name)
+    return _local_llms[key]
 
 class MedRAG:
 
-    def __init__(self, llm_name="OpenAI/gpt-3.5-turbo-16k", rag=True, follow_up=False, retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus", cache_dir=None, corpus_cache=False, HNSW=False):
+    def __init__(self, llm_name="OpenAI/gpt-3.5-turbo-16k", rag=True, follow_up=False, retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus", cache_dir=None, corpus_cache=False, HNSW=False, memory_budget=None, semantic_cache_threshold=None, batch_size=LOCAL_BATCH_SIZE, prefix_cache_size=LOCAL_PREFIX_CACHE_SIZE, dedup=MEDRAG_DEDUP, n_shards=1, shard_workers="thread", shard_addresses=None):
+        '''
+        n_shards, shard_workers, shard_addresses: sharded dense indexes, see RetrievalSystem
+        dedup (bool): whether medrag_answer, medrag_answer_batch and medrag_retrieve dedupe snippets unless told otherwise
+        batch_size (int): local models only, prompts generated together by generate_batch and by concurrent
+            generate calls (micro-batched); 1 disables batching
+        prefix_cache_size (int or str): local models only, memory for the past key values of shared prompt prefixes
+            (system prompts, the growing i-MedRAG conversation); 0 disables it
+        Local models are loaded once per process (see get_local_llm): instances of the same model share its weights,
+        batcher and prefix cache, and pass their own max_length and prefix cache setting with each call
+        '''
         self.llm_name = llm_name
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self.batcher = None
+        self.prefix_cache = None
+        self.local_llm = None
         self.rag = rag
         self.retriever_name = retriever_name
         self.corpus_name = corpus_name
@@ -51,7 +794,8 @@ class MedRAG:
         self.cache_dir = cache_dir
         self.docExt = None
         if rag:
-            self.retrieval_system = RetrievalSystem(self.retriever_name, self.corpus_name, self.db_dir, cache=corpus_cache, HNSW=HNSW)
+            self.retrieval_system = RetrievalSystem(self.retriever_name, self.corpus_name, self.db_dir, cache=corpus_cache, HNSW=HNSW, memory_budget=memory_budget, semantic_cache_threshold=semantic_cache_threshold,
+                                                    n_shards=n_shards, shard_workers=shard_workers, shard_addresses=shard_addresses)
         else:
             self.retrieval_system = None
         self.templates = {"cot_system": general_cot_system, "cot_prompt": general_cot,
@@ -85,7 +829,8 @@ class MedRAG:
         else:
             self.max_length = 2048
             self.context_length = 1024
-            self.tokenizer = AutoTokenizer.from_pretrained(self.llm_name, cache_dir=self.cache_dir)
+            self.local_llm = get_local_llm(self.llm_name, torch_dtype=torch.bfloat16, cache_dir=self.cache_dir)
+            self.tokenizer = self.local_llm.tokenizer
             if "mixtral" in llm_name.lower():
                 self.tokenizer.chat_template = open('./templates/mistral-instruct.jinja').read().replace('    ', '').replace('\n', '')
                 self.max_length = 32768
@@ -109,14 +854,15 @@ class MedRAG:
                 self.tokenizer.chat_template = open('./templates/pmc_llama.jinja').read().replace('    ', '').replace('\n', '')
                 self.max_length = 2048
                 self.context_length = 1024
-            self.model = transformers.pipeline(
-                "text-generation",
-                model=self.llm_name,
-                # torch_dtype=torch.float16,
-                torch_dtype=torch.bfloat16,
-                device_map="auto",
-                model_kwargs={"cache_dir":self.cache_dir},
-            )
+            self.model = self.local_llm.pipeline
+            # batched prompts are left-padded so every row continues from its last prompt token
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            if self.batch_size > 1:
+                self.batcher = self.local_llm.get_batcher(self.batch_size)
+            if parse_size(prefix_cache_size):
+                self.prefix_cache = self.local_llm.get_prefix_cache(prefix_cache_size)
         
         self.follow_up = follow_up
         if self.rag and self.follow_up:
@@ -129,58 +875,142 @@ class MedRAG:
         else:
             self.answer = self.medrag_answer
 
+    def count_tokens(self, text):
+        if "openai" in self.llm_name.lower() or "gemini" in self.llm_name.lower():
+            return len(self.tokenizer.encode(text, disallowed_special=()))
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
     def custom_stop(self, stop_str, input_len=0):
         stopping_criteria = StoppingCriteriaList([CustomStoppingCriteria(stop_str, self.tokenizer, input_len)])
         return stopping_criteria
 
+    def _local_generate(self, prompts, prefix_hints=None, **kwargs):
+        # the shared model generates with this instance's settings
+        return self.local_llm.generate(prompts, prefix_hints, prefix_cache=self.prefix_cache, max_length=self.max_length, **kwargs)
+
+    def _prefix_hints(self, messages, prompt, prefix=None):
+        '''
+        Texts prompt starts with that later calls are likely to share: the rendered system message, and the prompt
+        up to the end of prefix (a text at the start of the last message, e.g. the i-MedRAG context)
+        '''
+        if self.prefix_cache is None:
+            return None
+        hints = []
+        if messages[0]["role"] == "system":
+            hint = self.tokenizer.apply_chat_template(messages[:1], tokenize=False)
+            if prompt.startswith(hint):
+                hints.append(hint)
+        if prefix and messages[-1]["content"].startswith(prefix):
+            position = prompt.rfind(messages[-1]["content"])
+            if position >= 0:
+                hints.append(prompt[:position + len(prefix)])
+        return hints
+
+    def _local_usage(self, prompts, answers):
+        return types.SimpleNamespace(
+            prompt_tokens=sum(len(self.tokenizer.encode(prompt, add_special_tokens=False)) for prompt in prompts),
+            completion_tokens=sum(len(self.tokenizer.encode(ans, add_special_tokens=False)) for ans in answers)
+        )
+
+    def _cache_key(self, cache, messages, kwargs):
+        # API answers are cached in chat_completion, gemini and local models here
+        if cache is None or "openai" in self.llm_name.lower():
+            return None
+        return cache.key(self.llm_name, messages, dict(kwargs, max_length=self.max_length))
+
     # Call the large model and input the template
-    def generate(self, messages, **kwargs):
+    def generate(self, messages, prefix=None, **kwargs):
         '''
         generate response given messages
+        prefix (str): local models only, a text the last message starts with that later prompts share (e.g. the
+            i-MedRAG context, which every round extends): the prompt up to its end is kept in the prefix cache
+        '''
+        cache = get_response_cache()
+        key = self._cache_key(cache, messages, kwargs)
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                with llm_metrics.track(self.llm_name, response_cache_hit=True):
+                    return cached
+        # API calls are tracked in chat_completion
+        with (llm_metrics.track(self.llm_name) if "openai" not in self.llm_name.lower() else contextlib.nullcontext()) as call:
+            if "openai" in self.llm_name.lower():
+                ans = openai_client(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.0,
+                    **kwargs
+                )
+            elif "gemini" in self.llm_name.lower():
+                response = self.model.generate_content(messages[0]["content"] + '\n\n' + messages[1]["content"], **kwargs)
+                ans = response.candidates[0].content.parts[0].text
+                usage = getattr(response, "usage_metadata", None)
+                call.set_usage(types.SimpleNamespace(
+                    prompt_tokens=getattr(usage, "prompt_token_count", 0),
+                    completion_tokens=getattr(usage, "candidates_token_count", 0)
+                ))
+            else:
+                prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                prefix_hints = self._prefix_hints(messages, prompt, prefix)
+                if self.batcher is not None:
+                    ans = self.batcher.submit(prompt, prefix_hints, prefix_cache=self.prefix_cache, max_length=self.max_length, **kwargs)
+                else:
+                    ans = self._local_generate([prompt], [prefix_hints], **kwargs)[0]
+                call.set_usage(self._local_usage([prompt], [ans]))
+        if key is not None:
+            cache.put(key, self.llm_name, ans)
+        return ans
+
+    def generate_batch(self, messages_list, **kwargs):
+        '''
+        generate responses for a list of messages: local models run them in left-padded batches of batch_size
+        (similar lengths together), API and gemini models as concurrent requests
+        '''
+        if "openai" in self.llm_name.lower() or "gemini" in self.llm_name.lower():
+            if len(messages_list) <= 1:
+                return [self.generate(messages, **kwargs) for messages in messages_list]
+            with ThreadPoolExecutor(max_workers=min(len(messages_list), LLM_MAX_CONCURRENCY)) as executor:
+                return list(executor.map(lambda messages: self.generate(messages, **kwargs), messages_list))
+        cache = get_response_cache()
+        keys = [self._cache_key(cache, messages, kwargs) for messages in messages_list]
+        answers = [None] * len(messages_list)
+        for i, key in enumerate(keys):
+            if key is not None:
+                answers[i] = cache.get(key)
+                if answers[i] is not None:
+                    llm_metrics.record_cache_hit(self.llm_name)
+        pending = [i for i in range(len(messages_list)) if answers[i] is None]
+        prompts = {i: self.tokenizer.apply_chat_template(messages_list[i], tokenize=False, add_generation_prompt=True) for i in pending}
+        pending.sort(key=lambda i: len(prompts[i]))
+        batch_size = max(self.batch_size, 1)
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            with llm_metrics.track(self.llm_name, batch_size=len(batch)) as call:
+                completions = self._local_generate([prompts[i] for i in batch], **kwargs)
+                call.set_usage(self._local_usage([prompts[i] for i in batch], completions))
+            for i, ans in zip(batch, completions):
+                answers[i] = ans
+                if keys[i] is not None:
+                    cache.put(keys[i], self.llm_name, ans)
+        return answers
+
+    async def agenerate(self, messages, timeout=None, **kwargs):
+        '''
+        async generate: API models use the async client, gemini and local models run generate in a worker thread
+        timeout (float): seconds before the call is cancelled
         '''
         if "openai" in self.llm_name.lower():
-            ans = openai_client(
+            response = await achat_completion(
                 model=self.model,
                 messages=messages,
                 temperature=0.0,
+                timeout=timeout,
                 **kwargs
             )
-        elif "gemini" in self.llm_name.lower():
-            response = self.model.generate_content(messages[0]["content"] + '\n\n' + messages[1]["content"], **kwargs)
-            ans = response.candidates[0].content.parts[0].text
-        else:
-            stopping_criteria = None
-            prompt = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            if "meditron" in self.llm_name.lower():
-                # stopping_criteria = custom_stop(["###", "User:", "\n\n\n"], self.tokenizer, input_len=len(self.tokenizer.encode(prompt_cot, add_special_tokens=True)))
-                stopping_criteria = self.custom_stop(["###", "User:", "\n\n\n"], input_len=len(self.tokenizer.encode(prompt, add_special_tokens=True)))
-            if "llama-3" in self.llm_name.lower():
-                response = self.model(
-                    prompt,
-                    do_sample=False,
-                    eos_token_id=[self.tokenizer.eos_token_id, self.tokenizer.convert_tokens_to_ids("<|eot_id|>")],
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    max_length=self.max_length,
-                    truncation=True,
-                    stopping_criteria=stopping_criteria,
-                    **kwargs
-                )
-            else:
-                response = self.model(
-                    prompt,
-                    do_sample=False,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    max_length=self.max_length,
-                    truncation=True,
-                    stopping_criteria=stopping_criteria,
-                    **kwargs
-                )
-            # ans = response[0]["generated_text"]
-            ans = response[0]["generated_text"][len(prompt):]
-        return ans
+            return response.choices[0].message.content
+        return await asyncio.wait_for(asyncio.to_thread(self.generate, messages, **kwargs), timeout)
 
-    def medrag_answer(self, question, options=None, k=32, rrf_k=100, save_dir = None, snippets=None, snippets_ids=None, **kwargs):
+    def medrag_answer(self, question, options=None, k=32, rrf_k=100, save_dir = None, snippets=None, snippets_ids=None, dedup=None, token_budget=None, score_gap=None, **kwargs):
         '''
         question (str): question to be answered
         options (Dict[str, str]): options to be chosen from
@@ -189,7 +1019,14 @@ class MedRAG:
         save_dir (str): directory to save the results
         snippets (List[Dict]): list of snippets to be used
         snippets_ids (List[Dict]): list of snippet ids to be used
+        dedup (bool): collapse overlapping / near-duplicate snippets and backfill from lower-ranked ones
+            (default: the instance's dedup)
+        token_budget (int or True): take snippets until this many context tokens (True: the model's context_length)
+            instead of a fixed k, which then only caps the candidates
+        score_gap (float): with token_budget, also stop at the first score drop larger than this
         '''
+        if token_budget is True:
+            token_budget = self.context_length
 
         if options is not None:
             options = '\n'.join([key+". "+options[key] for key in sorted(options.keys())])
@@ -198,53 +1035,22 @@ class MedRAG:
 
         # retrieve relevant snippets
         if self.rag:
-            if snippets is not None:
-                retrieved_snippets = snippets[:k]
-                scores = []
-            elif snippets_ids is not None:
-                if self.docExt is None:
-                    self.docExt = DocExtracter(db_dir=self.db_dir, cache=True, corpus_name=self.corpus_name)
-                retrieved_snippets = self.docExt.extract(snippets_ids[:k])
-                scores = []
-            else:
-                assert self.retrieval_system is not None
-                retrieved_snippets, scores = self.retrieval_system.retrieve(question, k=k, rrf_k=rrf_k)
-
-            contexts = ["Document [{:d}] (Title: {:s}) {:s}".format(idx, retrieved_snippets[idx]["title"], retrieved_snippets[idx]["content"]) for idx in range(len(retrieved_snippets))]
-            if len(contexts) == 0:
-                contexts = [""]
-            if "openai" in self.llm_name.lower():
-                contexts = [self.tokenizer.decode(self.tokenizer.encode("\n".join(contexts))[:self.context_length])]
-            elif "gemini" in self.llm_name.lower():
-                contexts = [self.tokenizer.decode(self.tokenizer.encode("\n".join(contexts))[:self.context_length])]
-            else:
-                contexts = [self.tokenizer.decode(self.tokenizer.encode("\n".join(contexts), add_special_tokens=False)[:self.context_length])]
+            retrieved_snippets, scores = self.medrag_retrieve(question, k=k, rrf_k=rrf_k, snippets=snippets, snippets_ids=snippets_ids, dedup=dedup, token_budget=token_budget, score_gap=score_gap, verbose=False)
         else:
             retrieved_snippets = []
             scores = []
-            contexts = []
 
         if save_dir is not None and not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
         # generate answers
         answers = []
+        messages_list = self._answer_messages(question, options, retrieved_snippets, token_budget)
         if not self.rag:
-            prompt_cot = self.templates["cot_prompt"].render(question=question, options=options)
-            messages = [
-                {"role": "system", "content": self.templates["cot_system"]},
-                {"role": "user", "content": prompt_cot}
-            ]
-            ans = self.generate(messages, **kwargs)
+            ans = self.generate(messages_list[0], **kwargs)
             answers.append(re.sub("\s+", " ", ans))
         else:
-            for context in contexts:
-                prompt_medrag = self.templates["medrag_prompt"].render(context=context, question=question, options=options)
-                messages=[
-                        {"role": "system", "content": self.templates["medrag_system"]},
-                        {"role": "user", "content": prompt_medrag}
-                ]
-                ans = self.generate(messages, **kwargs)
+            for ans in self.generate_batch(messages_list, **kwargs):
                 answers.append(re.sub("\s+", " ", ans))
         
         if save_dir is not None:
@@ -255,33 +1061,120 @@ class MedRAG:
         
         return answers[0] if len(answers)==1 else answers, retrieved_snippets, scores
  
-    def medrag_retrieve(self, question, k=32, rrf_k=100, snippets=None, snippets_ids=None):
-        print(question)
+    def medrag_answer_batch(self, questions, options=None, k=32, rrf_k=100, dedup=None, token_budget=None, score_gap=None, **kwargs):
+        '''
+        medrag_answer for a list of questions: snippets for all of them are retrieved in one batch (see
+        RetrievalSystem.retrieve_batch), then the answers are generated together by generate_batch.
+        Returns the (answer, snippets, scores) of each question in the order of questions
+        '''
+        if token_budget is True:
+            token_budget = self.context_length
+        if dedup is None:
+            dedup = self.dedup
+
+        if options is not None:
+            options = '\n'.join([key+". "+options[key] for key in sorted(options.keys())])
+        else:
+            options = ''
+
+        if self.rag:
+            assert self.retrieval_system is not None
+            retrieved = self.retrieval_system.retrieve_batch(questions, k=k, rrf_k=rrf_k, dedup=dedup, token_budget=token_budget, score_gap=score_gap, count_tokens=self.count_tokens)
+        else:
+            retrieved = [([], []) for _ in questions]
+
+        messages_list, owners = [], []
+        for i, (question, (retrieved_snippets, _)) in enumerate(zip(questions, retrieved)):
+            for messages in self._answer_messages(question, options, retrieved_snippets, token_budget):
+                messages_list.append(messages)
+                owners.append(i)
+        answers = [[] for _ in questions]
+        for i, ans in zip(owners, self.generate_batch(messages_list, **kwargs)):
+            answers[i].append(re.sub("\s+", " ", ans))
+        return [(ans[0] if len(ans)==1 else ans, retrieved_snippets, scores) for ans, (retrieved_snippets, scores) in zip(answers, retrieved)]
+
+    def _answer_messages(self, question, options, retrieved_snippets, token_budget=None):
+        '''
+        prompts of medrag_answer for one question: the CoT prompt without RAG, else one prompt per context
+        '''
+        if not self.rag:
+            prompt_cot = self.templates["cot_prompt"].render(question=question, options=options)
+            return [[
+                {"role": "system", "content": self.templates["cot_system"]},
+                {"role": "user", "content": prompt_cot}
+            ]]
+        contexts = ["Document [{:d}] (Title: {:s}) {:s}".format(idx, retrieved_snippets[idx]["title"], retrieved_snippets[idx]["content"]) for idx in range(len(retrieved_snippets))]
+        if len(contexts) == 0:
+            contexts = [""]
+        # snippets selected by token_budget should fit it already; a budget larger than the context window is capped
+        context_length = self.context_length if token_budget is None else min(token_budget, self.context_length)
+        if "openai" in self.llm_name.lower():
+            contexts = [self.tokenizer.decode(self.tokenizer.encode("\n".join(contexts))[:context_length])]
+        elif "gemini" in self.llm_name.lower():
+            contexts = [self.tokenizer.decode(self.tokenizer.encode("\n".join(contexts))[:context_length])]
+        else:
+            contexts = [self.tokenizer.decode(self.tokenizer.encode("\n".join(contexts), add_special_tokens=False)[:context_length])]
+        messages_list = []
+        for context in contexts:
+            prompt_medrag = self.templates["medrag_prompt"].render(context=context, question=question, options=options)
+            messages_list.append([
+                    {"role": "system", "content": self.templates["medrag_system"]},
+                    {"role": "user", "content": prompt_medrag}
+            ])
+        return messages_list
+
+    def medrag_retrieve(self, question, k=32, rrf_k=100, snippets=None, snippets_ids=None, dedup=None, token_budget=None, score_gap=None, verbose=True):
+        if verbose:
+            print(question)
+        if dedup is None:
+            dedup = self.dedup
         if snippets is not None:
-            retrieved_snippets = snippets[:k]
+            if dedup:
+                retrieved_snippets, _ = dedup_snippets(snippets, k=k)
+            else:
+                retrieved_snippets = snippets[:k]
             scores = []
         elif snippets_ids is not None:
             if self.docExt is None:
                 self.docExt = DocExtracter(db_dir=self.db_dir, cache=True, corpus_name=self.corpus_name)
-            retrieved_snippets = self.docExt.extract(snippets_ids[:k])
+            # ids are looked up one by one, only as far as dedup or the budget go
+            if dedup:
+                retrieved_snippets, _ = dedup_snippets(snippets_ids, k=k, fetch=lambda item: self.docExt.extract([item])[0])
+            elif token_budget is not None:
+                retrieved_snippets = snippets_ids[:k] # looked up below
+            else:
+                retrieved_snippets = self.docExt.extract(snippets_ids[:k])
             scores = []
         else:
             assert self.retrieval_system is not None
-            retrieved_snippets, scores = self.retrieval_system.retrieve(question, k=k, rrf_k=rrf_k)
+            retrieved_snippets, scores = self.retrieval_system.retrieve(question, k=k, rrf_k=rrf_k, dedup=dedup, token_budget=token_budget, score_gap=score_gap, count_tokens=self.count_tokens)
+        if token_budget is not None and (snippets is not None or snippets_ids is not None):
+            fetch = (lambda item: self.docExt.extract([item])[0]) if snippets is None and not dedup else None
+            retrieved_snippets, _ = select_by_token_budget(retrieved_snippets, [], token_budget, count_tokens=self.count_tokens, fetch=fetch)
 
         return retrieved_snippets, scores
     
-    def i_medrag_answer(self, question, options=None, k=32, rrf_k=100, save_path = None, n_rounds=4, n_queries=3, qa_cache_path=None, **kwargs):
+    def i_medrag_answer(self, question, options=None, k=32, rrf_k=100, save_path = None, n_rounds=4, n_queries=3, qa_cache_path=None, structured=I_MEDRAG_STRUCTURED, **kwargs):
+        '''
+        structured (str): "json_schema" or "json" asks API models for JSON replies (see follow_up_format). Queries and
+            answers are parsed locally (parse_follow_up); an extra LLM call only asks for an option the parser cannot find
+        '''
+        option_keys = sorted(options.keys()) if options else None
         if options is not None:
             options = '\n'.join([key+". "+options[key] for key in sorted(options.keys())])
         else:
             options = ''
         QUESTION_PROMPT = f"Here is the question:\n{question}\n\n{options}"
+        if "openai" not in self.llm_name.lower():
+            structured = None
+        ask_instruction = self.templates['follow_up_ask'].format(n_queries) + ("\n" + FOLLOW_UP_JSON["queries"] if structured else "")
+        answer_instruction = self.templates['follow_up_answer'] + ("\n" + FOLLOW_UP_JSON["answer"] if structured else "")
 
         context = ""
         qa_cache = []
-        if qa_cache_path is not None and os.path.exists(qa_cache_path):
-            qa_cache = eval(open(qa_cache_path, 'r').read())[:n_rounds]
+        qa_log = EventLog(qa_cache_path, fsync=True) if qa_cache_path else None
+        if qa_log is not None and qa_log.exists():
+            qa_cache = load_qa_cache(qa_log)[:n_rounds]
             if len(qa_cache) > 0:
                 context = qa_cache[-1]
             n_rounds = n_rounds - len(qa_cache)
@@ -289,7 +1182,26 @@ class MedRAG:
 
         # Run in loop
         max_iterations = n_rounds + 3
-        saved_messages = [{"role": "system", "content": self.templates["i_medrag_system"]}]
+        # while the call runs, the transcript is appended message by message to an event log next to save_path;
+        # when it returns, save_path gets the whole transcript as one JSON list, as before, and the log is removed.
+        # event_log.read_messages reads either
+        saved_messages = []
+        message_log = EventLog(transcript_log_path(save_path)) if save_path else None
+        if message_log is not None:
+            message_log.clear()
+            if os.path.exists(save_path): # the transcript of an earlier call
+                os.remove(save_path)
+        def save_message(message):
+            saved_messages.append(message if type(message) == dict else message.model_dump())
+            if message_log is not None:
+                message_log.append("message", message=saved_messages[-1])
+        def save_transcript():
+            if message_log is not None:
+                with open(save_path + ".tmp", 'w') as f:
+                    json.dump(saved_messages, f, indent=4)
+                os.replace(save_path + ".tmp", save_path)
+                message_log.remove()
+        save_message({"role": "system", "content": self.templates["i_medrag_system"]})
 
         for i in range(max_iterations):
             if i < n_rounds:
@@ -301,7 +1213,7 @@ class MedRAG:
                         },
                         {
                             "role": "user",
-                            "content": f"{QUESTION_PROMPT}\n\n{self.templates['follow_up_ask'].format(n_queries)}",
+                            "content": f"{QUESTION_PROMPT}\n\n{ask_instruction}",
                         },
                     ]
                 else:                
@@ -312,7 +1224,7 @@ class MedRAG:
                         },
                         {
                             "role": "user",
-                            "content": f"{context}\n\n{QUESTION_PROMPT}\n\n{self.templates['follow_up_ask'].format(n_queries)}",
+                            "content": f"{context}\n\n{QUESTION_PROMPT}\n\n{ask_instruction}",
                         },
                     ]
             elif context != last_context:
@@ -323,7 +1235,7 @@ class MedRAG:
                     },
                     {
                         "role": "user",
-                        "content": f"{context}\n\n{QUESTION_PROMPT}\n\n{self.templates['follow_up_answer']}",
+                        "content": f"{context}\n\n{QUESTION_PROMPT}\n\n{answer_instruction}",
                     },
                 ]
             elif len(messages) == 1:
@@ -334,91 +1246,100 @@ class MedRAG:
                     },
                     {
                         "role": "user",
-                        "content": f"{context}\n\n{QUESTION_PROMPT}\n\n{self.templates['follow_up_answer']}",
+                        "content": f"{context}\n\n{QUESTION_PROMPT}\n\n{answer_instruction}",
                     },
                 ]
-            saved_messages.append(messages[-1])
-            if save_path:
-                with open(save_path, 'w') as f:
-                    json.dump([p if type(p) == dict else p.model_dump() for p in saved_messages], f, indent=4)
+            save_message(messages[-1])
             last_context = context
-            last_content = self.generate(messages, **kwargs)
+            generate_kwargs = dict(kwargs, response_format=follow_up_format(structured, "queries" if i < n_rounds else "answer")) if structured else kwargs
+            # the context opens the prompt of every later round: its end is a cacheable prefix for local models
+            last_content = self.generate(messages, prefix=context or None, **generate_kwargs)
             response_message = {"role": "assistant", "content": last_content}
-            saved_messages.append(response_message)
-            if save_path:
-                with open(save_path, 'w') as f:
-                    json.dump([p if type(p) == dict else p.model_dump() for p in saved_messages], f, indent=4)       
-            if i >= n_rounds and ("## Answer" in last_content or "answer is" in last_content.lower()):
+            save_message(response_message)
+            reply = parse_follow_up(last_content)
+            if i >= n_rounds and reply["answer"] is not None:
                 messages.append(response_message)
+                if option_keys is None:
+                    save_transcript()
+                    return json.dumps({"answer": reply["answer"]}, ensure_ascii=False), messages
+                choice = parse_answer_choice(reply["answer"], option_keys)
+                if choice is not None:
+                    save_transcript()
+                    return json.dumps({"answer": choice}), messages
+                # no option could be read from the answer: ask for it
                 messages.append(
                     {
                         "role": "user",
-                        "content": "Output the answer in JSON: {'answer': your_answer (A/B/C/D)}" if options else "Output the answer in JSON: {'answer': your_answer}",
+                        "content": "Output the answer in JSON: {'answer': your_answer (A/B/C/D)}",
                     }
                 )
-                saved_messages.append(messages[-1])
+                save_message(messages[-1])
                 answer_content = self.generate(messages, **kwargs)
                 answer_message = {"role": "assistant", "content": answer_content}
                 messages.append(answer_message)
-                saved_messages.append(messages[-1])
-                if save_path:
-                    with open(save_path, 'w') as f:
-                        json.dump([p if type(p) == dict else p.model_dump() for p in saved_messages], f, indent=4)
+                save_message(messages[-1])
+                save_transcript()
                 return messages[-1]["content"], messages
-            elif "## Queries" in last_content:
+            elif reply["queries"] is not None:
                 messages = messages[:-1]
-                if last_content.split("## Queries")[-1].strip() == "":
+                action_list = reply["queries"]
+                if len(action_list) == 0:
                     print("Empty queries. Continue with next iteration.")
                     continue
+                action_list = [question for question in action_list if question.strip() != ""]
                 try:
-                    action_str = self.generate([
-                        {
-                            "role": "user",
-                            "content": f"Parse the following passage and extract the queries as a list: {last_content}.\n\nPresent the queries as they are. DO NOT merge or break down queries. Output the list of queries in JSON format: {{\"output\": [\"query 1\", ..., \"query N\"]}}",
-                        }
-                    ], **kwargs)
-                    action_str = re.search(r"output\": (\[.*\])", action_str, re.DOTALL).group(1)
-                    action_list = [re.sub(r'^\d+\.\s*', '', s.strip()) for s in eval(action_str)]
+                    # all queries of the round at once; answers are appended in query order
+                    rag_results = [result[0] for result in self.medrag_answer_batch(action_list, k=k, rrf_k=rrf_k, **kwargs)]
                 except Exception as E:
-                    print("Error parsing action list. Continue with next iteration.")
-                    error_class = E.__class__.__name__
-                    error = f"{error_class}: {str(E)}"
-                    print(error)
-                    if save_path:
-                        with open(save_path + ".error", 'a') as f:
-                            f.write(f"{error}\n")                
-                    continue
-                for question in action_list:
-                    if question.strip() == "":
-                        continue
-                    try:
-                        rag_result = self.medrag_answer(question, k=k, rrf_k=rrf_k, **kwargs)[0]
+                    print(f"Batched queries failed ({E.__class__.__name__}: {str(E)}), answering them one by one")
+                    rag_results = []
+                    for question in action_list:
+                        try:
+                            rag_results.append(self.medrag_answer(question, k=k, rrf_k=rrf_k, **kwargs)[0])
+                        except Exception as E:
+                            rag_results.append(None)
+                            error_class = E.__class__.__name__
+                            error = f"{error_class}: {str(E)}"
+                            print(error)
+                            if save_path:
+                                with open(save_path + ".error", 'a') as f:
+                                    f.write(f"{error}\n")
+                for question, rag_result in zip(action_list, rag_results):
+                    if rag_result is not None:
                         context += f"\n\nQuery: {question}\nAnswer: {rag_result}"
                         context = context.strip()
-                    except Exception as E:
-                        error_class = E.__class__.__name__
-                        error = f"{error_class}: {str(E)}"
-                        print(error)
-                        if save_path:
-                            with open(save_path + ".error", 'a') as f:
-                                f.write(f"{error}\n")
                 qa_cache.append(context)
-                if qa_cache_path:
-                    with open(qa_cache_path, 'w') as f:
-                        json.dump(qa_cache, f, indent=4)
+                if qa_log is not None:
+                    qa_log.append("qa", context=context)
             else:
                 messages.append(response_message)
                 print("No queries or answer. Continue with next iteration.")
                 continue
+        save_transcript()
         return messages[-1]["content"], messages
 
 class CustomStoppingCriteria(StoppingCriteria):
+    '''
+    Stops each batch row once its generated text contains one of stop_words. Only a rolling window of the newest
+    tokens is decoded at each step, sized by the stop words' token lengths rather than their characters:
+    byte-fallback tokens can each carry a fraction of a multi-byte character. The margin covers tokens straddling
+    the stop word's ends
+    '''
     def __init__(self, stop_words, tokenizer, input_len=0):
         super().__init__()
         self.tokenizer = tokenizer
         self.stops_words = stop_words
         self.input_len = input_len
+        self.window = max(len(tokenizer.encode(stop, add_special_tokens=False)) for stop in stop_words) + 2
+        self.done = None
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
-        tokens = self.tokenizer.decode(input_ids[0][self.input_len:])
-        return any(stop in tokens for stop in self.stops_words)
\ No newline at end of file
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        # one flag per batch row, so each row of a batched generation stops on its own
+        start = max(self.input_len, input_ids.shape[1] - self.window)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:])
+        stopped = torch.tensor([any(stop in tokens for stop in self.stops_words) for tokens in tails], dtype=torch.bool, device=input_ids.device)
+        if self.done is None or self.done.shape != stopped.shape:
+            self.done = stopped
+        else:
+            self.done = self.done | stopped
+        return self.done
\ No newline at end of file
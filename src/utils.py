@@ -3,10 +3,20 @@ from sentence_transformers.models import Transformer, Pooling
 from sentence_transformers import SentenceTransformer
 import faiss
 import json
+import hashlib
+import bisect
 import torch
 import tqdm
 import numpy as np
 import os
+import re
+import sys
+import copy
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 
 corpus_names = {
@@ -99,13 +109,8 @@ def embed(chunk_dir, index_dir, model_name, **kwarg):
         embed_chunks = model.encode([""], **kwarg)
     return embed_chunks.shape[-1]
 
-def construct_index(index_dir, model_name, h_dim=768, HNSW=False, M=32):
-
-    with open(os.path.join(index_dir, "metadatas.jsonl"), 'w') as f:
-        f.write("")
-    
+def new_index(model_name, h_dim=768, HNSW=False, M=32):
     if HNSW:
-        M = M
         if "specter" in model_name.lower():
             index = faiss.IndexHNSWFlat(h_dim, M)
         else:
@@ -116,28 +121,596 @@ def construct_index(index_dir, model_name, h_dim=768, HNSW=False, M=32):
             index = faiss.IndexFlatL2(h_dim)
         else:
             index = faiss.IndexFlatIP(h_dim)
+    return index
+
+def construct_index(index_dir, model_name, h_dim=768, HNSW=False, M=32, n_shards=1):
+    '''
+    n_shards > 1 splits the corpus into shard_<i>.index files holding contiguous row ranges of (almost) equal size,
+    described by shards.json, instead of a single faiss.index; metadatas.jsonl keeps the global row order either way
+    '''
 
-    for fname in tqdm.tqdm(sorted(os.listdir(os.path.join(index_dir, "embedding")))):
+    with open(os.path.join(index_dir, "metadatas.jsonl"), 'w') as f:
+        f.write("")
+
+    fnames = sorted(os.listdir(os.path.join(index_dir, "embedding")))
+    # shards split the rows, not the embedding files, so a corpus of a few large files is still balanced
+    n_total = sum(np.load(os.path.join(index_dir, "embedding", fname), mmap_mode='r').shape[0] for fname in fnames)
+    if n_shards > max(n_total, 1):
+        raise ValueError("Cannot split {:d} embeddings into {:d} shards".format(n_total, n_shards))
+    bounds = [n_total * i // n_shards for i in range(n_shards + 1)] # first row of each shard, then the end
+    indexes = [new_index(model_name, h_dim=h_dim, HNSW=HNSW, M=M) for _ in range(n_shards)]
+
+    row = 0
+    for fname in tqdm.tqdm(fnames):
         curr_embed = np.load(os.path.join(index_dir, "embedding", fname))
-        index.add(curr_embed)
+        for shard_id, index in enumerate(indexes):
+            start, end = max(bounds[shard_id], row), min(bounds[shard_id + 1], row + len(curr_embed))
+            if start < end:
+                index.add(curr_embed[start - row:end - row])
+        row += len(curr_embed)
         with open(os.path.join(index_dir, "metadatas.jsonl"), 'a+') as f:
             f.write("\n".join([json.dumps({'index': i, 'source': fname.replace(".npy", "")}) for i in range(len(curr_embed))]) + '\n')
 
-    faiss.write_index(index, os.path.join(index_dir, "faiss.index"))
-    return index
+    if n_shards == 1:
+        faiss.write_index(indexes[0], os.path.join(index_dir, "faiss.index"))
+        return indexes[0]
+
+    offsets = bounds[:-1]
+    for i, index in enumerate(indexes):
+        faiss.write_index(index, os.path.join(index_dir, "shard_{:d}.index".format(i)))
+    with open(os.path.join(index_dir, "shards.json"), 'w') as f:
+        json.dump({"n_shards": n_shards, "offsets": offsets, "ntotal": sum(index.ntotal for index in indexes)}, f, indent=4)
+    return ShardedIndex([LocalShard(index) for index in indexes], offsets)
+
+
+def read_index_mmap(path):
+    '''
+    faiss.read_index with the vectors memory-mapped from path where the index type and faiss version allow it
+    (flat codes: IO_FLAG_MMAP_IFC, inverted lists: IO_FLAG_MMAP), so processes on a host share the pages and
+    only the parts searched are read; else the index is read into memory
+    '''
+    candidates = [faiss.IO_FLAG_MMAP]
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        candidates = [faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC, faiss.IO_FLAG_MMAP_IFC] + candidates
+    for flags in candidates:
+        try:
+            return faiss.read_index(path, flags | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError: # e.g. IVF inverted lists cannot be mapped together with flat codes
+            continue
+    return faiss.read_index(path)
+
+
+class LocalShard:
+    '''
+    Shard searched in a worker thread of the calling process (faiss releases the GIL during search)
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.d = index.d
+        self.ntotal = index.ntotal
+        self.metric_type = index.metric_type
+
+    def search(self, x, k):
+        return self.index.search(x, k)
+
+    def close(self):
+        pass
+
+
+def serve_shard(index_path, address, authkey):
+    '''
+    Serve one shard index over a multiprocessing connection; run on another host (or in a local process) and
+    point RemoteShard / Retriever(shard_addresses=...) at its address. Requests are unpickled, so authkey must be
+    a non-empty secret shared with the clients
+    '''
+    from multiprocessing.connection import Listener
+    if not authkey:
+        raise ValueError("serve_shard needs a non-empty authkey (e.g. MEDRAG_SHARD_AUTHKEY)")
+    index = read_index_mmap(index_path)
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                if request[0] == "info":
+                    conn.send((index.d, index.ntotal, index.metric_type))
+                elif request[0] == "search":
+                    conn.send(index.search(request[1], request[2]))
+
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            threading.Thread(target=handle, args=(listener.accept(),), daemon=True).start()
+
+
+class RemoteShard:
+    '''
+    Shard searched by a serve_shard process, possibly on another host
+    '''
+
+    def __init__(self, address, authkey, process=None, retries=50):
+        from multiprocessing.connection import Client
+        if not authkey:
+            raise ValueError("RemoteShard needs a non-empty authkey (e.g. MEDRAG_SHARD_AUTHKEY)")
+        for attempt in range(retries): # a freshly started server may not be listening yet
+            try:
+                self.conn = Client(address, authkey=authkey)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                if attempt == retries - 1:
+                    raise
+                time.sleep(0.1)
+        self.process = process
+        self.lock = threading.Lock()
+        self.conn.send(("info",))
+        self.d, self.ntotal, self.metric_type = self.conn.recv()
+
+    def search(self, x, k):
+        with self.lock:
+            self.conn.send(("search", x, k))
+            return self.conn.recv()
+
+    def close(self):
+        self.conn.close()
+        if self.process is not None:
+            self.process.terminate()
+
+
+class ShardedIndex:
+    '''
+    Scatter-gather search over shards holding contiguous row ranges of one corpus. Every shard returns its own
+    top-k, so merging them gives exactly the top-k of the unsharded index. Mimics the faiss search interface.
+    '''
+
+    def __init__(self, shards, offsets, max_workers=None):
+        self.shards = shards
+        self.offsets = offsets
+        self.d = shards[0].d
+        self.ntotal = sum(shard.ntotal for shard in shards)
+        self.metric_type = shards[0].metric_type
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(shards))
+
+    @classmethod
+    def load(cls, index_dir, workers="thread", addresses=None, authkey=None):
+        '''
+        workers: "thread" searches the shards in worker threads, "process" serves each shard from a local
+        process through the same transport used for remote shards; addresses (one per shard) connects to
+        serve_shard processes that are already running, e.g. on other hosts, with authkey (default:
+        MEDRAG_SHARD_AUTHKEY), which must be set. Local processes use a random key of their own
+        '''
+        info = json.load(open(os.path.join(index_dir, "shards.json")))
+        paths = [os.path.join(index_dir, "shard_{:d}.index".format(i)) for i in range(info["n_shards"])]
+        if addresses is not None:
+            authkey = authkey or os.getenv("MEDRAG_SHARD_AUTHKEY", "").encode()
+            shards = [RemoteShard(tuple(address) if isinstance(address, list) else address, authkey) for address in addresses]
+        elif workers == "process":
+            import tempfile
+            import multiprocessing
+            authkey = os.urandom(16)
+            socket_dir = tempfile.mkdtemp(prefix="medrag_shards_")
+            shards = []
+            for i, path in enumerate(paths):
+                address = os.path.join(socket_dir, "shard_{:d}.sock".format(i))
+                process = multiprocessing.Process(target=serve_shard, args=(path, address, authkey), daemon=True)
+                process.start()
+                shards.append(RemoteShard(address, authkey, process=process, retries=600))
+        else:
+            shards = [LocalShard(read_index_mmap(path)) for path in paths]
+        assert len(shards) == info["n_shards"]
+        return cls(shards, info["offsets"])
+
+    def search(self, x, k):
+        results = list(self.executor.map(lambda shard: shard.search(x, k), self.shards))
+        D = np.concatenate([D for D, _ in results], axis=1)
+        I = np.concatenate([np.where(I >= 0, I + offset, -1) for (_, I), offset in zip(results, self.offsets)], axis=1)
+        if self.metric_type == faiss.METRIC_INNER_PRODUCT:
+            order = np.argsort(-np.where(I >= 0, D, -np.inf), axis=1, kind="stable")[:, :k]
+        else:
+            order = np.argsort(np.where(I >= 0, D, np.inf), axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.executor.shutdown(wait=False)
+
+
+SNAPSHOT_NAME = "snapshot.bin"
+SNAPSHOT_MAGIC = b"MEDRAGSN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGN = 4096 # the header block and every section start on a page boundary
+# files of an index directory a snapshot is built from: if any of them changes, the snapshot is stale
+SNAPSHOT_SOURCES = ("faiss.index", "metadatas.jsonl", "shards.json")
+# MEDRAG_SNAPSHOT=on bundles every single-file dense index without a snapshot into one when it is first loaded
+MEDRAG_SNAPSHOT = os.getenv("MEDRAG_SNAPSHOT", "off").lower() == "on"
+
+def source_stats(index_dir):
+    # (size, mtime in ns) of the SNAPSHOT_SOURCES present in index_dir
+    stats = {}
+    for name in SNAPSHOT_SOURCES:
+        path = os.path.join(index_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def build_snapshot(index_dir, chunk_dir, save_path=None, corpus_name="", retriever_name=""):
+    '''
+    Pack faiss.index, metadatas.jsonl and the referenced chunk/*.jsonl snippets into one file
+    Layout: [magic | version (u32) | header length (u32) | JSON header] padded to 4096 bytes, then the
+    sections "index", "sources", "metadata", "snippets" and "offsets", each page aligned
+    '''
+    if save_path is None:
+        save_path = os.path.join(index_dir, SNAPSHOT_NAME)
+    if not os.path.exists(os.path.join(index_dir, "faiss.index")):
+        raise ValueError("build_snapshot needs a single faiss.index, sharded indexes are not bundled: {:s}".format(index_dir))
+    built_from = source_stats(index_dir)
+    index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    metadatas = [json.loads(line) for line in open(os.path.join(index_dir, "metadatas.jsonl")).read().strip().split('\n')]
+    assert len(metadatas) == index.ntotal
+
+    sources = sorted(set(item["source"] for item in metadatas))
+    source_ids = {source: i for i, source in enumerate(sources)}
+    metadata = np.array([[source_ids[item["source"]], item["index"]] for item in metadatas], dtype=np.int64)
+
+    checksum = hashlib.sha256()
+    sections = {}
+    tmp_path = save_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b"\0" * SNAPSHOT_ALIGN)
+
+        def write_section(name, chunks):
+            f.write(b"\0" * (-f.tell() % SNAPSHOT_ALIGN))
+            start = f.tell()
+            for chunk in chunks:
+                chunk = bytes(chunk)
+                checksum.update(chunk)
+                f.write(chunk)
+            sections[name] = [start, f.tell() - start]
+
+        write_section("index", [faiss.serialize_index(index)])
+        write_section("sources", [json.dumps(sources).encode("utf-8")])
+        write_section("metadata", [metadata.tobytes()])
+
+        # snippets are streamed in faiss row order; rows of one chunk file are contiguous, so each file is read once
+        offsets = np.zeros(len(metadatas) + 1, dtype=np.int64)
+
+        def iter_snippets():
+            curr_source, curr_lines = None, None
+            for i, item in enumerate(tqdm.tqdm(metadatas)):
+                if item["source"] != curr_source:
+                    curr_source = item["source"]
+                    curr_lines = open(os.path.join(chunk_dir, curr_source + ".jsonl")).read().strip().split('\n')
+                snippet = json.loads(curr_lines[item["index"]])
+                _ = snippet.pop("contents", None)
+                snippet = json.dumps(snippet).encode("utf-8")
+                offsets[i + 1] = offsets[i] + len(snippet)
+                yield snippet
+
+        write_section("snippets", iter_snippets())
+        write_section("offsets", [offsets.tobytes()])
+
+        header = json.dumps({
+            "version": SNAPSHOT_VERSION,
+            "corpus_name": corpus_name,
+            "retriever_name": retriever_name,
+            "ntotal": index.ntotal,
+            "dim": index.d,
+            "metric_type": index.metric_type,
+            "sections": sections,
+            "checksum": checksum.hexdigest(),
+            "built_from": built_from,
+        }).encode("utf-8")
+        assert len(SNAPSHOT_MAGIC) + 8 + len(header) <= SNAPSHOT_ALIGN
+        f.seek(0)
+        f.write(SNAPSHOT_MAGIC + np.array([SNAPSHOT_VERSION, len(header)], dtype="<u4").tobytes() + header)
+    os.replace(tmp_path, save_path)
+    return save_path
+
+
+class IndexSnapshot:
+    '''
+    Read-only view of a bundle written by build_snapshot. Opening only parses the header; metadata
+    and snippets are served from the memory map and the faiss index is deserialized on first access.
+    '''
+
+    def __init__(self, path, verify=False):
+        self.path = path
+        self._mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._mmap[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+            raise ValueError("{:s} is not an index snapshot".format(path))
+        version, header_len = np.frombuffer(self._mmap, dtype="<u4", count=2, offset=len(SNAPSHOT_MAGIC)).tolist()
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version {:d} in {:s}".format(version, path))
+        start = len(SNAPSHOT_MAGIC) + 8
+        self.header = json.loads(bytes(self._mmap[start:start + header_len]))
+        self.metadata = self._section("metadata").view(np.int64).reshape(-1, 2)
+        self.offsets = self._section("offsets").view(np.int64)
+        self.snippets = self._section("snippets")
+        self._sources = None
+        self._first_rows = None
+        self._index = None
+        if verify:
+            self.verify()
+
+    def _section(self, name):
+        start, length = self.header["sections"][name]
+        return self._mmap[start:start + length]
+
+    @property
+    def sources(self):
+        if self._sources is None:
+            self._sources = json.loads(bytes(self._section("sources")))
+        return self._sources
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.load_index()
+        return self._index
+
+    def load_index(self): # uncached, so an owner that drops the index really frees it
+        section = self._section("index")
+        if hasattr(faiss, "ZeroCopyIOReader") and hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            # flat codes are read in place from the memory map instead of being copied
+            try:
+                index = faiss.read_index(faiss.ZeroCopyIOReader(faiss.swig_ptr(section), len(section)), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+                index.referenced_objects = [section] # the map must outlive the index
+                return index
+            except RuntimeError:
+                pass
+        return faiss.deserialize_index(np.asarray(section))
+
+    def is_stale(self, index_dir):
+        '''
+        Whether a file of index_dir changed since the snapshot was built from it: its size or mtime differ from those
+        in the header (snapshots without them: it is newer than the snapshot). Files that are absent, as in a
+        directory shipped with the snapshot alone, are not compared
+        '''
+        built_from = self.header.get("built_from")
+        if built_from is None:
+            mtime = os.stat(self.path).st_mtime_ns
+            return any(mtime_ns > mtime for _, mtime_ns in source_stats(index_dir).values())
+        return any(built_from.get(name) != stat for name, stat in source_stats(index_dir).items())
+
+    def verify(self):
+        checksum = hashlib.sha256()
+        for name in ("index", "sources", "metadata", "snippets", "offsets"):
+            checksum.update(memoryview(self._section(name)))
+        if checksum.hexdigest() != self.header["checksum"]:
+            raise ValueError("Checksum mismatch in {:s}".format(self.path))
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def verify_once(self):
+        '''
+        verify() the first time this file is opened: a file that passed is recorded in <path>.verified with its size
+        and mtime, so later opens (e.g. every worker process) do not read it all again
+        '''
+        try:
+            with open(self.path + ".verified") as f:
+                if json.load(f) == self._stamp():
+                    return
+        except (OSError, ValueError):
+            pass
+        self.verify()
+        self.mark_verified()
+
+    def mark_verified(self): # e.g. right after build_snapshot wrote it
+        with open(self.path + ".verified", 'w') as f:
+            json.dump(self._stamp(), f)
+
+    def __len__(self):
+        return self.header["ntotal"]
+
+    def __getitem__(self, i): # same records as metadatas.jsonl
+        return {"index": int(self.metadata[i][1]), "source": self.sources[self.metadata[i][0]]}
+
+    def get_snippets(self, rows):
+        return [json.loads(bytes(self.snippets[self.offsets[i]:self.offsets[i + 1]])) for i in rows]
+
+    def find(self, source, index):
+        '''
+        Row of the snippet at line index of chunk file source, or None
+        '''
+        position = bisect.bisect_left(self.sources, source)
+        if position == len(self.sources) or self.sources[position] != source:
+            return None
+        if self._first_rows is None:
+            # the rows of a chunk file are contiguous and in line order (see build_snapshot)
+            source_ids, rows = np.unique(self.metadata[:, 0], return_index=True)
+            self._first_rows = dict(zip(source_ids.tolist(), rows.tolist()))
+        row = self._first_rows[position] + index
+        if row < len(self) and self.metadata[row].tolist() == [position, index]:
+            return row
+        rows = np.nonzero((self.metadata[:, 0] == position) & (self.metadata[:, 1] == index))[0]
+        return int(rows[0]) if len(rows) else None
+
+
+def parse_size(size):
+    '''
+    Parse a memory size given as a number of bytes or a string such as "512M" / "16GB"
+    '''
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size = size.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+def estimate_resident_size(obj):
+    '''
+    Rough resident size (in bytes) of the objects a Retriever keeps in memory
+    '''
+    if obj is None:
+        return 0
+    if isinstance(obj, tuple):
+        return sum(estimate_resident_size(item) for item in obj)
+    if isinstance(obj, list): # metadatas.jsonl records, sized from a sample
+        if len(obj) == 0:
+            return 0
+        sample = obj[:100]
+        return len(obj) * sum(sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item.values()) for item in sample) // len(sample)
+    if isinstance(obj, torch.nn.Module):
+        return sum(p.numel() * p.element_size() for p in obj.parameters()) + sum(b.numel() * b.element_size() for b in obj.buffers())
+    if isinstance(obj, faiss.Index):
+        size = obj.ntotal * obj.d * 4
+        hnsw = getattr(obj, "hnsw", None)
+        if hnsw is not None:
+            size += hnsw.neighbors.size() * 4
+        return size
+    if isinstance(obj, ShardedIndex):
+        size = 0
+        for shard in obj.shards:
+            if isinstance(shard, LocalShard):
+                size += estimate_resident_size(shard.index)
+            elif getattr(shard, "process", None) is not None: # served by a process on this host
+                size += shard.ntotal * shard.d * 4
+        return size # shards served from other hosts are resident there
+    return 0 # memory-mapped snapshots and Lucene indexes live in the page cache
+
+
+def release(obj):
+    '''
+    Close what an evicted resource holds open (e.g. the serve_shard processes and threads of a ShardedIndex)
+    '''
+    for item in obj if isinstance(obj, tuple) else (obj,):
+        close = getattr(item, "close", None)
+        if callable(close):
+            close()
+
+
+def load_encoder(model_name):
+    if "contriever" in model_name.lower():
+        encoder = SentenceTransformer(model_name, device="cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        encoder = CustomizeSentenceTransformer(model_name, device="cuda" if torch.cuda.is_available() else "cpu")
+    encoder.eval()
+    return encoder
+
+
+class ResourceManager:
+    '''
+    Load indexes and encoders on first use and keep their total resident size under memory_budget
+    (bytes, None for unlimited) by evicting the least-recently-used ones. A resource used through borrow() is only
+    closed once the last borrower returns it, so evicting it never pulls it from under a running search
+    '''
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = parse_size(memory_budget)
+        self.resources = OrderedDict() # key -> (resource, size)
+        self.resident_size = 0
+        self.borrowers = {} # id(resource) -> number of borrow() calls using it
+        self.evicted = {} # id(resource) -> resource evicted while borrowed, released by the last borrower
+        self.lock = threading.RLock()
+
+    def get(self, key, loader, sizer=estimate_resident_size):
+        with self.lock:
+            if key in self.resources:
+                self.resources.move_to_end(key)
+                return self.resources[key][0]
+            resource = loader()
+            size = sizer(resource)
+            self.resources[key] = (resource, size)
+            self.resident_size += size
+            self.evict(keep=key)
+            return resource
+
+    @contextmanager
+    def borrow(self, key, loader, sizer=estimate_resident_size):
+        '''
+        get() for the duration of a with block
+        '''
+        with self.lock:
+            resource = self.get(key, loader, sizer)
+            self.borrowers[id(resource)] = self.borrowers.get(id(resource), 0) + 1
+        try:
+            yield resource
+        finally:
+            with self.lock:
+                self.borrowers[id(resource)] -= 1
+                if self.borrowers[id(resource)] == 0:
+                    del self.borrowers[id(resource)]
+                    if id(resource) in self.evicted:
+                        release(self.evicted.pop(id(resource)))
+
+    def evict(self, keep=None):
+        with self.lock:
+            evicted = False
+            for key in list(self.resources.keys()):
+                if self.memory_budget is None or self.resident_size <= self.memory_budget:
+                    break
+                # resources of size 0 (memory-mapped snapshots, Lucene indexes) free nothing by being evicted
+                if key == keep or self.resources[key][1] == 0:
+                    continue
+                resource, size = self.resources.pop(key)
+                self.resident_size -= size
+                if id(resource) in self.borrowers:
+                    self.evicted[id(resource)] = resource
+                else:
+                    release(resource)
+                evicted = True
+                print("Evicted {:s} ({:.1f} MB) to stay within the memory budget".format(str(key), size / (1 << 20)))
+            if evicted and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def set_budget(self, memory_budget):
+        self.memory_budget = parse_size(memory_budget)
+        self.evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_budget": self.memory_budget,
+                "resident_size": self.resident_size,
+                "resources": {str(key): size for key, (_, size) in self.resources.items()},
+            }
+
+_resource_manager = None
+_resource_manager_lock = threading.Lock()
+
+def get_resource_manager(memory_budget=None):
+    '''
+    Process-wide ResourceManager, so every RetrievalSystem (e.g. one per doctor) shares one budget
+    '''
+    global _resource_manager
+    with _resource_manager_lock:
+        if _resource_manager is None:
+            _resource_manager = ResourceManager(memory_budget)
+        elif memory_budget is not None:
+            _resource_manager.set_budget(memory_budget)
+    return _resource_manager
 
 
 class Retriever: 
 
-    def __init__(self, retriever_name="ncbi/MedCPT-Query-Encoder", corpus_name="textbooks", db_dir="./corpus", HNSW=False, **kwarg):
+    def __init__(self, retriever_name="ncbi/MedCPT-Query-Encoder", corpus_name="textbooks", db_dir="./corpus", HNSW=False, resource_manager=None, n_shards=1, shard_workers="thread", shard_addresses=None, make_snapshot=MEDRAG_SNAPSHOT, **kwarg):
+        '''
+        make_snapshot (bool): bundle a single-file dense index without a snapshot into one (see build_snapshot)
+        n_shards (int): number of shard indexes to build when the corpus has not been indexed yet
+        shard_workers (str): "thread" or "process", how a sharded index is searched locally
+        shard_addresses (List): addresses of serve_shard processes (one per shard) to search instead
+        '''
         self.retriever_name = retriever_name
+        self.shard_workers = shard_workers
+        self.shard_addresses = shard_addresses
         self.corpus_name = corpus_name
 
         self.db_dir = db_dir
         if not os.path.exists(self.db_dir):
             os.makedirs(self.db_dir)
         self.chunk_dir = os.path.join(self.db_dir, self.corpus_name, "chunk")
-        if not os.path.exists(self.chunk_dir):
+        self.index_dir = os.path.join(self.db_dir, self.corpus_name, "index", self.retriever_name.replace("Query-Encoder", "Article-Encoder"))
+        self.snapshot = None
+        if "bm25" not in self.retriever_name.lower() and os.path.exists(os.path.join(self.index_dir, SNAPSHOT_NAME)):
+            self.snapshot = self._load_snapshot()
+        if self.snapshot is None and not os.path.exists(self.chunk_dir):
             print("Cloning the {:s} corpus from Huggingface...".format(self.corpus_name))
             os.system("git clone https://hf-mirror.com/datasets/MedRAG/{:s} {:s}".format(corpus_name, os.path.join(self.db_dir, self.corpus_name)))
             if self.corpus_name == "statpearls":
@@ -146,21 +719,11 @@ class Retriever:
                 os.system("tar -xzvf {:s} -C {:s}".format(os.path.join(db_dir, self.corpus_name, "statpearls_NBK430685.tar.gz"), os.path.join(self.db_dir, self.corpus_name)))
                 print("Chunking the statpearls corpus...")
                 os.system("python src/data/statpearls.py")
-        self.index_dir = os.path.join(self.db_dir, self.corpus_name, "index", self.retriever_name.replace("Query-Encoder", "Article-Encoder"))
         if "bm25" in self.retriever_name.lower():
-            from pyserini.search.lucene import LuceneSearcher
-            self.metadatas = None
-            self.embedding_function = None
-            if os.path.exists(self.index_dir):
-                self.index = LuceneSearcher(os.path.join(self.index_dir))
-            else:
+            if not os.path.exists(self.index_dir):
                 os.system("python -m pyserini.index.lucene --collection JsonCollection --input {:s} --index {:s} --generator DefaultLuceneDocumentGenerator --threads 16".format(self.chunk_dir, self.index_dir))
-                self.index = LuceneSearcher(os.path.join(self.index_dir))
         else:
-            if os.path.exists(os.path.join(self.index_dir, "faiss.index")):
-                self.index = faiss.read_index(os.path.join(self.index_dir, "faiss.index"))
-                self.metadatas = [json.loads(line) for line in open(os.path.join(self.index_dir, "metadatas.jsonl")).read().strip().split('\n')]
-            else:
+            if self.snapshot is None and not os.path.exists(os.path.join(self.index_dir, "faiss.index")) and not os.path.exists(os.path.join(self.index_dir, "shards.json")):
                 print("[In progress] Embedding the {:s} corpus with the {:s} retriever...".format(self.corpus_name, self.retriever_name.replace("Query-Encoder", "Article-Encoder")))
                 if self.corpus_name in ["textbooks", "pubmed", "wikipedia"] and self.retriever_name in ["allenai/specter", "facebook/contriever", "ncbi/MedCPT-Query-Encoder"] and not os.path.exists(os.path.join(self.index_dir, "embedding")):
                     print("[In progress] Downloading the {:s} embeddings given by the {:s} model...".format(self.corpus_name, self.retriever_name.replace("Query-Encoder", "Article-Encoder")))
@@ -196,38 +759,147 @@ class Retriever:
                     h_dim = embed(chunk_dir=self.chunk_dir, index_dir=self.index_dir, model_name=self.retriever_name.replace("Query-Encoder", "Article-Encoder"), **kwarg)
 
                 print("[In progress] Embedding finished! The dimension of the embeddings is {:d}.".format(h_dim))
-                self.index = construct_index(index_dir=self.index_dir, model_name=self.retriever_name.replace("Query-Encoder", "Article-Encoder"), h_dim=h_dim, HNSW=HNSW)
+                construct_index(index_dir=self.index_dir, model_name=self.retriever_name.replace("Query-Encoder", "Article-Encoder"), h_dim=h_dim, HNSW=HNSW, n_shards=n_shards)
                 print("[Finished] Corpus indexing finished!")
-                self.metadatas = [json.loads(line) for line in open(os.path.join(self.index_dir, "metadatas.jsonl")).read().strip().split('\n')]            
-            if "contriever" in self.retriever_name.lower():
-                self.embedding_function = SentenceTransformer(self.retriever_name, device="cuda" if torch.cuda.is_available() else "cpu")
-            else:
-                self.embedding_function = CustomizeSentenceTransformer(self.retriever_name, device="cuda" if torch.cuda.is_available() else "cpu")
-            self.embedding_function.eval()
+            if make_snapshot and self.snapshot is None and os.path.exists(os.path.join(self.index_dir, "faiss.index")) and os.path.exists(self.chunk_dir):
+                print("[In progress] Bundling the {:s} index into a snapshot...".format(self.corpus_name))
+                self.snapshot = self._build_snapshot()
 
-    def get_relevant_documents(self, question, k=3, id_only=False, **kwarg):
-        assert type(question) == str
-        question = [question]
+        # with a resource manager the index and encoder are only loaded on first use and may be evicted later
+        self.resource_manager = resource_manager
+        self._index, self._metadatas, self._embedding_function = None, None, None
+        if self.resource_manager is None:
+            self._index, self._metadatas = self._load_index()
+            self._embedding_function = self._load_embedding_function()
 
-        if "bm25" in self.retriever_name.lower():
-            res_ = [[]]
-            hits = self.index.search(question[0], k=k)
-            res_[0].append(np.array([h.score for h in hits]))
-            ids = [h.docid for h in hits]
-            indices = [{"source": '_'.join(h.docid.split('_')[:-1]), "index": eval(h.docid.split('_')[-1])} for h in hits]
+    def _load_snapshot(self):
+        # the snapshot, verified on first open and rebuilt if it is corrupt or the index changed since it was built;
+        # None if it cannot be used and cannot be rebuilt here
+        path = os.path.join(self.index_dir, SNAPSHOT_NAME)
+        snapshot = IndexSnapshot(path)
+        if snapshot.is_stale(self.index_dir):
+            problem = "is out of date with the index"
         else:
-            with torch.no_grad():
-                query_embed = self.embedding_function.encode(question, **kwarg)
-            res_ = self.index.search(query_embed, k=k)
-            ids = ['_'.join([self.metadatas[i]["source"], str(self.metadatas[i]["index"])]) for i in res_[1][0]]
-            indices = [self.metadatas[i] for i in res_[1][0]]
+            try:
+                snapshot.verify_once()
+                return snapshot
+            except ValueError:
+                problem = "is corrupt (checksum mismatch)"
+        if not os.path.exists(os.path.join(self.index_dir, "faiss.index")) or not os.path.exists(self.chunk_dir):
+            if problem.startswith("is corrupt") and not os.path.exists(os.path.join(self.index_dir, "metadatas.jsonl")):
+                raise ValueError("{:s} {:s} and there is no index to search instead".format(path, problem))
+            print("[Warning] {:s} {:s} and cannot be rebuilt here, searching the index instead".format(path, problem))
+            return None
+        print("[In progress] {:s} {:s}, rebuilding it...".format(path, problem))
+        return self._build_snapshot()
 
-        scores = res_[0][0].tolist()
-        
-        if id_only:
-            return [{"id":i} for i in ids], scores
+    def _build_snapshot(self):
+        path = build_snapshot(self.index_dir, self.chunk_dir, corpus_name=self.corpus_name, retriever_name=self.retriever_name)
+        snapshot = IndexSnapshot(path)
+        snapshot.mark_verified()
+        return snapshot
+
+    def _load_index(self):
+        if "bm25" in self.retriever_name.lower():
+            from pyserini.search.lucene import LuceneSearcher
+            return LuceneSearcher(os.path.join(self.index_dir)), None
+        elif self.snapshot is not None:
+            return self.snapshot.load_index(), self.snapshot
         else:
-            return self.idx2txt(indices), scores
+            if os.path.exists(os.path.join(self.index_dir, "shards.json")):
+                index = ShardedIndex.load(self.index_dir, workers=self.shard_workers, addresses=self.shard_addresses)
+            else:
+                index = read_index_mmap(os.path.join(self.index_dir, "faiss.index"))
+            metadatas = [json.loads(line) for line in open(os.path.join(self.index_dir, "metadatas.jsonl")).read().strip().split('\n')]
+            return index, metadatas
+
+    def _load_embedding_function(self):
+        if "bm25" in self.retriever_name.lower():
+            return None
+        return load_encoder(self.retriever_name)
+
+    def _get_index(self):
+        if self.resource_manager is None:
+            return self._index, self._metadatas
+        return self.resource_manager.get(("index", self.index_dir), self._load_index)
+
+    def _borrow_index(self):
+        # the index and metadatas, kept open until the with block ends even if they are evicted meanwhile
+        if self.resource_manager is None:
+            return nullcontext((self._index, self._metadatas))
+        return self.resource_manager.borrow(("index", self.index_dir), self._load_index)
+
+    @property
+    def index(self):
+        return self._get_index()[0]
+
+    @property
+    def metadatas(self):
+        return self._get_index()[1]
+
+    @property
+    def embedding_function(self):
+        if self.resource_manager is None or "bm25" in self.retriever_name.lower():
+            return self._embedding_function
+        # encoders only depend on the model, so all corpora share one copy
+        return self.resource_manager.get(("encoder", self.retriever_name), self._load_embedding_function)
+
+    def get_relevant_documents(self, question, k=3, id_only=False, query_embed=None, **kwarg):
+        assert type(question) == str
+        return self.get_relevant_documents_batch([question], k=k, id_only=id_only, query_embeds=query_embed, **kwarg)[0]
+
+    def get_relevant_documents_batch(self, questions, k=3, id_only=False, query_embeds=None, **kwarg):
+        '''
+        get_relevant_documents for a list of questions in one search: BM25 runs one batch_search, dense retrievers
+        search the matrix of query embeddings (query_embeds, one row per question, encoded here if not given)
+        in one index.search call. Returns (texts, scores) per question
+        '''
+        with self._borrow_index() as (index, metadatas):
+            if "bm25" in self.retriever_name.lower():
+                if len(questions) == 1:
+                    hits_list = [index.search(questions[0], k=k)]
+                else:
+                    qids = [str(q) for q in range(len(questions))]
+                    hits = index.batch_search(questions, qids, k=k, threads=min(len(questions), os.cpu_count() or 1))
+                    hits_list = [hits[qid] for qid in qids]
+                res_ = []
+                for hits in hits_list:
+                    ids = [h.docid for h in hits]
+                    # only "<source>_<index>" ids name a chunk line, so PubMed ids are only served id-only
+                    indices = None if id_only else [{"source": '_'.join(h.docid.split('_')[:-1]), "index": eval(h.docid.split('_')[-1])} for h in hits]
+                    res_.append(([h.score for h in hits], ids, indices, None))
+            else:
+                if query_embeds is None:
+                    with torch.no_grad():
+                        query_embeds = self.embedding_function.encode(questions, **kwarg)
+                D, I = index.search(query_embeds, k=k)
+                res_ = []
+                for scores, rows in zip(D, I):
+                    ids = ['_'.join([metadatas[i]["source"], str(metadatas[i]["index"])]) for i in rows]
+                    indices = [metadatas[i] for i in rows]
+                    res_.append((scores.tolist(), ids, indices, rows))
+
+        results = []
+        for scores, ids, indices, rows in res_:
+            if id_only:
+                results.append(([{"id":i} for i in ids], scores))
+            elif self.snapshot is not None:
+                results.append((self.snapshot.get_snippets(rows), scores))
+            else:
+                results.append((self.idx2txt(indices), scores))
+        return results
+
+    def fetch(self, source, index):
+        '''
+        The snippet at line index of chunk file source, or None if it is not part of this corpus
+        '''
+        if os.path.exists(os.path.join(self.chunk_dir, source + ".jsonl")):
+            return self.idx2txt([{"source": source, "index": index}])[0]
+        if self.snapshot is not None:
+            row = self.snapshot.find(source, index)
+            if row is not None:
+                return self.snapshot.get_snippets([row])[0]
+        return None
 
     def idx2txt(self, indices): # return List of Dict of str
         '''
@@ -252,53 +924,364 @@ class Retriever:
         
         
 
+class SemanticQueryCache:
+    '''
+    Approximate retrieval cache: a query whose embedding has cosine similarity >= threshold with a cached
+    query retrieved with the same parameters is served the cached result instead of searching the corpus.
+    Cached queries live in a small in-memory faiss index; least-recently-used entries are evicted beyond max_size.
+    '''
+
+    def __init__(self, encoder, threshold=0.95, max_size=1024, n_probe=8, near_miss_margin=0.05):
+        self.encoder = encoder # callable: str -> np.ndarray of shape (1, dim)
+        self.threshold = threshold
+        self.max_size = max_size
+        self.n_probe = n_probe
+        self.near_miss_margin = near_miss_margin
+        self.index = None
+        self.entries = OrderedDict() # id -> (params, result)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.lookups, self.hits, self.near_misses, self.hit_similarity = 0, 0, 0, 0.0
+
+    def embed(self, question, query_embed=None):
+        # query_embed: the question's embedding if the caller already has it
+        if query_embed is None:
+            query_embed = self.encoder(question)
+        query_embed = np.asarray(query_embed, dtype=np.float32)
+        normed = query_embed.copy()
+        faiss.normalize_L2(normed)
+        return query_embed, normed
+
+    def lookup(self, normed, params):
+        with self.lock:
+            self.lookups += 1
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            sims, ids = self.index.search(normed, min(self.n_probe, self.index.ntotal))
+            best = None
+            for sim, i in zip(sims[0].tolist(), ids[0].tolist()):
+                if i == -1 or self.entries[i][0] != params:
+                    continue
+                best = sim # results are sorted, so the first entry with matching params is the closest one
+                if sim >= self.threshold:
+                    self.hits += 1
+                    self.hit_similarity += sim
+                    self.entries.move_to_end(i)
+                    return copy.deepcopy(self.entries[i][1])
+                break
+            if best is not None and best >= self.threshold - self.near_miss_margin:
+                self.near_misses += 1
+            return None
+
+    def insert(self, normed, params, result):
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(normed.shape[-1]))
+            self.index.add_with_ids(normed, np.array([self.next_id], dtype=np.int64))
+            self.entries[self.next_id] = (params, copy.deepcopy(result))
+            self.next_id += 1
+            while len(self.entries) > self.max_size:
+                i, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([i], dtype=np.int64))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "threshold": self.threshold,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "mean_hit_similarity": self.hit_similarity / self.hits if self.hits else None,
+                "near_misses": self.near_misses, # best match within near_miss_margin below the threshold
+            }
+
+_query_caches = {}
+_query_caches_lock = threading.Lock()
+
+def get_query_cache(key, encoder, threshold=0.95, max_size=1024):
+    '''
+    Process-wide SemanticQueryCache per (retriever, corpus), shared by all RetrievalSystem instances
+    '''
+    with _query_caches_lock:
+        if key not in _query_caches:
+            _query_caches[key] = SemanticQueryCache(encoder, threshold=threshold, max_size=max_size)
+        return _query_caches[key]
+
+
+def minhash_signature(text, num_perm=64, shingle_size=5):
+    '''
+    MinHash signature of the word shingles of text, using multiply-add hashes modulo 2^64
+    '''
+    words = re.findall(r"\w+", text.lower())
+    shingles = set(" ".join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1)))
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in shingles], dtype=np.uint64)
+    rng = np.random.default_rng(0) # fixed seed so signatures are comparable across calls
+    a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        return (hashes[None, :] * a[:, None] + b[:, None]).min(axis=1)
+
+def split_chunk_id(snippet_id):
+    '''
+    "<source>_<i>" ids (textbooks, statpearls, wikipedia) -> (source, i); None for e.g. PubMed ids
+    '''
+    source, _, index = snippet_id.rpartition('_')
+    if source == "" or not index.isdigit():
+        return None
+    return source, int(index)
+
+def merge_overlapping(first, second, max_overlap=400, min_overlap=20):
+    '''
+    Join two consecutive chunks, dropping the text the splitter repeated at the start of the second one;
+    None if they do not overlap (e.g. neighbouring StatPearls sections), so they stay separate snippets
+    '''
+    for n in range(min(len(first), len(second), max_overlap), min_overlap - 1, -1):
+        if first.endswith(second[:n]):
+            return first + second[n:]
+    return None
+
+def dedup_snippets(snippets, scores=None, k=None, threshold=0.8, num_perm=64, shingle_size=5, merge_adjacent=True, fetch=None):
+    '''
+    Collapse redundant snippets before they are formatted into the context
+    Consecutive chunks of one source whose texts overlap are merged into the higher-ranked snippet, and snippets
+    whose estimated shingle Jaccard similarity with a kept snippet reaches threshold are dropped. Rank order is kept,
+    and the freed slots are backfilled from the lower-ranked candidates, so pass more than k snippets.
+    fetch turns an id-only candidate into the full snippet and is only called for snippets considered.
+    Returns (snippets, scores) with at most k entries
+    '''
+    scores = scores if scores else [None] * len(snippets)
+    k = len(snippets) if k is None else k
+    kept, kept_scores, signatures, spans = [], [], [], []
+    for snippet, score in zip(snippets, scores):
+        if len(kept) >= k:
+            break
+        if fetch is not None:
+            snippet = fetch(snippet)
+        chunk = split_chunk_id(snippet["id"]) if merge_adjacent and "id" in snippet else None
+        if chunk is not None:
+            source, index = chunk
+            merged = False
+            for i, (span_source, lo, hi) in enumerate(spans):
+                if span_source == source and lo <= index <= hi: # already covered by a merged snippet
+                    merged = True
+                elif span_source == source and index in (lo - 1, hi + 1):
+                    if index == hi + 1:
+                        content = merge_overlapping(kept[i]["content"], snippet["content"])
+                    else:
+                        content = merge_overlapping(snippet["content"], kept[i]["content"])
+                    if content is not None:
+                        kept[i] = dict(kept[i], content=content)
+                        spans[i] = (source, min(lo, index), max(hi, index))
+                        signatures[i] = minhash_signature(content, num_perm, shingle_size)
+                        merged = True
+                if merged:
+                    break
+            if merged:
+                continue
+        signature = minhash_signature(snippet["content"], num_perm, shingle_size)
+        if any(np.mean(signature == other) >= threshold for other in signatures):
+            continue
+        kept.append(snippet)
+        kept_scores.append(score)
+        signatures.append(signature)
+        spans.append((chunk[0], chunk[1], chunk[1]) if chunk is not None else (None, -1, -1))
+    if all(score is None for score in kept_scores):
+        kept_scores = []
+    return kept, kept_scores
+
+
+def select_by_token_budget(snippets, scores, token_budget, count_tokens=None, score_gap=None, overhead=8, fetch=None):
+    '''
+    Take ranked snippets until the next one would exceed token_budget, or until the score drops by more than
+    score_gap between consecutive ranks
+    Token counts come from the "n_tokens" field of corpora chunked locally by src/data (the corpora cloned from
+    Huggingface have none); count_tokens(text) (default: ~4 characters per token) is called for snippets without it. overhead covers the "Document [i] (Title: ...)"
+    formatting. fetch turns an id-only candidate into the full snippet and is only called for snippets considered.
+    '''
+    count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+    selected, selected_scores, used = [], [], 0
+    for i, snippet in enumerate(snippets):
+        if score_gap is not None and scores and i > 0 and abs(scores[i - 1] - scores[i]) > score_gap:
+            break
+        if fetch is not None:
+            snippet = fetch(snippet)
+        n_tokens = snippet.get("n_tokens")
+        if n_tokens is None:
+            n_tokens = count_tokens(concat(snippet["title"], snippet["content"]))
+        if used + n_tokens + overhead > token_budget:
+            break
+        used += n_tokens + overhead
+        selected.append(snippet)
+        if scores:
+            selected_scores.append(scores[i])
+    return selected, selected_scores
+
+
 class RetrievalSystem:
 
-    def __init__(self, retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus", HNSW=False, cache=False):
+    def __init__(self, retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus", HNSW=False, cache=False, memory_budget=None, semantic_cache_threshold=None, semantic_cache_size=1024, n_shards=1, shard_workers="thread", shard_addresses=None, make_snapshot=MEDRAG_SNAPSHOT):
+        '''
+        memory_budget (int or str): if set (or MEDRAG_MEMORY_BUDGET is), indexes and encoders are loaded on first use
+            and the least-recently-used ones are evicted to stay within the budget, e.g. "24GB"
+        semantic_cache_threshold (float): if set (or MEDRAG_SEMANTIC_CACHE_THRESHOLD is), queries whose embedding is at
+            least this similar to an earlier query reuse its result; semantic_cache_size bounds the number of entries
+        n_shards (int), shard_workers (str): build dense indexes as n_shards shards searched by threads or processes
+        shard_addresses (Dict): addresses of the serve_shard processes (one per shard) to search, by corpus
+            (e.g. "pubmed") or by (retriever, corpus) when several dense retrievers are used
+        make_snapshot (bool): bundle dense indexes without a snapshot into one when they are first loaded (MEDRAG_SNAPSHOT)
+        '''
         self.retriever_name = retriever_name
         self.corpus_name = corpus_name
         assert self.corpus_name in corpus_names
         assert self.retriever_name in retriever_names
+        memory_budget = memory_budget or os.getenv("MEDRAG_MEMORY_BUDGET")
+        self.resource_manager = get_resource_manager(memory_budget) if memory_budget else None
         self.retrievers = []
         for retriever in retriever_names[self.retriever_name]:
             self.retrievers.append([])
             for corpus in corpus_names[self.corpus_name]:
-                self.retrievers[-1].append(Retriever(retriever, corpus, db_dir, HNSW=HNSW))
+                addresses = (shard_addresses or {}).get((retriever, corpus), (shard_addresses or {}).get(corpus))
+                self.retrievers[-1].append(Retriever(retriever, corpus, db_dir, HNSW=HNSW, resource_manager=self.resource_manager, n_shards=n_shards, shard_workers=shard_workers, shard_addresses=addresses, make_snapshot=make_snapshot))
+        semantic_cache_threshold = semantic_cache_threshold or os.getenv("MEDRAG_SEMANTIC_CACHE_THRESHOLD")
+        self.query_cache, self.query_cache_row = None, None
+        if semantic_cache_threshold:
+            # the cache embeds queries with the first dense retriever, whose query embedding is then reused for the search
+            dense_rows = [i for i, name in enumerate(retriever_names[self.retriever_name]) if "bm25" not in name]
+            if dense_rows:
+                self.query_cache_row = dense_rows[0]
+                encoder = self.retrievers[self.query_cache_row][0]
+                encode = lambda question: encoder.embedding_function.encode([question])
+            else:
+                # BM25 only: MedCPT, loaded on the first lookup and shared through the resource manager by every system
+                manager = self.resource_manager or get_resource_manager()
+                encode = lambda question: manager.get(("encoder", "ncbi/MedCPT-Query-Encoder"), lambda: load_encoder("ncbi/MedCPT-Query-Encoder")).encode([question])
+            self.query_cache = get_query_cache((self.retriever_name, self.corpus_name), encode, threshold=float(semantic_cache_threshold), max_size=semantic_cache_size)
         self.cache = cache
         if self.cache:
             self.docExt = DocExtracter(cache=True, corpus_name=self.corpus_name, db_dir=db_dir)
         else:
             self.docExt = None
+        self.db_dir = db_dir
+        self.id_lookup, self.id_lookup_lock = None, threading.Lock()
     
-    def retrieve(self, question, k=3, rrf_k=100, id_only=False):
+    def retrieve(self, question, k=3, rrf_k=100, id_only=False, dedup=False, dedup_overfetch=2, token_budget=None, score_gap=None, count_tokens=None, extract=True, query_embeds=None):
         '''
             Given questions, return the relevant snippets from the corpus
+            With dedup, k * dedup_overfetch candidates are retrieved and collapsed by dedup_snippets down to k
+            With token_budget, k only caps the candidates, see select_by_token_budget
+            query_embeds (Dict[int, np.ndarray]): precomputed query embeddings by retriever row, see retrieve_batch
         '''
         assert type(question) == str
 
-        output_id_only = id_only
+        if dedup or token_budget is not None:
+            assert not id_only
+            texts, scores = self.retrieve(question, k=k * dedup_overfetch if dedup else k, rrf_k=rrf_k, id_only=True, extract=False, query_embeds=query_embeds)
+            return self._select(texts, scores, k, dedup, token_budget, score_gap, count_tokens)
+
+        query_embeds = dict(query_embeds or {})
+        if self.query_cache is not None:
+            params = (k, rrf_k, id_only, extract)
+            with torch.no_grad():
+                query_embed, normed = self.query_cache.embed(question, query_embeds.get(self.query_cache_row))
+            if self.query_cache_row is not None:
+                query_embeds[self.query_cache_row] = query_embed
+            cached = self.query_cache.lookup(normed, params)
+            if cached is not None:
+                return cached
+
+        texts, scores = self._search([question], k=k, rrf_k=rrf_k, id_only=id_only, extract=extract, query_embeds=query_embeds)[0]
+        if self.query_cache is not None:
+            self.query_cache.insert(normed, params, (texts, scores))
+        return texts, scores
+
+    def _search(self, questions, k=3, rrf_k=100, id_only=False, extract=True, query_embeds=None):
+        # (texts, scores) of each question, every retriever searching all of them at once; query_embeds: query
+        # embedding matrices by retriever row
+        query_embeds = query_embeds or {}
         if self.cache:
             id_only = True
 
-        texts = []
-        scores = []
+        texts = [[] for _ in questions]
+        scores = [[] for _ in questions]
 
         if "RRF" in self.retriever_name:
             k_ = max(k * 2, 100)
         else:
             k_ = k
-        for i in range(len(retriever_names[self.retriever_name])):
-            texts.append([])
-            scores.append([])
+        for i, name in enumerate(retriever_names[self.retriever_name]):
+            embeds = query_embeds.get(i)
+            if embeds is None and "bm25" not in name.lower():
+                # the corpora of a row share the encoder
+                with torch.no_grad():
+                    embeds = self.retrievers[i][0].embedding_function.encode(questions)
+            for q in range(len(questions)):
+                texts[q].append([])
+                scores[q].append([])
             for j in range(len(corpus_names[self.corpus_name])):
-                t, s = self.retrievers[i][j].get_relevant_documents(question, k=k_, id_only=id_only)
-                texts[-1].append(t)
-                scores[-1].append(s)
-        texts, scores = self.merge(texts, scores, k=k, rrf_k=rrf_k)
-        if self.cache:
-            texts = self.docExt.extract(texts)
+                results = self.retrievers[i][j].get_relevant_documents_batch(questions, k=k_, id_only=id_only, query_embeds=embeds)
+                for q, (t, s) in enumerate(results):
+                    texts[q][-1].append(t)
+                    scores[q][-1].append(s)
+        results = [self.merge(texts[q], scores[q], k=k, rrf_k=rrf_k) for q in range(len(questions))]
+        if self.cache and extract:
+            results = [(self.docExt.extract(t), s) for t, s in results]
+        return results
+
+    def _select(self, texts, scores, k, dedup, token_budget, score_gap, count_tokens):
+        # dedup / budget the id-only candidates of a question: only the snippets they get to are read from the corpus
+        fetch = self.fetch
+        if dedup:
+            texts, scores = dedup_snippets(texts, scores, k=k, fetch=fetch)
+            fetch = None
+        if token_budget is not None:
+            texts, scores = select_by_token_budget(texts, scores, token_budget, count_tokens=count_tokens, score_gap=score_gap, fetch=fetch)
         return texts, scores
 
+    def fetch(self, item):
+        '''
+        Full snippet of an id-only result, from the id -> text cache if there is one, else from the chunk file (or
+        snapshot) a "<source>_<index>" id names. Other ids, e.g. "PMID:<n>" or the Wikipedia article ids BM25
+        returns, are looked up in the id -> chunk line map of DocExtracter, built on first use
+        '''
+        if self.docExt is not None:
+            return self.docExt.extract([item])[0]
+        chunk = split_chunk_id(item["id"])
+        if chunk is not None:
+            for retriever in self.retrievers[0]:
+                snippet = retriever.fetch(*chunk)
+                if snippet is not None:
+                    return snippet
+        with self.id_lookup_lock:
+            if self.id_lookup is None:
+                self.id_lookup = DocExtracter(cache=False, corpus_name=self.corpus_name, db_dir=self.db_dir)
+        return self.id_lookup.extract([item])[0]
+
+    def retrieve_batch(self, questions, k=3, rrf_k=100, id_only=False, dedup=False, dedup_overfetch=2, token_budget=None, score_gap=None, count_tokens=None, extract=True):
+        '''
+            retrieve for a list of questions: every dense retriever encodes all of them in one batch and searches its
+            index with the query matrix in one call, BM25 runs one batch_search. With the semantic query cache the
+            questions are looked up, and searched on a miss, one by one with the batch's embeddings
+        '''
+        if len(questions) == 0:
+            return []
+        if self.query_cache is not None:
+            query_embeds = [{} for _ in questions]
+            for i, name in enumerate(retriever_names[self.retriever_name]):
+                if "bm25" in name.lower():
+                    continue
+                with torch.no_grad():
+                    embeds = self.retrievers[i][0].embedding_function.encode(questions)
+                for q in range(len(questions)):
+                    query_embeds[q][i] = embeds[q:q + 1]
+            return [self.retrieve(question, k=k, rrf_k=rrf_k, id_only=id_only, dedup=dedup, dedup_overfetch=dedup_overfetch, token_budget=token_budget,
+                                  score_gap=score_gap, count_tokens=count_tokens, extract=extract, query_embeds=query_embeds[q]) for q, question in enumerate(questions)]
+        if dedup or token_budget is not None:
+            assert not id_only
+            candidates = self._search(questions, k=k * dedup_overfetch if dedup else k, rrf_k=rrf_k, id_only=True, extract=False)
+            return [self._select(texts, scores, k, dedup, token_budget, score_gap, count_tokens) for texts, scores in candidates]
+        return self._search(questions, k=k, rrf_k=rrf_k, id_only=id_only, extract=extract)
+
     def merge(self, texts, scores, k=3, rrf_k=100):
         '''
             Merge the texts and scores from different retrievers
@@ -328,6 +1311,7 @@ class RetrievalSystem:
                         "id": item["id"],
                         "title": item.get("title", ""),
                         "content": item.get("content", ""),
+                        "n_tokens": item.get("n_tokens"),
                         "score": 1 / (rrf_k + j + 1),
                         "count": 1
                         }
@@ -336,7 +1320,7 @@ class RetrievalSystem:
             texts = texts[0][:k]
             scores = scores[0][:k]
         else:
-            texts = [dict((key, item[1][key]) for key in ("id", "title", "content")) for item in RRF_list[:k]]
+            texts = [dict((key, item[1][key]) for key in ("id", "title", "content", "n_tokens") if item[1][key] is not None) for item in RRF_list[:k]]
             scores = [item[1]["score"] for item in RRF_list[:k]]
         return texts, scores
     
@@ -0,0 +1,16 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# medrag reads the API settings from a config.py that every checkout creates for itself
+try:
+    import config
+except ImportError:
+    config = types.ModuleType("config")
+    config.config = {"api_key": "test"}
+    sys.modules["config"] = config
+
+# tests never read or write the shared response cache
+os.environ.setdefault("LLM_CACHE", "off")
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+import discuss_merge_3
+from discuss_merge_3 import MedicalTeam
+
+
+@pytest.fixture
+def team(monkeypatch):
+    # a team without doctors: only the discussion prompts are exercised, with the LLM calls recorded
+    team = MedicalTeam.__new__(MedicalTeam)
+    team.case_context = "Patient case:\n{}\n"
+    team.token_usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    team.prompts = []
+
+    async def adecide(cont, choices=("Yes", "No"), default=None, **kwargs):
+        team.prompts.append(cont)
+        return "Yes"
+
+    async def achat(cont, **kwargs):
+        team.prompts.append(cont)
+        return '{"participate": true, "opinions": {"lab": "agree"}}'
+
+    monkeypatch.setattr(discuss_merge_3, "adecide", adecide)
+    monkeypatch.setattr(discuss_merge_3, "achat", achat)
+    return team
+
+
+def test_discussion_prompts_share_their_opening_block(team):
+    prompt = "Diagnosis opinions from each doctor:\n\nlab: ├── Pneumonia\n\nCurrent round: Round 1, Turn 1"
+
+    async def run():
+        team._semaphore = asyncio.Semaphore(4)
+        await team._ashould_participate("imaging", prompt)
+        await team._agenerate_opinion("imaging", "lab", prompt)
+        await team._afused_opinions("imaging", ["lab"], prompt)
+
+    asyncio.run(run())
+    block = team._situation_block(prompt)
+    assert len(team.prompts) == 3
+    assert all(cont.startswith(block) for cont in team.prompts)
+    assert len(set(team.prompts)) == 3
+
+
+
+def test_final_decision_is_made_on_the_async_path(team, monkeypatch):
+    monkeypatch.setattr(discuss_merge_3, "chat", lambda *args, **kwargs: pytest.fail("blocking chat() called"))
+    team.round_opinions = {1: {"lab": "├── Pneumonia"}}
+    team.options = "A. Pneumonia"
+
+    async def run():
+        team._semaphore = asyncio.Semaphore(1)
+        return await team._amake_final_decision()
+
+    assert asyncio.run(run()) is not None
+    assert "A. Pneumonia" in team.prompts[-1]
+
+
+@pytest.mark.parametrize("update_with_case", [False, True])
+def test_updates_carry_the_case_only_when_asked(team, monkeypatch, tmp_path, update_with_case):
+    contexts = []
+
+    async def achat(cont, context=None, **kwargs):
+        contexts.append(context)
+        return "├── Pneumonia"
+
+    monkeypatch.setattr(discuss_merge_3, "achat", achat)
+    team.update_with_case = update_with_case
+    team.round_opinions = {1: {"lab": "├── Pneumonia"}}
+    team.interaction_log = {"Round 1": {"Turn 1": {"lab": {"lab": None}}}}
+    team.journal = discuss_merge_3.StepJournal(str(tmp_path / "journal.jsonl"))
+
+    async def run():
+        team._semaphore = asyncio.Semaphore(1)
+        return await team._acollect_updated_opinions(1, {"lab": "├── Pneumonia"})
+
+    assert asyncio.run(run()) == {"lab": "├── Pneumonia"}
+    assert contexts == [team.case_context if update_with_case else None]
+
+TREE = """Lab Doctor Reasoning Pathway
+├── Disease 1: Community-acquired pneumonia
+│   └── Analysis: ...
+│       ├── Evidence 1: fever
+│       └── Evidence 2: infiltrate
+├── Disease 2: Acute bronchitis
+│   └── Analysis: ...
+└── ..."""
+
+
+def test_ranked_diseases_reads_root_entries_only():
+    assert discuss_merge_3.ranked_diseases(TREE) == ["community-acquired pneumonia", "acute bronchitis"]
+    # indented children (analysis, evidence) are never diseases, even without the │ guide
+    assert discuss_merge_3.ranked_diseases("├── Sepsis\n    ├── Evidence 1: lactate\n    └── Evidence 2: fever") == ["sepsis"]
+    assert discuss_merge_3.ranked_diseases(None) == []
+
+
+def tree(*diseases):
+    return "Doctor Reasoning Pathway\n" + "\n".join(f"├── Disease {i + 1}: {d}\n│   └── Analysis: ..." for i, d in enumerate(diseases))
+
+
+def test_consensus_is_the_share_leading_with_the_same_disease():
+    opinions = {"lab": tree("Pneumonia", "Bronchitis"), "imaging": tree("pneumonia"), "pathology": tree("Tuberculosis", "Pneumonia")}
+    assert discuss_merge_3.consensus(opinions) == pytest.approx(2 / 3)
+    assert discuss_merge_3.consensus({"lab": tree("Sepsis"), "imaging": tree("**Sepsis**")}) == 1.0
+
+
+def test_consensus_needs_a_leading_disease_from_every_doctor():
+    assert discuss_merge_3.consensus({"lab": tree("Sepsis"), "imaging": "no tree at all"}) == 0.0
+    assert discuss_merge_3.consensus({"lab": tree("Sepsis"), "imaging": None}) == 0.0
+    assert discuss_merge_3.consensus({"lab": tree("Sepsis")}) == 0.0
+
+
+def test_parse_fused_opinions():
+    answer = 'Here you go: {"participate": true, "opinions": {"lab": "agree", "imaging": "", "pathology": "disagree"}}'
+    assert discuss_merge_3.parse_fused_opinions(answer, ["lab", "imaging"]) == {"participate": True, "opinions": {"lab": "agree"}}
+    # participating without an opinion on any asked target counts as not participating
+    assert discuss_merge_3.parse_fused_opinions('{"participate": "yes", "opinions": {}}', ["lab"]) == {"participate": False, "opinions": {}}
+    assert discuss_merge_3.parse_fused_opinions('{"participate": "Yes", "opinions": {"lab": 3}}', ["lab"]) == {"participate": True, "opinions": {"lab": "3"}}
+    assert discuss_merge_3.parse_fused_opinions("I would rather not", ["lab"]) is None
+    assert discuss_merge_3.parse_fused_opinions('{"participate": true, "opinions": ["lab"]}', ["lab"]) is None
+    assert discuss_merge_3.parse_fused_opinions(None, ["lab"]) is None
@@ -0,0 +1,73 @@
+import json
+
+from event_log import EventLog, read_messages, transcript_log_path
+
+
+def test_append_and_read(tmp_path):
+    log = EventLog(str(tmp_path / "log.jsonl"))
+    log.append("message", message={"role": "user", "content": "hi"})
+    log.append("qa", context="ctx")
+    assert [event["event"] for event in log.read()] == ["message", "qa"]
+    assert log.read("qa") == [{"event": "qa", "context": "ctx"}]
+    assert read_messages(log.path) == [{"role": "user", "content": "hi"}]
+
+
+def test_torn_tail_does_not_swallow_the_next_event(tmp_path):
+    log = EventLog(str(tmp_path / "log.jsonl"), fsync=True)
+    log.append("qa", context="round 1")
+    with open(log.path, "a", encoding="utf-8") as f:
+        f.write('{"event": "qa", "context": "round')  # crashed mid-write
+    log.append("qa", context="round 2")
+    log.append("qa", context="round 3")
+    assert [event["context"] for event in log.read("qa")] == ["round 1", "round 2", "round 3"]
+
+
+def test_read_missing_and_clear(tmp_path):
+    log = EventLog(str(tmp_path / "sub" / "log.jsonl"))
+    assert not log.exists() and log.read() == []
+    log.append("qa", context="x")
+    log.clear()
+    assert log.exists() and log.read() == []
+    log.remove()
+    assert not log.exists()
+
+
+def test_unicode_round_trip(tmp_path):
+    log = EventLog(str(tmp_path / "log.jsonl"))
+    log.append("message", message={"role": "assistant", "content": "肺炎 ├── Disease"})
+    with open(log.path, encoding="utf-8") as f:
+        assert json.loads(f.readline())["message"]["content"] == "肺炎 ├── Disease"
+
+
+def test_replace_is_atomic_and_appends_follow_it(tmp_path):
+    log = EventLog(str(tmp_path / "log.jsonl"))
+    log.append("qa", context="old")
+    with log.locked():
+        log.replace([("qa", {"context": "a"}), ("qa", {"context": "b"})])
+    log.append("qa", context="c")
+    assert [event["context"] for event in log.read("qa")] == ["a", "b", "c"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["log.jsonl"]
+
+
+def test_legacy_qa_cache_is_converted(tmp_path):
+    from medrag import load_qa_cache
+
+    path = tmp_path / "qa.json"
+    path.write_text(json.dumps(["ctx 1", "ctx 2"], indent=4), encoding="utf-8")
+    log = EventLog(str(path), fsync=True)
+    assert load_qa_cache(log) == ["ctx 1", "ctx 2"]
+    assert [event["context"] for event in log.read("qa")] == ["ctx 1", "ctx 2"]
+    assert load_qa_cache(log) == ["ctx 1", "ctx 2"]
+
+
+def test_read_messages_of_a_saved_and_of_an_interrupted_transcript(tmp_path):
+    messages = [{"role": "system", "content": "sys"}, {"role": "user", "content": "q"}]
+    save_path = str(tmp_path / "transcript.json")
+    log = EventLog(transcript_log_path(save_path))
+    for message in messages:
+        log.append("message", message=message)
+    assert read_messages(save_path) == messages  # the call never returned
+    with open(save_path, "w") as f:
+        json.dump(messages, f, indent=4)
+    log.remove()
+    assert read_messages(save_path) == messages
@@ -0,0 +1,60 @@
+import sqlite3
+
+import llm_cache
+from llm_cache import ResponseCache
+
+
+def stored_size(cache):
+    return cache.connect().execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+def running_total(cache):
+    return cache.connect().execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_size=100, mode="on")
+    keys = [cache.key("m", [{"role": "user", "content": str(i)}]) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, "m", "x" * 28) # 30 bytes as JSON
+    assert cache.get(keys[0]) == "x" * 28 # keys[1] is now the least recently used
+    cache.put(keys[3], "m", "x" * 28)
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(key) is not None for key in (keys[0], keys[2], keys[3]))
+    assert running_total(cache) == stored_size(cache) == 90
+
+
+def test_running_total_follows_replacements_and_clear(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_size="1M", mode="on")
+    key = cache.key("m", [{"role": "user", "content": "q"}])
+    cache.put(key, "m", "short")
+    cache.put(key, "m", "a longer answer")
+    assert running_total(cache) == stored_size(cache) == len('"a longer answer"')
+    cache.clear()
+    assert running_total(cache) == 0
+
+
+def test_running_total_of_a_cache_written_before_it(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)")
+    conn.execute("INSERT INTO responses VALUES ('k', 'm', '\"old\"', 5, 0, 0)")
+    conn.commit()
+    conn.close()
+    cache = ResponseCache(path, max_size="1M", mode="on")
+    assert running_total(cache) == 5
+    assert cache.get("k") == "old"
+
+
+def test_hits_write_access_times_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_cache, "ACCESS_BATCH", 2)
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_size="1M", mode="on")
+    keys = [cache.key("m", [{"role": "user", "content": str(i)}]) for i in range(2)]
+    for key in keys:
+        cache.put(key, "m", "answer")
+    accessed = lambda: dict(cache.connect().execute("SELECT key, accessed FROM responses").fetchall())
+    before = accessed()
+    cache.get(keys[0])
+    assert accessed() == before and list(cache.accessed) == [keys[0]]
+    cache.get(keys[1])
+    assert all(accessed()[key] > before[key] for key in keys) and cache.accessed == {}
@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("openai")
+
+import llm_scheduler
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "LLM_SCHEDULER", True)
+    monkeypatch.setattr(llm_scheduler, "LLM_RPM", "60")
+    monkeypatch.setattr(llm_scheduler, "LLM_TPM", "90000")
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY", "8")
+    yield
+    llm_scheduler.share_limits(1)
+
+
+def test_share_limits_splits_the_rates_between_workers(limits):
+    llm_scheduler.share_limits(1)
+    whole = llm_scheduler.get_scheduler()
+    llm_scheduler.share_limits(3)
+    part = llm_scheduler.get_scheduler()
+    assert part is not whole
+    assert part.requests.capacity == pytest.approx(20)
+    assert part.tokens.capacity == pytest.approx(30000)
+    assert part.limit.limit == 2
+    assert llm_scheduler.get_scheduler() is part
+
+
+def test_token_bucket_waits_once_drained():
+    bucket = llm_scheduler.TokenBucket(60)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+
+
+def connection_error():
+    import httpx
+    return llm_scheduler.openai.APIConnectionError(request=httpx.Request("POST", "http://localhost"))
+
+
+def test_retries_book_the_tokens_of_a_request_once():
+    scheduler = llm_scheduler.RequestScheduler(tpm=60000, max_concurrency=2, max_attempts=3, backoff_base=0)
+    attempts = []
+
+    def request():
+        attempts.append(scheduler.tokens.level)
+        raise connection_error()
+
+    with pytest.raises(llm_scheduler.openai.APIConnectionError):
+        scheduler.run(request, {"messages": [{"content": "x" * 400}], "max_tokens": 900})
+    # 100 prompt + 900 completion tokens booked before the first attempt only, and returned after the last
+    assert attempts[0] == pytest.approx(59000, abs=5)
+    assert attempts[1] == pytest.approx(59000, abs=5) and attempts[2] == pytest.approx(59000, abs=5)
+    assert scheduler.tokens.level == pytest.approx(60000)
+    assert scheduler.limit.in_flight == 0
+
+
+def test_streams_hold_their_slot_until_consumed():
+    scheduler = llm_scheduler.RequestScheduler(max_concurrency=1)
+    with scheduler.stream(lambda: iter(["chunk"]), {"messages": []}) as stream:
+        assert scheduler.limit.in_flight == 1
+        assert list(stream) == ["chunk"]
+    assert scheduler.limit.in_flight == 0
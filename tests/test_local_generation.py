@@ -0,0 +1,110 @@
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+import medrag
+
+
+@pytest.fixture(scope="module")
+def tiny_llm():
+    # a randomly initialized two-layer Llama with a small BPE vocabulary: its outputs are noise, but greedy
+    # decoding is deterministic, so cached and uncached generation must agree token for token
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+
+    tok = Tokenizer(models.BPE(unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=300, special_tokens=["<unk>", "<s>", "</s>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tok.train_from_iterator(["the patient has fever and cough ### User: answer question about disease evidence"] * 50, trainer)
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tok, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+    tokenizer.chat_template = "{% for m in messages %}<s>{{ m['role'] }}:\n{{ m['content'] }}</s>{% endfor %}{% if add_generation_prompt %}<s>assistant:\n{% endif %}"
+    tokenizer.padding_side = "left"
+    tokenizer.pad_token = tokenizer.eos_token
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=512, bos_token_id=1, eos_token_id=2)
+    return tokenizer, transformers.LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture
+def local_llm(tiny_llm):
+    tokenizer, model = tiny_llm
+    return medrag.LocalLLM(types.SimpleNamespace(model=model), tokenizer, "local/tiny")
+
+
+def make_medrag(local_llm, prefix_cache, batch_size=1, max_length=400):
+    # what MedRAG.__init__ sets up for a local model, without loading one
+    rag = medrag.MedRAG.__new__(medrag.MedRAG)
+    rag.llm_name = local_llm.llm_name
+    rag.max_length = max_length
+    rag.tokenizer = local_llm.tokenizer
+    rag.batch_size = batch_size
+    rag.local_llm = local_llm
+    rag.batcher = local_llm.get_batcher(batch_size) if batch_size > 1 else None
+    rag.prefix_cache = local_llm.get_prefix_cache("100M") if prefix_cache else None
+    return rag
+
+
+SYSTEM = {"role": "system", "content": "the patient has fever and cough " * 5}
+QUESTIONS = [[SYSTEM, {"role": "user", "content": "answer question %d about " % i + "disease " * i}] for i in range(4)]
+
+
+def test_batched_prompts_share_a_cached_prefix(local_llm):
+    plain = make_medrag(local_llm, prefix_cache=False)
+    expected = [plain.generate(messages, max_new_tokens=12) for messages in QUESTIONS]
+    cached = make_medrag(local_llm, prefix_cache=True, batch_size=4)
+    assert cached.generate_batch(QUESTIONS, max_new_tokens=12) == expected
+    assert len(cached.prefix_cache.entries) == 1  # the shared prefix, prefilled once
+    assert cached.generate_batch(QUESTIONS, max_new_tokens=12) == expected
+    assert cached.prefix_cache.hits == 1
+
+
+def test_growing_context_reuses_the_previous_round(local_llm):
+    context = "Query: fever\nAnswer: the patient has cough"
+    rounds = [context, context + "\n\nQuery: cough\nAnswer: disease evidence"]
+    prompts = [[SYSTEM, {"role": "user", "content": context + "\n\nHere is the question:\nQ?"}] for context in rounds]
+    plain = make_medrag(local_llm, prefix_cache=False)
+    cached = make_medrag(local_llm, prefix_cache=True)
+    first = cached.generate(prompts[0], prefix=rounds[0], max_new_tokens=8)
+    reused = []
+    lookup = cached.prefix_cache.lookup
+    cached.prefix_cache.lookup = lambda ids: reused.append(lookup(ids)[1]) or lookup(ids)
+    second = cached.generate(prompts[1], prefix=rounds[1], max_new_tokens=8)
+    assert [first, second] == [plain.generate(messages, max_new_tokens=8) for messages in prompts]
+    # round 2 starts from the end of round 1's context, past the system prompt
+    system_length = len(cached.tokenizer(cached.tokenizer.apply_chat_template([SYSTEM], tokenize=False), add_special_tokens=False)["input_ids"])
+    assert reused[0] > system_length
+
+
+def test_shared_batcher_uses_the_settings_of_each_caller(local_llm):
+    cached = make_medrag(local_llm, prefix_cache=True, batch_size=2)
+    plain = make_medrag(local_llm, prefix_cache=False, batch_size=4, max_length=60)
+    assert cached.batcher is plain.batcher and cached.batcher.batch_size == 4
+    # the batcher belongs to the model, not to the first MedRAG that asked for it
+    assert cached.batcher.run_batch == local_llm.generate
+    max_lengths = []
+    generate_ids = local_llm._generate_ids
+    local_llm._generate_ids = lambda input_ids, attention_mask, max_length, **kwargs: max_lengths.append(max_length) or generate_ids(input_ids, attention_mask, max_length, **kwargs)
+    plain.generate(QUESTIONS[1], max_new_tokens=4)
+    assert len(local_llm.prefix_cache.entries) == 0
+    cached.generate(QUESTIONS[1], max_new_tokens=4)
+    assert len(local_llm.prefix_cache.entries) > 0
+    assert max_lengths == [60, 400]
+
+
+def test_stop_word_split_across_byte_tokens(tiny_llm):
+    # the vocabulary has no CJK merges, so each character of the stop word is three partial-UTF-8 byte tokens
+    tokenizer, _ = tiny_llm
+    prompt = tokenizer.encode("the patient has", add_special_tokens=False)
+    stop = "发热"
+    assert len(tokenizer.encode(stop, add_special_tokens=False)) > len(stop) + 2
+    criteria = medrag.CustomStoppingCriteria([stop], tokenizer, len(prompt))
+    generated = tokenizer.encode(" fever 发热", add_special_tokens=False)
+    assert criteria(torch.tensor([prompt + generated]), None).tolist() == [True]
+    criteria = medrag.CustomStoppingCriteria([stop], tokenizer, len(prompt))
+    generated = tokenizer.encode(" fever 发", add_special_tokens=False)
+    assert criteria(torch.tensor([prompt + generated]), None).tolist() == [False]
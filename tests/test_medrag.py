@@ -0,0 +1,59 @@
+import medrag
+
+
+class WordTokenizer:
+    # one token per whitespace-separated word, standing in for tiktoken
+    def encode(self, text, **kwargs):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def make_medrag(llm_name, context_length):
+    rag = medrag.MedRAG.__new__(medrag.MedRAG)
+    rag.llm_name = llm_name
+    rag.rag = True
+    rag.context_length = context_length
+    rag.tokenizer = WordTokenizer()
+    rag.templates = {"medrag_system": medrag.general_medrag_system, "medrag_prompt": medrag.general_medrag}
+    return rag
+
+
+SNIPPETS = [{"title": "t", "content": "word " * 100}] * 3
+
+
+def context_words(messages_list):
+    [messages] = messages_list
+    return messages[1]["content"].count("word")
+
+
+def test_token_budget_is_capped_by_the_context_window():
+    rag = make_medrag("OpenAI/gpt-4", context_length=120)
+    assert context_words(rag._answer_messages("q", "", SNIPPETS, token_budget=10_000)) < 120
+    assert context_words(rag._answer_messages("q", "", SNIPPETS, token_budget=50)) < 50
+
+
+def test_snippets_within_the_budget_are_kept_whole():
+    rag = make_medrag("OpenAI/gpt-4", context_length=1000)
+    assert context_words(rag._answer_messages("q", "", SNIPPETS, token_budget=500)) == 300
+
+
+def test_retrieval_dedupes_as_the_instance_is_set_up():
+    snippets = [{"id": "a", "title": "t", "content": "the same chunk of text about fever"}] * 3
+    rag = make_medrag("OpenAI/gpt-4", context_length=1000)
+    rag.dedup = True
+    assert len(rag.medrag_retrieve("q", k=3, snippets=snippets, verbose=False)[0]) == 1
+    assert len(rag.medrag_retrieve("q", k=3, snippets=snippets, dedup=False, verbose=False)[0]) == 3
+    rag.dedup = False
+    assert len(rag.medrag_retrieve("q", k=3, snippets=snippets, verbose=False)[0]) == 3
+
+
+def test_run_async_closes_the_clients_of_its_loop():
+    async def case():
+        first = medrag.get_async_openai_client(api_key="key", base_url="http://localhost:1")
+        assert medrag.get_async_openai_client(api_key="key", base_url="http://localhost:1") is first
+        return first
+    client = medrag.run_async(case())
+    assert client.is_closed()
+    assert len(medrag._async_clients) == 0
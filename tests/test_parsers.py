@@ -0,0 +1,76 @@
+import pytest
+
+from medrag import parse_choice, parse_answer_choice, parse_follow_up, parse_queries, parse_sections
+
+OPTIONS = ["A", "B", "C", "D"]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("C", "C"),
+    ("**C**", "C"),
+    ("(C)", "C"),
+    ("C. Pneumonia", "C"),
+    ("C) Pneumonia", "C"),
+    ("The answer is C.", "C"),
+    ("The answer is (C)", "C"),
+    ("Answer: B", "B"),
+    ("The best option is D because ...", "D"),
+    ("choice: A", "A"),
+    ("A diagnosis of pneumonia (C) best fits.", "C"),
+    ("A 45-year-old man; I think the answer is B.", "B"),
+    ("I would choose (D).", "D"),
+])
+def test_parse_answer_choice_positions(text, expected):
+    assert parse_answer_choice(text, OPTIONS) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "A diagnosis of pneumonia fits best.",
+    "I am not sure.",
+    "None of the options fits",
+    "",
+])
+def test_parse_answer_choice_prose_is_not_an_answer(text):
+    assert parse_answer_choice(text, OPTIONS) is None
+
+
+def test_parse_choice_words():
+    assert parse_choice("Yes, I will.", ("Yes", "No")) == "Yes"
+    assert parse_choice("**no**", ("Yes", "No")) == "No"
+    assert parse_choice("Nothing to add", ("Yes", "No")) is None
+
+
+def test_parse_choice_partial_stream():
+    assert parse_choice("No", ("Yes", "No"), complete=False) is None
+    assert parse_choice("Not", ("Yes", "No"), complete=False) is None
+    assert parse_choice("No,", ("Yes", "No"), complete=False) == "No"
+    assert parse_choice("C", OPTIONS, complete=False) is None
+    assert parse_choice("(C", OPTIONS, complete=False) is None
+    assert parse_choice("(C)", OPTIONS, complete=False) == "C"
+
+
+def test_parse_sections():
+    sections = parse_sections("## Analysis\nsome text\n\n## Queries:\n1. q1\n### Answer ##\nB")
+    assert sections == {"analysis": "some text", "queries": "1. q1", "answer": "B"}
+
+
+def test_parse_queries():
+    assert parse_queries("1. What is X?\n2) **Y causes?**\n- \"Z\"\n\n* W") == ["What is X?", "Y causes?", "Z", "W"]
+    assert parse_queries('["q1", " q2 ", ""]') == ["q1", "q2"]
+
+
+def test_parse_follow_up_sections():
+    reply = parse_follow_up("## Analysis\nblah\n\n## Queries\n1. q1\n2. q2\n")
+    assert reply == {"queries": ["q1", "q2"], "answer": None}
+    reply = parse_follow_up("## Analysis\nblah\n## Answer\nThe answer is C.")
+    assert reply["queries"] is None and parse_answer_choice(reply["answer"], OPTIONS) == "C"
+
+
+def test_parse_follow_up_json():
+    reply = parse_follow_up('```json\n{"analysis": "a", "queries": ["q1", "q2"]}\n```')
+    assert reply == {"queries": ["q1", "q2"], "answer": None}
+    assert parse_follow_up('{"analysis": "a", "answer": "B"}') == {"queries": None, "answer": "B"}
+
+
+def test_parse_follow_up_nothing():
+    assert parse_follow_up("Let me think about it.") == {"queries": None, "answer": None}
@@ -0,0 +1,60 @@
+import types
+
+import faiss
+import numpy as np
+
+from utils import LocalShard, ResourceManager, ShardedIndex, estimate_resident_size
+
+
+class Closable:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_evicted_resources_are_closed():
+    manager = ResourceManager(memory_budget=100)
+    first, metadatas = Closable(), [{"id": 1}]
+    manager.get("a", lambda: (first, metadatas), sizer=lambda resource: 80)
+    second = Closable()
+    manager.get("b", lambda: second, sizer=lambda resource: 80)
+    assert first.closed and not second.closed
+    assert list(manager.stats()["resources"]) == ["b"]
+    assert manager.resident_size == 80
+
+
+
+def test_resources_of_size_zero_are_not_evicted():
+    manager = ResourceManager(memory_budget=100)
+    searcher = Closable()
+    manager.get("lucene", lambda: searcher, sizer=lambda resource: 0)
+    manager.get("a", Closable, sizer=lambda resource: 80)
+    manager.get("b", Closable, sizer=lambda resource: 80)
+    assert not searcher.closed
+    assert list(manager.stats()["resources"]) == ["lucene", "b"]
+
+
+def test_borrowed_resources_are_closed_when_returned():
+    manager = ResourceManager(memory_budget=100)
+    first = Closable()
+    with manager.borrow("a", lambda: first, sizer=lambda resource: 80) as borrowed:
+        with manager.borrow("a", lambda: Closable(), sizer=lambda resource: 80) as again:
+            assert again is borrowed is first
+        manager.get("b", Closable, sizer=lambda resource: 80)
+        assert list(manager.stats()["resources"]) == ["b"] and not first.closed
+    assert first.closed
+    # a reload after the eviction is a new resource
+    assert manager.get("a", Closable, sizer=lambda resource: 80) is not first
+
+def test_sharded_index_size_counts_shards_on_this_host():
+    index = faiss.IndexFlatIP(8)
+    index.add(np.zeros((10, 8), dtype=np.float32))
+    local_process = types.SimpleNamespace(d=8, ntotal=20, metric_type=faiss.METRIC_INNER_PRODUCT, process=object())
+    other_host = types.SimpleNamespace(d=8, ntotal=30, metric_type=faiss.METRIC_INNER_PRODUCT, process=None)
+    sharded = ShardedIndex([LocalShard(index), local_process, other_host], [0, 10, 30])
+    try:
+        assert estimate_resident_size(sharded) == (10 + 20) * 8 * 4
+    finally:
+        sharded.executor.shutdown()
@@ -0,0 +1,259 @@
+import json
+import os
+import threading
+import types
+
+import faiss
+import numpy as np
+import pytest
+
+import utils
+from utils import IndexSnapshot, RetrievalSystem, build_snapshot
+
+
+def write_corpus(root, sources):
+    # chunk/<source>.jsonl files and a flat index over one random vector per chunk
+    chunk_dir, index_dir = os.path.join(root, "chunk"), os.path.join(root, "index")
+    os.makedirs(chunk_dir)
+    os.makedirs(index_dir)
+    metadatas = []
+    for source, n in sources.items():
+        with open(os.path.join(chunk_dir, source + ".jsonl"), "w") as f:
+            for i in range(n):
+                f.write(json.dumps({"id": f"{source}_{i}", "title": source, "content": f"{source} chunk {i} " * 5}) + "\n")
+                metadatas.append({"source": source, "index": i})
+    index = faiss.IndexFlatIP(4)
+    index.add(np.random.default_rng(0).random((len(metadatas), 4), dtype=np.float32))
+    faiss.write_index(index, os.path.join(index_dir, "faiss.index"))
+    with open(os.path.join(index_dir, "metadatas.jsonl"), "w") as f:
+        f.write("\n".join(json.dumps(item) for item in metadatas))
+    return chunk_dir, index_dir
+
+
+def test_snapshot_finds_rows_by_chunk(tmp_path):
+    chunk_dir, index_dir = write_corpus(str(tmp_path), {"b_book": 3, "a_book": 2})
+    snapshot = IndexSnapshot(build_snapshot(index_dir, chunk_dir))
+    row = snapshot.find("a_book", 1)
+    assert snapshot[row] == {"source": "a_book", "index": 1}
+    assert snapshot.get_snippets([row])[0]["id"] == "a_book_1"
+    assert snapshot.find("a_book", 2) is None
+    assert snapshot.find("c_book", 0) is None
+
+
+class IdRetriever:
+    # a dense retriever returning ranked ids only, which serves snippets by (source, index) and records its calls
+    def __init__(self, n, step=1):
+        self.n = n
+        self.step = step
+        self.fetched = []
+        self.searches = []
+        self.encoded = []
+        self.embedding_function = types.SimpleNamespace(encode=lambda questions: self.encoded.append(questions) or np.zeros((len(questions), 4)))
+
+    def get_relevant_documents_batch(self, questions, k=3, id_only=False, query_embeds=None):
+        assert id_only
+        self.searches.append(query_embeds.shape)
+        ranks = range(min(k, self.n))
+        return [([{"id": f"book_{i * self.step}"} for i in ranks], [1.0 - i / 100 for i in ranks]) for _ in questions]
+
+    def fetch(self, source, index):
+        self.fetched.append(index)
+        return {"id": f"{source}_{index}", "title": source, "content": f"distinct words number {index} " * 10, "n_tokens": 40}
+
+
+@pytest.fixture
+def system(monkeypatch, tmp_path):
+    monkeypatch.setitem(utils.retriever_names, "Fake", ["fake"])
+    monkeypatch.setitem(utils.corpus_names, "Fake", ["fake"])
+    system = RetrievalSystem.__new__(RetrievalSystem)
+    system.retriever_name, system.corpus_name = "Fake", "Fake"
+    system.retrievers = [[IdRetriever(32)]]
+    system.query_cache, system.cache, system.docExt = None, False, None
+    system.db_dir, system.id_lookup, system.id_lookup_lock = str(tmp_path), None, threading.Lock()
+    return system
+
+
+def test_budgeted_retrieval_reads_only_selected_snippets(system):
+    texts, scores = system.retrieve("q", k=32, token_budget=150)
+    assert [text["id"] for text in texts] == ["book_0", "book_1", "book_2"]
+    # the fourth snippet is read to find that it does not fit, the rest never are
+    assert system.retrievers[0][0].fetched == [0, 1, 2, 3]
+
+
+def test_deduplicated_retrieval_reads_only_considered_snippets(system):
+    # chunks far apart, none of them redundant: dedup stops after the first k of the 2 * k candidates
+    system.retrievers = [[IdRetriever(32, step=10)]]
+    texts, scores = system.retrieve("q", k=4, dedup=True)
+    assert [text["id"] for text in texts] == ["book_0", "book_10", "book_20", "book_30"]
+    assert system.retrievers[0][0].fetched == [0, 10, 20, 30]
+
+
+def test_batch_retrieval_searches_all_questions_at_once(system):
+    results = system.retrieve_batch(["q1", "q2", "q3"], k=4, token_budget=150)
+    retriever = system.retrievers[0][0]
+    assert retriever.encoded == [["q1", "q2", "q3"]]
+    assert retriever.searches == [(3, 4)] # one search with the query matrix
+    assert [[text["id"] for text in texts] for texts, _ in results] == [["book_0", "book_1", "book_2"]] * 3
+
+
+
+class PubMedRetriever(IdRetriever):
+    # BM25 over PubMed returns PMID ids, which name no chunk file
+    def get_relevant_documents_batch(self, questions, k=3, id_only=False, query_embeds=None):
+        assert id_only
+        return [([{"id": "PMID:42"}, {"id": "PMID:7"}], [2.0, 1.0]) for _ in questions]
+
+
+def test_ids_naming_no_chunk_file_are_looked_up(system, tmp_path):
+    os.makedirs(tmp_path / "fake" / "chunk")
+    with open(tmp_path / "fake" / "chunk" / "pubmed23n0001.jsonl", "w") as f:
+        for pmid in (7, 42):
+            f.write(json.dumps({"id": f"PMID:{pmid}", "title": "t", "content": f"abstract {pmid}", "contents": "", "n_tokens": 10}) + "\n")
+    system.retrievers = [[PubMedRetriever(2)]]
+    texts, scores = system.retrieve("q", k=2, token_budget=100)
+    assert [text["content"] for text in texts] == ["abstract 42", "abstract 7"]
+    assert system.retrievers[0][0].fetched == []
+
+def snippet(id, content):
+    return {"id": id, "title": "t", "content": content}
+
+
+def test_dedup_merges_overlapping_neighbours_only():
+    first = "Pneumonia is an infection of the lung parenchyma. It presents with fever and cough"
+    second = "presents with fever and cough. Chest radiography shows an infiltrate"
+    section = "Treatment: empiric antibiotics chosen by severity and local resistance patterns"
+    texts, _ = utils.dedup_snippets([snippet("book_1", first), snippet("book_2", second), snippet("book_3", section)])
+    assert [text["id"] for text in texts] == ["book_1", "book_3"]
+    assert texts[0]["content"] == first + ". Chest radiography shows an infiltrate"
+    # neighbouring sections that share no text stay separate snippets
+    assert texts[1]["content"] == section
+
+
+def test_dedup_drops_near_duplicates_and_backfills():
+    text = "acute kidney injury is defined by a rise in serum creatinine or a fall in urine output " * 3
+    snippets = [snippet("a_1", text), snippet("b_7", text + "more"), snippet("c_4", "hyperkalemia needs urgent treatment " * 5)]
+    texts, scores = utils.dedup_snippets(snippets, [0.9, 0.8, 0.7], k=2)
+    assert [text["id"] for text in texts] == ["a_1", "c_4"]
+    assert scores == [0.9, 0.7]
+
+
+def test_snapshot_index_matches_the_faiss_index(tmp_path):
+    chunk_dir, index_dir = write_corpus(str(tmp_path), {"a_book": 4})
+    snapshot = IndexSnapshot(build_snapshot(index_dir, chunk_dir))
+    query = np.ones((1, 4), dtype=np.float32)
+    expected = utils.read_index_mmap(os.path.join(index_dir, "faiss.index")).search(query, 3)
+    found = snapshot.load_index().search(query, 3)
+    assert (found[1] == expected[1]).all()
+
+
+def test_snapshot_is_stale_once_the_index_changes(tmp_path):
+    chunk_dir, index_dir = write_corpus(str(tmp_path), {"a_book": 4})
+    snapshot = IndexSnapshot(build_snapshot(index_dir, chunk_dir))
+    assert not snapshot.is_stale(index_dir)
+    index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    index.add(np.zeros((1, 4), dtype=np.float32))
+    faiss.write_index(index, os.path.join(index_dir, "faiss.index"))
+    assert snapshot.is_stale(index_dir)
+    # a directory shipped with the snapshot alone is not stale
+    for name in ("faiss.index", "metadatas.jsonl"):
+        os.remove(os.path.join(index_dir, name))
+    assert not snapshot.is_stale(index_dir)
+
+
+def test_stale_snapshot_is_rebuilt(tmp_path, monkeypatch):
+    chunk_dir, index_dir = write_corpus(str(tmp_path), {"a_book": 4})
+    path = build_snapshot(index_dir, chunk_dir)
+    with open(os.path.join(chunk_dir, "a_book.jsonl"), "a") as f:
+        f.write(json.dumps({"id": "a_book_4", "title": "a_book", "content": "new chunk"}) + "\n")
+    with open(os.path.join(index_dir, "metadatas.jsonl"), "a") as f:
+        f.write("\n" + json.dumps({"source": "a_book", "index": 4}))
+    index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    index.add(np.zeros((1, 4), dtype=np.float32))
+    faiss.write_index(index, os.path.join(index_dir, "faiss.index"))
+    retriever = utils.Retriever.__new__(utils.Retriever)
+    retriever.index_dir, retriever.chunk_dir = index_dir, chunk_dir
+    retriever.corpus_name, retriever.retriever_name = "a", "b"
+    snapshot = retriever._load_snapshot()
+    assert snapshot.path == path # rebuilt in place
+    assert len(snapshot) == 5 and not snapshot.is_stale(index_dir)
+    assert snapshot.find("a_book", 4) is not None
+
+
+
+def test_snapshot_is_verified_on_first_open_and_rebuilt_if_corrupt(tmp_path):
+    chunk_dir, index_dir = write_corpus(str(tmp_path), {"a_book": 4})
+    path = build_snapshot(index_dir, chunk_dir)
+    start, _ = IndexSnapshot(path).header["sections"]["snippets"]
+    with open(path, "r+b") as f:
+        f.seek(start + 2)
+        f.write(b"#")
+    with pytest.raises(ValueError):
+        IndexSnapshot(path).verify_once()
+    retriever = utils.Retriever.__new__(utils.Retriever)
+    retriever.index_dir, retriever.chunk_dir = index_dir, chunk_dir
+    retriever.corpus_name, retriever.retriever_name = "a", "b"
+    snapshot = retriever._load_snapshot()
+    snapshot.verify()
+    # recorded as verified, so the next open does not check it again
+    assert json.load(open(path + ".verified")) == [os.path.getsize(path), os.stat(path).st_mtime_ns]
+
+
+def test_retriever_bundles_a_snapshot_on_first_load(tmp_path):
+    chunk_dir, flat_dir = write_corpus(str(tmp_path / "textbooks"), {"a_book": 3})
+    index_dir = os.path.join(flat_dir, "dense")
+    os.rename(flat_dir, str(tmp_path / "flat"))
+    os.makedirs(flat_dir)
+    os.rename(str(tmp_path / "flat"), index_dir)
+    retriever = utils.Retriever("dense", "textbooks", str(tmp_path), resource_manager=utils.ResourceManager(), make_snapshot=True)
+    assert retriever.snapshot is not None and len(retriever.snapshot) == 3
+    assert retriever.snapshot.path == os.path.join(index_dir, utils.SNAPSHOT_NAME)
+
+def test_dense_batch_search_matches_single_searches(tmp_path):
+    chunk_dir, index_dir = write_corpus(str(tmp_path), {"a_book": 5, "b_book": 5})
+    retriever = utils.Retriever.__new__(utils.Retriever)
+    retriever.retriever_name, retriever.chunk_dir, retriever.snapshot, retriever.resource_manager = "dense", chunk_dir, None, None
+    retriever._index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    retriever._metadatas = [json.loads(line) for line in open(os.path.join(index_dir, "metadatas.jsonl"))]
+    queries = np.random.default_rng(1).random((3, 4), dtype=np.float32)
+    batch = retriever.get_relevant_documents_batch(["q1", "q2", "q3"], k=4, query_embeds=queries)
+    for q, question in enumerate(["q1", "q2", "q3"]):
+        assert batch[q] == retriever.get_relevant_documents(question, k=4, query_embed=queries[q:q + 1])
+    assert batch[0][0][0]["content"].startswith(batch[0][0][0]["id"].rsplit("_", 1)[0])
+
+
+def test_select_by_token_budget_stops_at_the_budget():
+    snippets = [{"title": "t", "content": "c", "n_tokens": n} for n in (40, 40, 10, 40)]
+    selected, scores = utils.select_by_token_budget(snippets, [0.9, 0.8, 0.7, 0.6], token_budget=100, overhead=8)
+    # the third snippet would still fit, but selection stops at the first one that does not
+    assert selected == snippets[:2] and scores == [0.9, 0.8]
+
+
+def test_select_by_token_budget_stops_at_a_score_gap():
+    snippets = [{"title": "t", "content": "c", "n_tokens": 1}] * 4
+    selected, scores = utils.select_by_token_budget(snippets, [0.9, 0.85, 0.3, 0.29], token_budget=1000, score_gap=0.2)
+    assert scores == [0.9, 0.85]
+
+
+def test_select_by_token_budget_counts_snippets_without_n_tokens():
+    snippets = [{"title": "t", "content": "word " * 10}] * 3
+    counted = []
+    count_tokens = lambda text: counted.append(text) or 20
+    selected, scores = utils.select_by_token_budget(snippets, [], token_budget=50, count_tokens=count_tokens, overhead=0)
+    assert len(selected) == 2 and scores == []
+    assert len(counted) == 3
+
+
+def test_bm25_systems_share_one_lazily_loaded_cache_encoder(monkeypatch):
+    loaded = []
+    monkeypatch.setitem(utils.retriever_names, "FakeBM25", ["bm25"])
+    monkeypatch.setitem(utils.corpus_names, "Fake", ["fake"])
+    monkeypatch.setattr(utils, "Retriever", lambda *args, **kwargs: None)
+    monkeypatch.setattr(utils, "load_encoder", lambda name: loaded.append(name) or types.SimpleNamespace(encode=lambda questions: np.ones((len(questions), 4), dtype=np.float32)))
+    monkeypatch.setattr(utils, "_query_caches", {})
+    monkeypatch.setattr(utils, "_resource_manager", None)
+    systems = [RetrievalSystem("FakeBM25", "Fake", semantic_cache_threshold=0.9) for _ in range(3)]
+    assert loaded == []
+    assert all(system.query_cache is systems[0].query_cache for system in systems)
+    for system in systems:
+        system.query_cache.embed("q")
+    assert loaded == ["ncbi/MedCPT-Query-Encoder"]
@@ -0,0 +1,47 @@
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from utils import RemoteShard, ShardedIndex, construct_index, serve_shard
+
+
+def test_remote_shards_need_an_authkey(tmp_path, monkeypatch):
+    monkeypatch.delenv("MEDRAG_SHARD_AUTHKEY", raising=False)
+    (tmp_path / "shards.json").write_text('{"n_shards": 1, "offsets": [0]}')
+    with pytest.raises(ValueError):
+        ShardedIndex.load(str(tmp_path), addresses=[["localhost", 1]])
+    with pytest.raises(ValueError):
+        RemoteShard(("localhost", 1), b"")
+    with pytest.raises(ValueError):
+        serve_shard(str(tmp_path / "shard_0.index"), ("localhost", 0), b"")
+
+
+def write_embeddings(index_dir, sizes):
+    os.makedirs(os.path.join(index_dir, "embedding"))
+    rng = np.random.default_rng(0)
+    embeds = [rng.random((n, 4), dtype=np.float32) for n in sizes]
+    for i, embed in enumerate(embeds):
+        np.save(os.path.join(index_dir, "embedding", f"file_{i}.npy"), embed)
+    return np.concatenate(embeds)
+
+
+def test_shards_split_rows_evenly_across_files(tmp_path):
+    embeds = write_embeddings(str(tmp_path), [10, 1])
+    index = construct_index(str(tmp_path), "ncbi/MedCPT-Article-Encoder", h_dim=4, n_shards=3)
+    try:
+        assert [shard.ntotal for shard in index.shards] == [3, 4, 4]
+        assert json.load(open(tmp_path / "shards.json"))["offsets"] == [0, 3, 7]
+        flat = faiss.IndexFlatIP(4)
+        flat.add(embeds)
+        assert np.array_equal(index.search(embeds[:5], 6)[1], flat.search(embeds[:5], 6)[1])
+    finally:
+        index.close()
+
+
+def test_more_shards_than_rows_are_refused(tmp_path):
+    write_embeddings(str(tmp_path), [2])
+    with pytest.raises(ValueError):
+        construct_index(str(tmp_path), "ncbi/MedCPT-Article-Encoder", h_dim=4, n_shards=3)
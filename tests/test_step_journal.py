@@ -0,0 +1,22 @@
+from discuss_merge_3 import StepJournal
+
+
+def test_resume_after_torn_line(tmp_path):
+    path = str(tmp_path / "journal_case.jsonl")
+    journal = StepJournal(path)
+    journal.record("participation/1/1/lab", True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"event": "step", "step": "opinion/1/1/lab/imag')  # crashed mid-write
+    # the step is re-run after the crash and must survive the next resume
+    StepJournal(path).record("opinion/1/1/lab/imaging", "agree")
+    resumed = StepJournal(path)
+    assert resumed.steps == {"participation/1/1/lab": True, "opinion/1/1/lab/imaging": "agree"}
+
+
+def test_reads_lines_without_event_field(tmp_path):
+    path = tmp_path / "journal_case.jsonl"
+    path.write_text('{"step": "final_decision", "value": "A"}\n', encoding="utf-8")
+    journal = StepJournal(str(path))
+    assert "final_decision" in journal and journal["final_decision"] == "A"
+    journal.remove()
+    assert not path.exists()